@@ -0,0 +1,265 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Synthetic Munin data generator
+
+Generate a Munin tree usable by dispytch: pollers configurations, datafiles
+and RRD files filled with synthetic values. A dispytch configuration file
+targeting the generated tree is written at its root.
+
+Usage:
+    generator.py <path> [options]
+
+Options:
+    --pollers <count>   Number of pollers [default: 2]
+    --nodes <count>     Number of nodes per poller [default: 10]
+    --history <hours>   Hours of history stored in RRD files [default: 48]
+    --no-rrd            Only generate configurations and datafiles
+"""
+
+
+import os
+import sys
+import math
+import time
+import random
+
+# Munin creates its RRD files with a 5 minutes step and these archives
+MUNIN_STEP = 300
+MUNIN_RRAS = []
+for __steps, __rows in ((1, 576), (6, 432), (24, 540), (288, 450)):
+    for __cf in ('AVERAGE', 'MIN', 'MAX'):
+        MUNIN_RRAS.append("RRA:{0}:0.5:{1}:{2}".format(__cf, __steps, __rows))
+
+# datatype: (graph infos, [(subtype, draw), ...], munin type letter)
+DATATYPES = {
+    'cpu': ({'graph_title': 'CPU usage', 'graph_vlabel': '%',
+             'graph_args': '--base 1000 -r --lower-limit 0'},
+            [('system', 'AREA'), ('user', 'STACK'), ('nice', 'STACK'),
+             ('idle', 'STACK'), ('iowait', 'STACK'), ('irq', 'STACK'),
+             ('softirq', 'STACK')], 'd'),
+    'load': ({'graph_title': 'Load average', 'graph_vlabel': 'load'},
+             [('load', 'LINE2')], 'g'),
+    'memory': ({'graph_title': 'Memory usage', 'graph_vlabel': 'Bytes',
+                'graph_total': 'total'},
+               [('apps', 'AREA'), ('page_tables', 'STACK'),
+                ('slab', 'STACK'), ('cached', 'STACK'), ('buffers', 'STACK'),
+                ('free', 'STACK'), ('swap', 'STACK')], 'g'),
+    'if_eth0': ({'graph_title': 'eth0 traffic',
+                 'graph_vlabel': 'bits in (-) / out (+) per ${graph_period}'},
+                [('down', 'LINE1'), ('up', 'LINE1')], 'd'),
+    'df': ({'graph_title': 'Disk usage in percent', 'graph_vlabel': '%'},
+           [('_dev_sda{0}'.format(idx), 'LINE1') for idx in range(1, 9)],
+           'g'),
+    }
+
+# graphs only described in datafile, making it as large as munin's ones
+EXTRA_GRAPHS = 40
+
+
+def node_names(poller, nodes):
+    """Get generated nodes names of a poller
+
+    :param int poller: Poller index
+    :param int nodes: Number of nodes per poller
+    :return: Nodes names (:class:`list`)
+    """
+    return ["poller{0};host-{0}-{1}.example.com".format(poller, idx)
+            for idx in range(nodes)]
+
+
+def generate_config(path, nodes, files=1, prefix="group"):
+    """Generate synthetic Munin ".conf" files
+
+    :param str path: Directory receiving the configuration files
+    :param nodes: Number of nodes to generate or list of nodes names
+    :param int files: Number of files to spread the nodes in
+    :param str prefix: Group prefix of generated nodes names
+    """
+    if isinstance(nodes, int):
+        nodes = ["{0}{1};host{2}.example.com".format(
+            prefix, idx % files, idx) for idx in range(nodes)]
+
+    per_file = max(1, int(math.ceil(len(nodes) / float(files))))
+    for fidx in range(files):
+        with open(os.path.join(path, "nodes{0:04d}.conf".format(fidx)),
+                  "w") as cfd:
+            cfd.write("# synthetic munin configuration\n")
+            for nidx in range(fidx * per_file,
+                              min(len(nodes), (fidx + 1) * per_file)):
+                cfd.write("[{0}]\n".format(nodes[nidx]))
+                cfd.write("    address 10.{0}.{1}.{2}  # node address\n".format(
+                    nidx / 65536 % 256, nidx / 256 % 256, nidx % 256))
+                cfd.write("    use_node_name yes\n")
+                if nidx % 10 == 0:
+                    cfd.write("    contacts nobody\n")
+                    cfd.write("    df.graph_args --base 1024 -l 0\n")
+                cfd.write("\n")
+
+
+def generate_datafile(path, nodes):
+    """Generate Munin datafile describing nodes graphs
+
+    :param str path: Datafile path
+    :param list nodes: Nodes names
+    """
+    with open(path, "w") as dfile:
+        dfile.write("version 2.0.25\n")
+        for node in nodes:
+            for datatype, (graph, subtypes, _) in sorted(DATATYPES.items()):
+                prefix = "{0}:{1}".format(node, datatype)
+                for key, value in sorted(graph.items()):
+                    dfile.write("{0}.{1} {2}\n".format(prefix, key, value))
+                dfile.write("{0}.graph_order {1}\n".format(
+                    prefix, " ".join([name for name, _ in subtypes])))
+                for name, draw in subtypes:
+                    dfile.write("{0}.{1}.label {1}\n".format(prefix, name))
+                    dfile.write("{0}.{1}.draw {2}\n".format(prefix, name, draw))
+                    dfile.write("{0}.{1}.info synthetic {1} serie\n".format(
+                        prefix, name))
+                if datatype.startswith('if_'):
+                    dfile.write("{0}.up.negative down\n".format(prefix))
+            for idx in range(EXTRA_GRAPHS):
+                prefix = "{0}:extra{1}".format(node, idx)
+                dfile.write("{0}.graph_title Extra graph {1}\n".format(
+                    prefix, idx))
+                dfile.write("{0}.value.label value\n".format(prefix))
+
+
+def generate_rrd(path, kind, start, stop):
+    """Create a Munin RRD file and fill it with synthetic values
+
+    :param str path: RRD file path
+    :param str kind: Munin type letter (g: GAUGE, d: DERIVE)
+    :param int start: First update timestamp
+    :param int stop: Last update timestamp
+    """
+    import rrdtool
+
+    dstype = "GAUGE:600:U:U" if kind == 'g' else "DERIVE:600:0:U"
+    rrdtool.create(path, "--start", str(start - MUNIN_STEP),
+                   "--step", str(MUNIN_STEP), "DS:42:{0}".format(dstype),
+                   *MUNIN_RRAS)
+
+    phase = random.random() * math.pi
+    counter = 0
+    updates = []
+    for timestamp in range(start, stop + 1, MUNIN_STEP):
+        value = 50 + 40 * math.sin(phase + timestamp / 3600.0)
+        if kind == 'd':
+            counter += int(value * MUNIN_STEP)
+            value = counter
+        updates.append("{0}:{1}".format(timestamp, value))
+        if len(updates) >= 512:
+            rrdtool.update(path, *updates)
+            updates = []
+    if updates:
+        rrdtool.update(path, *updates)
+
+
+def write_dispytch_config(path, configpath, datadir, peers=None):
+    """Write dispytch configuration targeting generated data
+
+    :param str path: Configuration file path
+    :param str configpath: Generated Munin configurations path
+    :param str datadir: Generated Munin data directory
+    :param list peers: Federation peers as (poller, munin dispatch URL)
+    """
+    root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    with open(path, "w") as cfd:
+        cfd.write("[logging]\nlevel = warning\nconsole = no\nfile =\n\n")
+        cfd.write("[dispytch]\nlocation = /d/\n")
+        cfd.write("modules = {0}\n".format(os.path.join(root, 'modules')))
+        cfd.write("mutators = {0}\n\n".format(os.path.join(root, 'mutators')))
+        cfd.write("[munin]\ndispatch = /munin/\nmultipollers = yes\n")
+        cfd.write("config = {0}\ndatadir = {1}\n".format(configpath, datadir))
+        cfd.write("routes = <method:list|fetch>\n"
+                  "    <method:list>/<target>\n")
+        for extra in ("", "/<template>"):
+            cfd.write("    <method:by-id|by-ip>/<target>/<datatype>/<cf>"
+                      "/<start>/<stop>{0}\n".format(extra))
+        cfd.write("    <method:aggregate>/<target>/<datatype>/<cf>"
+                  "/<start>/<stop>\n")
+        cfd.write("    <method:all>/<target>/<cf>/<start>/<stop>\n")
+        if peers:
+            cfd.write("peers = {0}\n".format("\n    ".join(
+                "{0} {1}".format(poller, url) for (poller, url) in peers)))
+
+
+def generate(path, pollers=2, nodes=10, history=48, rrd=True):
+    """Generate a synthetic Munin tree
+
+    :param str path: Directory receiving generated data
+    :param int pollers: Number of pollers
+    :param int nodes: Number of nodes per poller
+    :param int history: Hours of history stored in RRD files
+    :param bool rrd: Generate RRD files
+    :return: Generated tree description (:class:`dict`)
+    """
+    configpath = os.path.join(path, "pollers")
+    datadir = os.path.join(path, "db")
+    stop = int(time.time()) // MUNIN_STEP * MUNIN_STEP
+    start = stop - history * 3600
+
+    all_nodes = []
+    rrd_files = 0
+    for pidx in range(pollers):
+        poller = "poller{0}".format(pidx)
+        names = node_names(pidx, nodes)
+        all_nodes.extend(names)
+
+        os.makedirs(os.path.join(configpath, poller))
+        generate_config(os.path.join(configpath, poller), names)
+        os.makedirs(os.path.join(datadir, poller, poller))
+        generate_datafile(os.path.join(datadir, poller, "datafile"), names)
+
+        if not rrd:
+            continue
+        for node in names:
+            host = node.split(';')[-1]
+            for datatype, (_, subtypes, kind) in DATATYPES.items():
+                for subtype, _ in subtypes:
+                    generate_rrd(os.path.join(
+                        datadir, poller, poller, "{0}-{1}-{2}-{3}.rrd".format(
+                            host, datatype, subtype, kind)), kind, start, stop)
+                    rrd_files += 1
+
+    config_file = os.path.join(path, "dispytch.conf")
+    write_dispytch_config(config_file, configpath, datadir)
+    return {'path': path, 'config_file': config_file, 'nodes': all_nodes,
+            'pollers': pollers, 'rrd_files': rrd_files,
+            'start': start, 'stop': stop}
+
+
+if __name__ == "__main__":
+    import docopt
+
+    doc_args = docopt.docopt(__doc__)
+    tree = generate(doc_args['<path>'], int(doc_args['--pollers']),
+                    int(doc_args['--nodes']), int(doc_args['--history']),
+                    not doc_args['--no-rrd'])
+    print("generated {0} nodes and {1} RRD files in {2}".format(
+        len(tree['nodes']), tree['rrd_files'], tree['path']))
+    print("export DISPYTCH_CONFIG={0}".format(tree['config_file']))
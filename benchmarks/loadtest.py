@@ -0,0 +1,747 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""dispytch load test
+
+Drive bin/dispytch end to end with a dashboard-like mix of requests, from
+concurrent clients, and report throughput, latency percentiles, error
+rates and RSS over time as JSON.
+
+Requests are sent either through the CGI environment contract, spawning
+"dispytch --rest" for each request as a web server would, through a
+persistent server spawned with "dispytch serve", or to an already running
+server. The mix is synthetic, against a generated Munin tree, unless a
+recorded mix is given: one request per line, as "<uri>", "<method> <uri>
+[<json body>]" or access log lines. Recorded URIs include dispytch location
+and are reported by method, ie. "GET by-id" for "/d/munin/by-id/...".
+
+Usage:
+    loadtest.py cgi [options]
+    loadtest.py serve [--workers <count>] [options]
+    loadtest.py http <url> [--pid <pid>] [options]
+
+Options:
+    --dataset <path>        Use an already generated Munin tree
+    --pollers <count>       Number of generated pollers [default: 2]
+    --nodes <count>         Number of generated nodes per poller [default: 10]
+    --history <hours>       Hours of generated RRD history [default: 48]
+    --mix <file>            Replay recorded requests instead of synthetic ones
+    --concurrency <count>   Number of concurrent clients [default: 4]
+    --duration <seconds>    Measured duration of the test [default: 30]
+    --warmup <seconds>      Unmeasured duration before the test [default: 2]
+    --interval <seconds>    Timeline sampling interval [default: 1]
+    --workers <count>       Number of server worker processes [default: 1]
+    --pid <pid>             Running server process, whose RSS is sampled
+    --slo <objectives>      Latency (ms) and error rate objectives, ie.
+                            "p95=250,p99=1000,errors=0.01"
+    --seed <seed>           Random seed of the synthetic mix [default: 0]
+    -o <json_file>          Write results to json file
+"""
+
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import httplib
+import urlparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import ConfigParser
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DISPYTCH = os.path.join(ROOT, 'bin', 'dispytch')
+
+import docopt
+
+import generator
+from suite import percentile
+
+
+# Synthetic dashboard mix: (weight, kind, method, path, query, body)
+# Paths are formatted with "node" and "poller", relative to munin dispatch
+SYNTHETIC_MIX = [
+    (30, 'graph_1d', 'GET', "by-id/{node}/{datatype}/AVERAGE/now-1d/now",
+     "", None),
+    (15, 'highcharts_1w', 'GET', "by-id/{node}/{datatype}/AVERAGE/now-1w/now",
+     "?mutator=munin.highcharts", None),
+    (10, 'graph_1h', 'GET', "by-id/{node}/if_eth0/AVERAGE/now-1h/now",
+     "", None),
+    (10, 'node_infos', 'GET', "list/{node}", "", None),
+    (10, 'node_overview', 'GET', "all/{node}/AVERAGE/now-1d/now", "", None),
+    (5, 'nodes_list', 'GET', "list", "", None),
+    (5, 'aggregate_1d', 'GET', "aggregate/{poller};*/cpu/AVERAGE/now-1d/now",
+     "?function=sum", None),
+    (5, 'batch', 'POST', "by-id", "",
+     [{'target': "{node}", 'datatype': datatype, 'cf': "AVERAGE",
+       'start': "now-1d", 'stop': "now"}
+      for datatype in ('cpu', 'load', 'memory')]),
+    ]
+
+# datatypes of synthetic graphs requests
+GRAPH_DATATYPES = ['cpu', 'load', 'memory', 'df']
+
+# request line of access logs, ie. "GET /d/munin/list HTTP/1.1"
+_LOG_REQUEST_RE = re.compile(r'"([A-Z]+) (\S+) HTTP/[0-9.]+"')
+
+
+class Request(object):
+    """Request sent by load test clients
+    """
+
+    __slots__ = ('kind', 'method', 'uri', 'body')
+
+    def __init__(self, kind, method, uri, body=None):
+        """Initialization method
+
+        :param str kind: Request kind, results are reported by kind
+        :param str method: HTTP method, GET or POST
+        :param str uri: Request URI, including dispytch location
+        :param str body: JSON body of POST requests
+        """
+        self.kind = kind
+        self.method = method
+        self.uri = uri
+        self.body = body
+
+
+def _format(template, **fields):
+    """Format strings of a request body template
+
+    :param template: Body template
+    :return: Formatted body
+    """
+    if isinstance(template, dict):
+        return dict((key, _format(value, **fields))
+                    for (key, value) in template.items())
+    if isinstance(template, list):
+        return [_format(value, **fields) for value in template]
+    return template.format(**fields)
+
+
+def synthetic_mix(prefix, nodes, count, seed=0):
+    """Build a synthetic dashboard mix of requests
+
+    Nodes popularity follows a Zipf-like distribution, as dashboards mostly
+    show the same nodes.
+
+    :param str prefix: Munin dispatch URI, ie. "/d/munin"
+    :param list nodes: Munin nodes names
+    :param int count: Number of requests
+    :param int seed: Random seed
+    :return: Requests (:class:`list` of :class:`Request`)
+    """
+    rand = random.Random(seed)
+    ranked = list(nodes)
+    rand.shuffle(ranked)
+    popularity = [1.0 / (rank + 1) for rank in range(len(ranked))]
+    total = float(sum(weight for (weight, _, _, _, _, _) in SYNTHETIC_MIX))
+
+    requests = []
+    for _ in range(count):
+        node = _weighted_choice(rand, ranked, popularity)
+        fields = {'node': node, 'poller': node.split(';')[0],
+                  'datatype': rand.choice(GRAPH_DATATYPES)}
+        threshold = rand.random() * total
+        for (weight, kind, method, path, query, body) in SYNTHETIC_MIX:
+            threshold -= weight
+            if threshold < 0:
+                break
+        uri = "{0}/{1}{2}".format(prefix, path.format(**fields), query)
+        if body is not None:
+            body = json.dumps(_format(body, **fields))
+        requests.append(Request(kind, method, uri, body))
+    return requests
+
+
+def _weighted_choice(rand, items, weights):
+    """Choose an item according to weights
+
+    :param random.Random rand: Random generator
+    :param list items: Items to choose from
+    :param list weights: Items weights
+    :return: Chosen item
+    """
+    threshold = rand.random() * sum(weights)
+    for (item, weight) in zip(items, weights):
+        threshold -= weight
+        if threshold < 0:
+            return item
+    return items[-1]
+
+
+def recorded_mix(path):
+    """Read a recorded mix of requests
+
+    :param str path: Recorded mix file
+    :return: Requests (:class:`list` of :class:`Request`)
+    """
+    requests = []
+    with open(path) as mixfd:
+        for line in mixfd:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            matched = _LOG_REQUEST_RE.search(line)
+            if matched:
+                (method, uri, body) = (matched.group(1), matched.group(2),
+                                       None)
+            elif line.startswith('/'):
+                (method, uri, body) = ('GET', line, None)
+            else:
+                fields = line.split(None, 2)
+                (method, uri) = fields[:2]
+                body = fields[2] if len(fields) > 2 else None
+            # "/<location>/<dispatch>/<method>/..." requests
+            segments = urlparse.urlsplit(uri).path.strip('/').split('/')
+            kind = "{0} {1}".format(method,
+                                    segments[min(2, len(segments) - 1)])
+            requests.append(Request(kind, method, uri, body))
+    return requests
+
+
+def _environ(config_file):
+    """Build environment of dispytch processes, running the repository code
+
+    :param str config_file: dispytch configuration file
+    :return: Environment (:class:`dict`)
+    """
+    path = [ROOT] + [entry for entry in
+                     os.environ.get('PYTHONPATH', '').split(os.pathsep)
+                     if entry]
+    return dict(os.environ, DISPYTCH_CONFIG=config_file,
+                PYTHONPATH=os.pathsep.join(path))
+
+
+def _error(content_type, body):
+    """Get error of a dispytch JSON response
+
+    :param str content_type: Response content type
+    :param str body: Response body
+    :return: Error message or :obj:`None`
+    """
+    if not content_type.startswith('application/json'):
+        return None
+    try:
+        response = json.loads(body)
+    except ValueError:
+        return "invalid JSON response"
+    if isinstance(response, dict) and 'error' in response:
+        return response['error']
+    return None
+
+
+class CGIDriver(object):
+    """Send requests through the CGI environment contract
+
+    Each request spawns "dispytch --rest", with the request in its
+    environment and body on its standard input.
+    """
+
+    def __init__(self, config_file):
+        """Initialization method
+
+        :param str config_file: dispytch configuration file
+        """
+        self.env = _environ(config_file)
+
+    def pids(self):
+        """Processes whose RSS is sampled, none as each request has its own
+
+        :return: Processes ids (:class:`list`)
+        """
+        return []
+
+    def send(self, request):
+        """Send a request
+
+        :param Request request: Request to send
+        :return: Error message or :obj:`None`, and process peak RSS in kB
+        :rtype: tuple
+        """
+        env = dict(self.env, REQUEST_METHOD=request.method,
+                   REQUEST_URI=request.uri)
+        if request.body is not None:
+            env['CONTENT_TYPE'] = 'application/json'
+            env['CONTENT_LENGTH'] = str(len(request.body))
+        with tempfile.TemporaryFile() as errfd:
+            proc = subprocess.Popen([sys.executable, DISPYTCH, '--rest'],
+                                    env=env, stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE, stderr=errfd)
+            proc.stdin.write(request.body or '')
+            proc.stdin.close()
+            output = proc.stdout.read()
+            proc.stdout.close()
+            # the process is reaped here to get its own resources usage
+            (_, status, usage) = os.wait4(proc.pid, 0)
+            proc.returncode = (os.WEXITSTATUS(status)
+                               if os.WIFEXITED(status)
+                               else -os.WTERMSIG(status))
+            if proc.returncode != 0:
+                errfd.seek(0)
+                lines = errfd.read().strip().splitlines() or [""]
+                return ("exit status {0}: {1}".format(proc.returncode,
+                                                      lines[-1]),
+                        usage.ru_maxrss)
+
+        (head, _, body) = output.partition('\n\n')
+        content_type = ''
+        for line in head.splitlines():
+            (name, _, value) = line.partition(':')
+            if name.lower() == 'content-type':
+                content_type = value.strip()
+        return (_error(content_type, body), usage.ru_maxrss)
+
+
+class HTTPDriver(object):
+    """Send requests to a persistent server
+
+    Each client thread keeps its own connection to the server.
+    """
+
+    def __init__(self, url, pid=None):
+        """Initialization method
+
+        :param str url: Server URL, ie. "http://127.0.0.1:8080"
+        :param int pid: Server process, whose RSS is sampled
+        """
+        parsed = urlparse.urlsplit(url)
+        self.host = parsed.hostname
+        self.port = parsed.port or 80
+        self.pid = pid
+        self._local = threading.local()
+
+    def pids(self):
+        """Processes whose RSS is sampled: the server and its workers
+
+        :return: Processes ids (:class:`list`)
+        """
+        if self.pid is None:
+            return []
+        return [self.pid] + _children(self.pid)
+
+    def send(self, request):
+        """Send a request
+
+        :param Request request: Request to send
+        :return: Error message or :obj:`None`, and :obj:`None` as RSS is
+                 sampled from the server processes
+        :rtype: tuple
+        """
+        headers = {}
+        if request.body is not None:
+            headers['Content-Type'] = 'application/json'
+        for attempt in (0, 1):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                conn = httplib.HTTPConnection(self.host, self.port,
+                                              timeout=300)
+                self._local.conn = conn
+            try:
+                conn.request(request.method, request.uri, request.body,
+                             headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as exc:
+                conn.close()
+                self._local.conn = None
+                if attempt == 0 and not isinstance(exc, socket.timeout):
+                    # the server may have closed an idle connection
+                    continue
+                return (str(exc) or exc.__class__.__name__, None)
+            if response.will_close:
+                conn.close()
+                self._local.conn = None
+            break
+
+        if response.status != 200:
+            return ("HTTP {0}".format(response.status), None)
+        return (_error(response.getheader('content-type', ''), body), None)
+
+
+def _children(pid):
+    """Get children processes of a process
+
+    :param int pid: Parent process id
+    :return: Children processes ids (:class:`list`)
+    """
+    children = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(entry)) as statfd:
+                stat = statfd.read()
+        except IOError:
+            continue
+        # the command name may contain spaces, fields follow its parenthesis
+        if int(stat.rsplit(')', 1)[1].split()[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def _rss(pids):
+    """Get resident set size of processes
+
+    :param list pids: Processes ids
+    :return: Total RSS in kB (:class:`int`)
+    """
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{0}/status'.format(pid)) as statusfd:
+                for line in statusfd:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+                        break
+        except IOError:
+            continue
+    return total
+
+
+def spawn_server(config_file, workers):
+    """Spawn a persistent server on a free local port
+
+    The server runs in its own process group, so that its workers are
+    terminated along with it.
+
+    :param str config_file: dispytch configuration file
+    :param int workers: Number of server worker processes
+    :return: Server process and URL (:class:`tuple`)
+    """
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    proc = subprocess.Popen(
+        [sys.executable, DISPYTCH, 'serve', '127.0.0.1:{0}'.format(port),
+         '--workers', str(workers)],
+        env=_environ(config_file), preexec_fn=os.setsid)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError("server exited with status {0}".format(
+                proc.returncode))
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    else:
+        stop_server(proc)
+        raise RuntimeError("server not listening after 30 seconds")
+    return (proc, "http://127.0.0.1:{0}".format(port))
+
+
+def stop_server(proc):
+    """Terminate a spawned server and its workers
+
+    :param subprocess.Popen proc: Server process
+    """
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    proc.wait()
+
+
+class LoadTest(object):
+    """Concurrent clients sending requests in a closed loop
+    """
+
+    def __init__(self, driver, requests, concurrency, interval):
+        """Initialization method
+
+        :param driver: Requests driver (:class:`CGIDriver` or
+                       :class:`HTTPDriver`)
+        :param list requests: Requests, sent in turn by clients
+        :param int concurrency: Number of concurrent clients
+        :param float interval: Timeline sampling interval, in seconds
+        """
+        self.driver = driver
+        self.requests = requests
+        self.concurrency = concurrency
+        self.interval = interval
+        self.samples = []
+        self.timeline = []
+        self._lock = threading.Lock()
+        self._next = 0
+        self._measuring = False
+        self._stopped = threading.Event()
+
+    def _client(self):
+        """Client loop, sending requests until the test is stopped
+        """
+        while not self._stopped.is_set():
+            with self._lock:
+                request = self.requests[self._next % len(self.requests)]
+                self._next += 1
+            started = time.time()
+            (error, rss) = self.driver.send(request)
+            finished = time.time()
+            if self._measuring:
+                with self._lock:
+                    self.samples.append((finished, finished - started,
+                                         request.kind, error, rss))
+
+    def _sample(self):
+        """Sample RSS of driver processes for the timeline
+        """
+        while not self._stopped.wait(self.interval):
+            if self._measuring:
+                self.timeline.append((time.time(),
+                                      _rss(self.driver.pids())))
+
+    def run(self, duration, warmup):
+        """Run the load test
+
+        :param float duration: Measured duration, in seconds
+        :param float warmup: Unmeasured duration before, in seconds
+        :return: Measure start and end timestamps (:class:`tuple`)
+        """
+        threads = [threading.Thread(target=self._client)
+                   for _ in range(self.concurrency)]
+        threads.append(threading.Thread(target=self._sample))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        time.sleep(warmup)
+        self._measuring = True
+        started = time.time()
+        time.sleep(duration)
+        self._measuring = False
+        finished = time.time()
+        self._stopped.set()
+        for thread in threads:
+            thread.join()
+        return (started, finished)
+
+
+def _latencies(timings):
+    """Summarize latencies
+
+    :param list timings: Sorted latencies, in seconds
+    :return: Latencies summary in ms (:class:`dict`)
+    """
+    if not timings:
+        return {}
+    return {'min_ms': timings[0] * 1000,
+            'mean_ms': sum(timings) / len(timings) * 1000,
+            'p50_ms': percentile(timings, 0.50) * 1000,
+            'p95_ms': percentile(timings, 0.95) * 1000,
+            'p99_ms': percentile(timings, 0.99) * 1000,
+            'max_ms': timings[-1] * 1000}
+
+
+def report(loadtest, started, finished):
+    """Report load test results
+
+    :param LoadTest loadtest: Finished load test
+    :param float started: Measure start timestamp
+    :param float finished: Measure end timestamp
+    :return: Results (:class:`dict`)
+    """
+    elapsed = finished - started
+    samples = loadtest.samples
+    errors = [sample for sample in samples if sample[3] is not None]
+    results = {
+        'duration_s': elapsed,
+        'requests': len(samples),
+        'errors': len(errors),
+        'error_rate': len(errors) / float(len(samples)) if samples else None,
+        'throughput_per_s': len(samples) / elapsed,
+        'latency': _latencies(sorted(sample[1] for sample in samples)),
+        'kinds': {},
+        'error_messages': {},
+        'timeline': [],
+        }
+
+    for kind in set(sample[2] for sample in samples):
+        kind_samples = [sample for sample in samples if sample[2] == kind]
+        kind_errors = [sample for sample in kind_samples
+                       if sample[3] is not None]
+        results['kinds'][kind] = dict(
+            _latencies(sorted(sample[1] for sample in kind_samples)),
+            requests=len(kind_samples), errors=len(kind_errors))
+    for sample in errors:
+        message = str(sample[3])[:200]
+        results['error_messages'][message] = (
+            results['error_messages'].get(message, 0) + 1)
+
+    # timeline buckets, RSS sampled from server processes or reported by
+    # CGI processes
+    rss_samples = dict((int((timestamp - started) // loadtest.interval), rss)
+                       for (timestamp, rss) in loadtest.timeline)
+    buckets = {}
+    for sample in samples:
+        buckets.setdefault(int((sample[0] - started) // loadtest.interval),
+                           []).append(sample)
+    for bucket in sorted(set(buckets) | set(rss_samples)):
+        bucket_samples = buckets.get(bucket, [])
+        rss = rss_samples.get(bucket)
+        reported = [sample[4] for sample in bucket_samples
+                    if sample[4] is not None]
+        if reported:
+            rss = max(reported)
+        results['timeline'].append({
+            'offset_s': bucket * loadtest.interval,
+            'requests': len(bucket_samples),
+            'errors': len([sample for sample in bucket_samples
+                           if sample[3] is not None]),
+            'p95_ms': (percentile(sorted(sample[1]
+                                         for sample in bucket_samples),
+                                  0.95) * 1000
+                       if bucket_samples else None),
+            'rss_kb': rss,
+            })
+    return results
+
+
+def check_slo(results, objectives):
+    """Check results against service level objectives
+
+    :param dict results: Load test results
+    :param str objectives: Objectives, ie. "p95=250,p99=1000,errors=0.01"
+    :return: Objectives checks (:class:`dict`)
+    """
+    checks = {}
+    for objective in objectives.split(','):
+        (name, _, target) = objective.strip().partition('=')
+        if name == 'errors':
+            value = results['error_rate']
+        else:
+            value = results['latency'].get('{0}_ms'.format(name))
+        if value is None and name != 'errors':
+            raise ValueError("unknown objective: {0}".format(name))
+        checks[name] = {'target': float(target), 'value': value,
+                        'ok': value is not None and value <= float(target)}
+    return checks
+
+
+def main(doc_args):
+    """Run load test as requested from command line
+
+    :param dict doc_args: Parsed command line arguments
+    :return: Exit code (:class:`int`)
+    """
+    tmpdir = None
+    server = None
+    params = {'pollers': int(doc_args['--pollers']),
+              'nodes': int(doc_args['--nodes']),
+              'history': int(doc_args['--history'])}
+    try:
+        if doc_args['--dataset']:
+            dataset = os.path.abspath(doc_args['--dataset'])
+            tree = {'path': dataset,
+                    'config_file': os.path.join(dataset, 'dispytch.conf'),
+                    'nodes': []}
+            for poller in range(params['pollers']):
+                tree['nodes'].extend(
+                    generator.node_names(poller, params['nodes']))
+        elif doc_args['--mix'] and doc_args['http']:
+            tree = None
+        else:
+            tmpdir = tempfile.mkdtemp(prefix="dispytch-load-")
+            tree = generator.generate(tmpdir, **params)
+
+        duration = float(doc_args['--duration'])
+        if doc_args['--mix']:
+            requests = recorded_mix(doc_args['--mix'])
+        else:
+            if tree is None:
+                raise ValueError("synthetic mix requires a dataset")
+            cfg = ConfigParser.RawConfigParser()
+            cfg.read(tree['config_file'])
+            prefix = "{0}/{1}".format(
+                cfg.get('dispytch', 'location').rstrip('/'),
+                cfg.get('munin', 'dispatch').strip('/'))
+            requests = synthetic_mix(prefix, tree['nodes'], 10000,
+                                     int(doc_args['--seed']))
+        if not requests:
+            raise ValueError("no request to send")
+
+        if doc_args['cgi']:
+            mode = 'cgi'
+            driver = CGIDriver(tree['config_file'])
+        elif doc_args['serve']:
+            mode = 'serve'
+            (server, url) = spawn_server(tree['config_file'],
+                                         int(doc_args['--workers']))
+            driver = HTTPDriver(url, server.pid)
+        else:
+            mode = 'http'
+            pid = doc_args['--pid']
+            driver = HTTPDriver(doc_args['<url>'],
+                                int(pid) if pid else None)
+
+        loadtest = LoadTest(driver, requests,
+                            int(doc_args['--concurrency']),
+                            float(doc_args['--interval']))
+        (started, finished) = loadtest.run(duration,
+                                           float(doc_args['--warmup']))
+    finally:
+        if server is not None:
+            stop_server(server)
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    results = report(loadtest, started, finished)
+    results.update({
+        'timestamp': int(time.time()),
+        'version': open(os.path.join(ROOT, 'VERSION')).read().strip(),
+        'python': platform.python_version(),
+        'mode': mode,
+        'workers': int(doc_args['--workers']) if mode == 'serve' else None,
+        'concurrency': int(doc_args['--concurrency']),
+        'mix': doc_args['--mix'] or 'synthetic',
+        'dataset': params if not doc_args['--mix'] else None,
+        })
+
+    exit_code = 0
+    if doc_args['--slo']:
+        results['slo'] = check_slo(results, doc_args['--slo'])
+        if not all(check['ok'] for check in results['slo'].values()):
+            exit_code = 1
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if doc_args['-o']:
+        with open(doc_args['-o'], 'w') as jsonfd:
+            jsonfd.write(output)
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(docopt.docopt(__doc__)))
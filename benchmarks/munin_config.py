@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Munin configuration loading benchmark
+
+Generate a synthetic Munin configuration and measure its loading.
+
+Usage:
+    munin_config.py [--nodes <count>] [--files <count>] [--rounds <count>]
+
+Options:
+    --nodes <count>     Number of generated nodes [default: 10000]
+    --files <count>     Number of generated ".conf" files [default: 100]
+    --rounds <count>    Number of measured loads [default: 5]
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'modules'))
+
+import docopt
+
+from munin import infos
+from generator import generate_config
+
+
+def measure(func, rounds):
+    """Measure function execution times
+
+    :param func: Function to call
+    :param int rounds: Number of calls
+    :return: Execution times in seconds (:class:`list`)
+    """
+    timings = []
+    for _ in range(rounds):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return timings
+
+
+def main(nodes, files, rounds):
+    """Run the benchmark
+
+    :param int nodes: Number of nodes to generate
+    :param int files: Number of files to spread the nodes in
+    :param int rounds: Number of measured loads
+    :return: Benchmark results (:class:`dict`)
+    """
+    tmpdir = tempfile.mkdtemp(prefix="dispytch-bench-")
+    try:
+        configpath = os.path.join(tmpdir, "conf")
+        os.mkdir(configpath)
+        generate_config(configpath, nodes, files)
+        config = infos.MuninConfig(configpath, os.path.join(tmpdir, "data"),
+                                   "no")
+
+        def full_load():
+            config.clear()
+            config.load()
+
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        full = measure(full_load, rounds)
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # touch a single file to measure incremental reload
+        touched = os.path.join(configpath, "nodes0000.conf")
+
+        def incremental_load():
+            stat = os.stat(touched)
+            os.utime(touched, (stat.st_atime, stat.st_mtime + 1))
+            config.load(force=True)
+
+        incremental = measure(incremental_load, rounds)
+
+        return {
+            'nodes': len(config.nodes),
+            'files': files,
+            'full_load_s': {'min': min(full), 'max': max(full)},
+            'incremental_load_s': {'min': min(incremental),
+                                   'max': max(incremental)},
+            'peak_rss_kb': rss_after,
+            'peak_rss_growth_kb': rss_after - rss_before,
+            }
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    doc_args = docopt.docopt(__doc__)
+    results = main(int(doc_args['--nodes']), int(doc_args['--files']),
+                   int(doc_args['--rounds']))
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+
+"""Check native RRD reader against rrdtool
+
+Fetch every RRD file found under a directory with both rrdtool and the
+native reader, for several windows and consolidation functions, and report
+differences. Files not supported by the native reader are counted as
+skipped.
+
+Usage:
+    rrd_reader_check.py [options] <datadir>
+
+Options:
+    --cf <cf>           Consolidation functions [default: AVERAGE,MIN,MAX]
+    --windows <secs>    Windows sizes in seconds
+                        [default: 3600,86400,604800,2678400,31536000]
+    --offset <secs>     Windows end offset from now [default: 0]
+    --daemon <address>  Flush RRD files through rrdcached before checking
+"""
+
+
+import os
+import sys
+import math
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'modules'))
+
+import docopt
+import rrdtool
+
+from munin import rrd_reader, rrdcached
+
+
+def same_values(expected, values):
+    """Compare rrdtool and native reader values
+
+    :param list expected: rrdtool rows
+    :param array.array values: Native reader values
+    :return: Index of the first difference or None (:class:`int`)
+    """
+    if len(expected) != len(values):
+        return min(len(expected), len(values))
+    for idx, (row, value) in enumerate(zip(expected, values)):
+        if row[0] is None:
+            if not math.isnan(value):
+                return idx
+        elif row[0] != value:
+            return idx
+    return None
+
+
+def check_file(path, cfs, windows, end):
+    """Check native reader on a RRD file
+
+    :return: Checks results as (checked, skipped, errors) (:class:`tuple`)
+    """
+    checked, skipped, errors = 0, 0, []
+    for cf in cfs:
+        for window in windows:
+            start = end - window
+            try:
+                native = rrd_reader.fetch(path, cf, start, end)
+            except rrd_reader.UnsupportedRRD:
+                skipped += 1
+                continue
+            expected = rrdtool.fetch([path, cf, "-s", str(start),
+                                      "-e", str(end)])
+            checked += 1
+            if tuple(expected[0]) != native[0]:
+                errors.append("{0} {1} {2}s: range {3} != {4}".format(
+                    path, cf, window, expected[0], native[0]))
+                continue
+            diff = same_values(expected[2], native[2])
+            if diff is not None:
+                errors.append("{0} {1} {2}s: values differ at row {3}".format(
+                    path, cf, window, diff))
+    return checked, skipped, errors
+
+
+def main(doc_args):
+    """Main function
+    """
+    cfs = doc_args['--cf'].split(',')
+    windows = [int(window) for window in doc_args['--windows'].split(',')]
+    end = int(time.time()) - int(doc_args['--offset'])
+    daemon = None
+    if doc_args['--daemon']:
+        daemon = rrdcached.RRDCachedClient(doc_args['--daemon'])
+
+    total_checked, total_skipped, total_errors = 0, 0, []
+    for root, _, files in os.walk(doc_args['<datadir>']):
+        for filename in sorted(files):
+            if not filename.endswith('.rrd'):
+                continue
+            path = os.path.join(root, filename)
+            if daemon is not None:
+                daemon.flush([path])
+            checked, skipped, errors = check_file(path, cfs, windows, end)
+            total_checked += checked
+            total_skipped += skipped
+            total_errors.extend(errors)
+
+    for error in total_errors:
+        print(error)
+    print("checked: {0}, skipped: {1}, errors: {2}".format(
+        total_checked, total_skipped, len(total_errors)))
+    return 1 if total_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(docopt.docopt(__doc__)))
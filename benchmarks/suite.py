@@ -0,0 +1,354 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""dispytch benchmark suite
+
+Run micro and end-to-end benchmarks of dispytch hot paths against a
+synthetic Munin tree and report latency percentiles, throughput and peak
+RSS as JSON. Results may be compared against a previous run to catch
+performance regressions.
+
+Usage:
+    suite.py [options] [<benchmark>...]
+    suite.py --list
+
+Options:
+    --dataset <path>        Use an already generated Munin tree
+    --pollers <count>       Number of generated pollers [default: 2]
+    --nodes <count>         Number of generated nodes per poller [default: 10]
+    --history <hours>       Hours of generated RRD history [default: 48]
+    --iterations <count>    Measured iterations per benchmark [default: 200]
+    --warmup <count>        Unmeasured iterations per benchmark [default: 5]
+    -o <json_file>          Write results to json file
+    --compare <json_file>   Compare results with a previous run
+    --threshold <ratio>     Tolerated p50 slowdown when comparing [default: 0.2]
+    --list                  List available benchmarks
+"""
+
+
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import timeit
+import platform
+import tempfile
+import resource
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+import docopt
+
+import generator
+
+
+# Registered benchmarks: name -> (setup function, description)
+BENCHMARKS = {}
+
+
+def benchmark(description):
+    """Register a benchmark
+
+    Registered function is a setup function called once with the benchmark
+    context. It returns the function to measure, optionally with a function
+    preparing its arguments for each iteration (not measured).
+
+    :param str description: Benchmark description
+    """
+    def register(func):
+        BENCHMARKS[func.__name__] = (func, description)
+        return func
+    return register
+
+
+class Context(object):
+    """Benchmark context giving access to dispytch and generated data
+    """
+
+    def __init__(self, tree):
+        """Initialization method
+
+        :param dict tree: Generated tree description
+        """
+        # dispytch loads its configuration on import
+        os.environ['DISPYTCH_CONFIG'] = tree['config_file']
+        import dispytch
+
+        self.tree = tree
+        self.dispytch = dispytch
+        self.config = dispytch.config
+        self.node = tree['nodes'][len(tree['nodes']) // 2]
+        self.munin = dispytch.get_module('munin', self.config.modules_path)
+        self.munin.configure(self.config.get_section('munin'))
+        self.mutator = dispytch.get_mutator('munin.highcharts')
+
+    def uri(self, datatype='cpu', start='now-1d', stop='now', query=''):
+        """Build a munin by-id request URI
+
+        :return: Request URI (:class:`str`)
+        """
+        return "{0}/munin/by-id/{1}/{2}/AVERAGE/{3}/{4}{5}".format(
+            self.config.location, self.node, datatype, start, stop, query)
+
+
+@benchmark("parse a GET request URI")
+def receive_request(ctx):
+    uri = ctx.uri()
+    return lambda: ctx.dispytch.receive_request('GET', uri)
+
+
+@benchmark("select dispatch of a request")
+def select_dispatch(ctx):
+    docpath = ctx.uri()[len(ctx.config.location):]
+    return lambda: ctx.dispytch.select_dispatch(docpath,
+                                                ctx.config.dispatches)
+
+
+@benchmark("route a request with the compiled router")
+def route(ctx):
+    docpath = ctx.uri()[len(ctx.config.location):]
+    return lambda: ctx.config.router.route(docpath)
+
+
+@benchmark("load munin configuration from scratch")
+def munin_config_load(ctx):
+    munin_cfg = ctx.config.get_section('munin')
+
+    def load():
+        config = ctx.munin.infos.MuninConfig(
+            munin_cfg['config'], munin_cfg['datadir'],
+            munin_cfg.get('multipollers'))
+        config.load()
+    return load
+
+
+@benchmark("load node graphs infos from datafile")
+def load_node_graphs(ctx):
+    config = ctx.munin.infos.config
+    node = config.get_node(ctx.node)
+    return lambda: config._load_node_graphs(node)
+
+
+@benchmark("fetch RRD series of a datatype (1 day)")
+def get_munin_entry_metrics(ctx):
+    node = ctx.munin.infos.config.get_node(ctx.node)
+    return lambda: ctx.munin.rrd_utils.get_munin_entry_metrics(
+        node.datadir, node.name, 'cpu', 'AVERAGE', 'now-1d', 'now')
+
+
+@benchmark("fetch RRD series of a datatype with the native reader (1 day)")
+def get_munin_entry_metrics_native(ctx):
+    rrd_utils = ctx.munin.rrd_utils
+    node = ctx.munin.infos.config.get_node(ctx.node)
+
+    def run():
+        reader = rrd_utils.READER
+        rrd_utils.READER = "native"
+        try:
+            rrd_utils.get_munin_entry_metrics(
+                node.datadir, node.name, 'cpu', 'AVERAGE', 'now-1d', 'now')
+        finally:
+            rrd_utils.READER = reader
+    return run
+
+
+@benchmark("mutate series to highcharts (1 day)")
+def mutate_to_highcharts(ctx):
+    module = ctx.munin
+    node = module.infos.config.get_node(ctx.node)
+    info = module.infos.config.get_graphs(node)['cpu']
+    data = module.rrd_utils.get_munin_entry_metrics(
+        node.datadir, node.name, 'cpu', 'AVERAGE', 'now-1d', 'now')
+
+    def prepare():
+        # mutators modify series in place
+        return (('munin', copy.deepcopy(info), copy.deepcopy(data)), {})
+    return ctx.mutator, prepare
+
+
+@benchmark("end-to-end request without mutator (1 day)")
+def end_to_end(ctx):
+    uri = ctx.uri()
+
+    def run():
+        request = ctx.dispytch.receive_request('GET', uri)
+        json.dumps(ctx.dispytch.dispatch(*request))
+    return run
+
+
+@benchmark("end-to-end request with highcharts mutator (1 week)")
+def end_to_end_highcharts(ctx):
+    uri = ctx.uri(start='now-1w', query='?mutator=munin.highcharts')
+
+    def run():
+        request = ctx.dispytch.receive_request('GET', uri)
+        json.dumps(ctx.dispytch.dispatch(*request))
+    return run
+
+
+def percentile(values, ratio):
+    """Get percentile from sorted values
+
+    :param list values: Sorted values
+    :param float ratio: Percentile ratio (0 to 1)
+    :return: Percentile value
+    """
+    return values[min(len(values) - 1, int(round(ratio * (len(values) - 1))))]
+
+
+def run_benchmark(ctx, name, iterations, warmup):
+    """Run a registered benchmark
+
+    :param Context ctx: Benchmark context
+    :param str name: Benchmark name
+    :param int iterations: Measured iterations
+    :param int warmup: Unmeasured iterations
+    :return: Benchmark results (:class:`dict`)
+    """
+    setup = BENCHMARKS[name][0](ctx)
+    (func, prepare) = setup if isinstance(setup, tuple) else (setup, None)
+
+    timings = []
+    for idx in range(warmup + iterations):
+        (args, kwargs) = prepare() if prepare else ((), {})
+        start = timeit.default_timer()
+        func(*args, **kwargs)
+        elapsed = timeit.default_timer() - start
+        if idx >= warmup:
+            timings.append(elapsed)
+
+    timings.sort()
+    total = sum(timings)
+    return {
+        'description': BENCHMARKS[name][1],
+        'iterations': iterations,
+        'min_ms': timings[0] * 1000,
+        'mean_ms': total / len(timings) * 1000,
+        'p50_ms': percentile(timings, 0.50) * 1000,
+        'p90_ms': percentile(timings, 0.90) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000,
+        'max_ms': timings[-1] * 1000,
+        'throughput_per_s': len(timings) / total if total else None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+
+def compare(results, baseline, threshold):
+    """Compare benchmark results with a baseline
+
+    :param dict results: Current results
+    :param dict baseline: Baseline results
+    :param float threshold: Tolerated p50 slowdown ratio
+    :return: Comparison per benchmark and regressions names
+    :rtype: tuple
+    """
+    comparison = {}
+    regressions = []
+    for name, result in results['benchmarks'].items():
+        previous = baseline.get('benchmarks', {}).get(name)
+        if not previous or not previous['p50_ms']:
+            continue
+        ratio = result['p50_ms'] / previous['p50_ms']
+        comparison[name] = {'baseline_p50_ms': previous['p50_ms'],
+                            'p50_ms': result['p50_ms'],
+                            'ratio': ratio}
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return comparison, regressions
+
+
+def main(doc_args):
+    """Run benchmarks as requested from command line
+
+    :param dict doc_args: Parsed command line arguments
+    :return: Exit code (:class:`int`)
+    """
+    if doc_args['--list']:
+        for name in sorted(BENCHMARKS):
+            print("{0:28s} {1}".format(name, BENCHMARKS[name][1]))
+        return 0
+
+    names = doc_args['<benchmark>'] or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print("unknown benchmark: {0}".format(name))
+            return 2
+
+    tmpdir = None
+    params = {'pollers': int(doc_args['--pollers']),
+              'nodes': int(doc_args['--nodes']),
+              'history': int(doc_args['--history'])}
+    try:
+        if doc_args['--dataset']:
+            dataset = os.path.abspath(doc_args['--dataset'])
+            tree = {'path': dataset,
+                    'config_file': os.path.join(dataset, 'dispytch.conf'),
+                    'nodes': []}
+            for poller in range(params['pollers']):
+                tree['nodes'].extend(
+                    generator.node_names(poller, params['nodes']))
+        else:
+            tmpdir = tempfile.mkdtemp(prefix="dispytch-bench-")
+            tree = generator.generate(tmpdir, **params)
+
+        ctx = Context(tree)
+        results = {
+            'timestamp': int(time.time()),
+            'version': open(os.path.join(ROOT, 'VERSION')).read().strip(),
+            'python': platform.python_version(),
+            'dataset': params,
+            'benchmarks': {},
+            }
+        for name in names:
+            results['benchmarks'][name] = run_benchmark(
+                ctx, name, int(doc_args['--iterations']),
+                int(doc_args['--warmup']))
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+    exit_code = 0
+    if doc_args['--compare']:
+        with open(doc_args['--compare']) as baseline:
+            (results['comparison'], regressions) = compare(
+                results, json.load(baseline), float(doc_args['--threshold']))
+        if regressions:
+            results['regressions'] = regressions
+            exit_code = 1
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if doc_args['-o']:
+        with open(doc_args['-o'], 'w') as jsonfd:
+            jsonfd.write(output)
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(docopt.docopt(__doc__)))
@@ -28,46 +28,138 @@
 
 import os
 import sys
+import time
+import timeit
 import logging
 import logging.config
 import importlib
+import urllib
 import urlparse
 import json
+import threading
 
 # import config
 # mutators are imported on-demand later
 from dispytch import config
+from dispytch import admission
+from dispytch import body as request_body
+from dispytch import cache
+from dispytch import jobs
+from dispytch import metrics
+from dispytch import pipeline
+from dispytch import profiling
+from dispytch import utils
 
 
 EXIT_USAGE = 2
 EXIT_HANDLE_ERROR = 3
 
 logging.config.dictConfig(config.logging())
-_log = logging.getLogger("dispytch")
+_log = logging.getLogger("dispytch.dispatch")
 
 _INTERNAL_SECTIONS = ('logging',)
 
+cache.configure(config.cache, config.cache_size, config.cache_path)
 
-class MutatorError(Exception):
-    """Custom exception to handle mutator errors
+_profiler = profiling.SamplingProfiler(config.profile_every, config.profile_dir)
+
+_admission = admission.Admission(config.max_inflight, config.client_rate,
+                                 config.client_burst, config.heavy_concurrency,
+                                 config.heavy_timeout)
+
+
+MutatorError = pipeline.MutatorError
+
+# compiled mutators pipelines, by mutator chain
+_pipelines = utils.LRUCache(128, 'mutator_pipelines')
+
+# modules are loaded once per process, by path and name
+_loaded_modules = {}
+
+# in-flight dispatches, identical concurrent requests are coalesced
+_dispatches = utils.SingleFlight('dispatch')
+
+# mutators full names, metrics labels of unknown ones are bounded
+_mutators_names = None
+
+# background jobs, only run by the persistent server
+_jobs = jobs.JobManager(config.jobs_dir, config.jobs_workers, config.jobs_ttl,
+                        config.max_jobs)
+
+
+class RawResponse(object):
+    """Response sent as is, without JSON serialization
     """
 
+    def __init__(self, body, content_type='text/plain; charset=utf-8',
+                 headers=None, path=None):
+        """Initialization method
+
+        Responses may be read from a file instead of body, in which case
+        byte ranges of the file may be requested.
+
+        :param body: Response body, as string or iterable of chunks
+        :param str content_type: Response content type
+        :param list headers: Additional response headers
+        :param str path: Path of the file sent as response body
+        """
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers or []
+        self.path = path
+
+
+class StreamedBody(object):
+    """Response body produced chunk by chunk
+
+    Chunks are produced again each time the body is iterated, so that
+    coalesced requests may share it. The function must not modify its
+    arguments.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        """Initialization method
+
+        :param function: Function returning an iterable of chunks
+        :param args: Positionnal args of the function
+        :param kwargs: Named args of the function
+        """
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __iter__(self):
+        return iter(self.function(*self.args, **self.kwargs))
+
 
 def get_module(module_name, path):
+    module = _loaded_modules.get((path, module_name))
+    if module is not None:
+        return module
     try:
-        _log.debug("importing {0} from {1}".format(module_name, path))
+        _log.debug("importing %s from %s", module_name, path)
         # If a previous module with the same name exists, clean it
         # I don't know if there is a better way, this may not be pythonic
         if module_name in sys.modules:
             sys.modules.pop(module_name)
         sys.path.insert(0, path)
         module = importlib.import_module(module_name)
-        _log.debug("imported: {0}".format(module.__file__))
+        _log.debug("imported: %s", module.__file__)
     finally:
         sys.path.pop(sys.path.index(path))
+    _loaded_modules[(path, module_name)] = module
     return module
 
 
+def get_mutator_module(module_name):
+    """Get mutators module
+
+    :param str module_name: Mutators module name
+    :return: Mutators module
+    """
+    return get_module(module_name, config.mutators_path)
+
+
 def get_mutator(mutator_fullname):
     """Get mutator function
 
@@ -83,11 +175,28 @@ def get_mutator(mutator_fullname):
         raise MutatorError("Invalid mutator name: {0}".format(mutator_fullname))
 
     (module_name, transform) = mutator_fullname.split('.')
-    module = get_module(module_name, config.mutators_path)
-    _log.debug("getting mutator function: mutate_to_{0}".format(transform))
+    module = get_mutator_module(module_name)
+    _log.debug("getting mutator function: mutate_to_%s", transform)
     return getattr(module, "mutate_to_{0}".format(transform))
 
 
+def get_pipeline(mutator_chain):
+    """Get compiled mutators pipeline
+
+    Pipelines are compiled once per mutator chain, see
+    :mod:`dispytch.pipeline` for the chain syntax.
+
+    :param str mutator_chain: Mutator chain
+    :return: Mutators pipeline (:class:`dispytch.pipeline.Pipeline`)
+    """
+    compiled = _pipelines.get(mutator_chain)
+    if compiled is None:
+        compiled = pipeline.compile_pipeline(mutator_chain,
+                                             get_mutator_module)
+        _pipelines.set(mutator_chain, compiled)
+    return compiled
+
+
 # modules path in config
 # mutators path in config
 # mutators are called using <mutator_module>.|mutate_to_|<transform>
@@ -107,7 +216,7 @@ def parse_documentpath(string):
     :rtype: list
     """
     # document path starts with '/', exclude the first empty element
-    _log.debug("parsing documentpath: {0}".format(string))
+    _log.debug("parsing documentpath: %s", string)
     return string.split("/")[1:]
 
 
@@ -118,7 +227,7 @@ def parse_urlencoded(string):
     :return: Named arguments from parsed URL-Encoded string
     :rtype: dict
     """
-    _log.debug("parsing url-encoded: {0}".format(string))
+    _log.debug("parsing url-encoded: %s", string)
     url_params = {}
     for key, value in urlparse.parse_qs(string).items():
         # Forcing single item per key.
@@ -127,61 +236,84 @@ def parse_urlencoded(string):
     return url_params
 
 
-def receive_request(method, request_uri):
+def receive_request(method, request_uri, environ=None, stream=None):
     """Receive request for the specified method
 
+    Request headers and body are read from CGI environment and standard
+    input, unless provided (ie. by a WSGI server).
+
     :param str method: Method used for the request, may be GET or POST
     :param str request_uri: Request URI
+    :param dict environ: Request environment, defaults to :data:`os.environ`
+    :param stream: Request body stream, defaults to :data:`sys.stdin`
 
     :return: Module name, parsed "args" and "kwargs" as :func:`tuple`
     :rtype: tuple
     """
-    _log.debug("request method: {0}".format(method))
+    _log.debug("request method: %s", method)
 
     if request_uri.startswith(config.location):
         # Stripping dispytch location from URI
         request_uri = request_uri[len(config.location):]
 
-    _log.debug('request URI: {0}'.format(request_uri))
-    (dispatch, module_name) = select_dispatch(request_uri, config.dispatches)
-
-    # Cleaning module's dispatch from positionnal arguments
-    if request_uri.startswith(dispatch):
-        request_uri = request_uri[len(dispatch):]
-
-    _log.debug('request target module: {0}'.format(module_name))
-    datas = (module_name, [], {})
-
+    _log.debug('request URI: %s', request_uri)
     docpath = request_uri
     urlencoded = None
     if "?" in request_uri:
         (docpath, urlencoded) = request_uri.split("?", 1)
 
-    _log.debug("request: parsing documentpath from URI")
-    datas[1].extend(parse_documentpath(docpath))
+    # Routing selects the dispatch and extracts arguments from document path
+    routed = config.router.route(docpath)
+    if routed is None:
+        raise ImportError("No module found to handle the request")
+    (dispatch, module_name, path_args, path_kwargs) = routed
+    # path arguments may be percent-encoded, ie. nodes patterns
+    path_args = [urllib.unquote(arg) for arg in path_args]
+    path_kwargs = dict((key, urllib.unquote(value))
+                       for (key, value) in path_kwargs.items())
+    _log.debug("selected dispatch: %s", dispatch)
+
+    _log.debug('request target module: %s', module_name)
+    datas = (module_name, path_args, {})
 
     if urlencoded:
         _log.debug("request: parsing url-encoded from URI")
         datas[2].update(parse_urlencoded(urlencoded))
 
     if method == "POST":
+        environ = os.environ if environ is None else environ
+        stream = sys.stdin if stream is None else stream
+
         # Typical content type header:
         #   application/json; charset=utf-8
         # Charset support will be implemented in future releases
-        content_type = os.environ.get('CONTENT_TYPE').split(';')[0]
-        _log.debug("request content-type: {0}".format(content_type))
+        content_type = (environ.get('CONTENT_TYPE') or '').split(';')[0]
+        _log.debug("request content-type: %s", content_type)
 
-        # read posted data from stdin
-        request = sys.stdin.read()
-
-        if content_type == 'application/json':
-            _log.debug("request: parsing json from POST")
-            datas[2].update(json.loads(request))
+        # CGI bodies end with standard input, others are bounded by length
+        if environ.get('CONTENT_LENGTH'):
+            length = int(environ['CONTENT_LENGTH'])
+        else:
+            length = None if stream is sys.stdin else 0
+        reader = request_body.BodyReader(stream, length, config.max_body_size)
+
+        if content_type.strip() == 'application/json':
+            parser = request_body.JSONStream(reader)
+            if parser.peek() == '[':
+                # sub-requests are parsed while they are processed
+                _log.debug("request: streaming json batch from POST")
+                datas[2]['_batch'] = parser.items()
+            else:
+                _log.debug("request: parsing json from POST")
+                datas[2].update(parser.value())
         else:
             _log.debug("request: parsing url-encoded from POST")
-            datas[2].update(parse_urlencoded(request))
+            datas[2].update(parse_urlencoded(reader.read_all()))
 
-    _log.debug("request datas: {0}".format(datas))
+    # Arguments from document path take precedence
+    datas[2].update(path_kwargs)
+
+    _log.debug("request datas: %s", datas)
     return datas
 
 
@@ -194,20 +326,200 @@ def info():
     # get insternal configuration
     for section in _INTERNAL_SECTIONS:
         cur_config.update({ section: config.get_section(section)})
-        config.print_section(section)
 
     # get moludes configuration
-    for disp in config.dispatch_list():
+    for disp in config.dispatches:
         (section, mod_config) = config.get_dispatch(disp)
         cur_config.update({ section: config.get_section(section)})
-        config.print_section(section)
 
     return cur_config
 
 
+def list_modules():
+    """List configured modules
+
+    :return: Configured modules by dispatch
+    :rtype: dict
+    """
+    return dict(config.dispatches)
+
+
+def list_mutators():
+    """List available mutators
+
+    :return: Available mutators full names
+    :rtype: list
+    """
+    mutators = []
+    for filename in sorted(os.listdir(config.mutators_path)):
+        (module_name, ext) = os.path.splitext(filename)
+        if ext != '.py':
+            continue
+        module = get_mutator_module(module_name)
+        for attr in sorted(dir(module)):
+            for prefix in ('mutate_to_', 'transform_'):
+                if attr.startswith(prefix):
+                    mutators.append("{0}.{1}".format(module_name,
+                                                     attr[len(prefix):]))
+    return mutators
+
+
+def metrics_exposition():
+    """Get dispytch runtime metrics
+
+    :return: Metrics in Prometheus text exposition format
+    :rtype: RawResponse
+    """
+    return RawResponse(metrics.render(), 'text/plain; version=0.0.4')
+
+
+def _configured_modules():
+    """Load and configure modules of configured dispatches
+
+    :return: Configured modules (:class:`list`)
+    """
+    modules = []
+    for module_name in sorted(set(config.dispatches.values())):
+        module = get_module(module_name, config.modules_path)
+        module.configure(config.get_section(module_name))
+        modules.append(module)
+    return modules
+
+
+def periodic_tasks():
+    """List periodic tasks of configured modules
+
+    Modules may provide a "periodic_tasks" function returning their tasks
+    as (name, interval, function, offset). Tasks are run on multiples of
+    their interval, shifted by their offset in seconds.
+
+    :return: Periodic tasks (:class:`list`)
+    """
+    tasks = []
+    for module in _configured_modules():
+        if hasattr(module, 'periodic_tasks'):
+            tasks.extend(module.periodic_tasks())
+    return tasks
+
+
+def warm_up():
+    """Warm up configured modules before serving requests
+
+    Modules may provide a "warm_up" function, ie. loading their
+    configuration and indexes, run by the persistent server before its
+    workers are forked.
+    """
+    for module in _configured_modules():
+        if hasattr(module, 'warm_up'):
+            try:
+                module.warm_up()
+            except Exception as exc:
+                _log.error("unable to warm up %s: %s", module.__name__, exc)
+
+
+def run_task(name, function):
+    """Run a periodic task, logging its failures
+
+    :param str name: Task name
+    :param function: Task function
+    """
+    _log.debug("running task %s", name)
+    try:
+        function()
+    except Exception as exc:
+        _log.error("task %s failed: %s", name, exc)
+
+
+def start_periodic_tasks():
+    """Run periodic tasks of configured modules in background threads
+
+    Tasks are run once at start.
+    """
+    def loop(name, interval, function, offset):
+        while True:
+            run_task(name, function)
+            time.sleep(interval - (time.time() - offset) % interval)
+
+    for (name, interval, function, offset) in periodic_tasks():
+        _log.info("scheduling task %s every %ss", name, interval)
+        task = threading.Thread(target=loop,
+                                args=(name, interval, function, offset))
+        task.daemon = True
+        task.start()
+
+
+def enable_jobs():
+    """Enable background jobs, run by the persistent server workers
+    """
+    _jobs.enabled = True
+
+
+def run_job(module_name, args, kwargs):
+    """Run a job request
+
+    Modules may split requests, ie. multi-targets requests, so that a job
+    result is written as each part is handled. Jobs are not limited by
+    modules "max_cost".
+
+    :param str module_name: Module handling the request
+    :param list args: Positionnal args to pass to the module
+    :param dict kwargs: Named args to pass to the module
+
+    :return: Responses of the request parts (:class:`generator`)
+    """
+    requests = [(args, kwargs)]
+    if not kwargs.get('mutator'):
+        module = get_module(module_name, config.modules_path)
+        module.configure(config.get_section(module_name))
+        if hasattr(module, 'split_request'):
+            requests = module.split_request(*args, **kwargs)
+    for (part_args, part_kwargs) in requests:
+        response = dispatch(module_name, list(part_args), part_kwargs,
+                            background=True)
+        if isinstance(response, RawResponse):
+            raise RuntimeError("streamed exports are not supported by jobs")
+        yield response
+
+
+def job(*args):
+    """Get job status or result
+
+    Jobs are requested by identifier, as "<id>" for their status and as
+    "<id>/result" for their gzip'd JSON lines result.
+
+    :return: Job status (:class:`dict`) or result (:class:`RawResponse`)
+    """
+    if len(args) == 1:
+        return _jobs.status(args[0])
+    if len(args) == 2 and args[1] == 'result':
+        path = _jobs.result_path(args[0])
+        disposition = 'attachment; filename="{0}"'.format(
+            os.path.basename(path))
+        return RawResponse(None, 'application/gzip', path=path,
+                           headers=[('Content-Disposition', disposition)])
+    raise jobs.JobError("invalid job request")
+
+
+# Internal dispatches handlers, as referenced in configuration
+_INTERNAL_HANDLERS = {
+    'info': info,
+    'list_modules': list_modules,
+    'list_mutators': list_mutators,
+    'metrics': metrics_exposition,
+    }
+
+# Internal dispatches handlers taking positionnal args from document path
+_INTERNAL_REQUEST_HANDLERS = {
+    'jobs': job,
+    }
+
+
 def select_dispatch(docpath, dispatches):
     """Select matching dispatch from dispatches infos
 
+    Requests are routed using the router compiled from configuration, this
+    function is kept to select a dispatch from arbitrary dispatches.
+
     :param str docpath: Requested path
     :param dict dispatches: Dictionnary of dispatches and associated modules
 
@@ -216,16 +528,21 @@ def select_dispatch(docpath, dispatches):
     # dispatches are sorted, so the most precise dispatch is selected
     for entry in sorted(dispatches, reverse=True):
         if docpath == entry or docpath.startswith("{0}/".format(entry)):
-            _log.debug("selected dispatch: {0}".format(entry))
+            _log.debug("selected dispatch: %s", entry)
             return (entry, dispatches[entry])
 
 
-def dispatch(module_name, args, kwargs):
+def dispatch(module_name, args, kwargs, background=False):
     """Dispatch request args and kwargs to the selected module
 
+    Requests with "async" named arg set to "yes" are submitted as jobs, the
+    job status is returned. Without mutator, requests with "format" named
+    arg set to "frames" get their series as binary frames.
+
     :param str docpath: Document path called
     :param list args: Positionnal args to pass to the module
     :param dict kwargs: Named args to pass to the module
+    :param bool background: Request is run by a job
 
     :return: Data returned by module
     :rtype: dict
@@ -234,28 +551,65 @@ def dispatch(module_name, args, kwargs):
     module_config = {}
 
     # retrieve the required known module using dispatch info from document path
-    _log.info("handling new dispatch: {0}".format(module_name))
+    _log.info("handling new dispatch: %s", module_name)
 
-    # How to handle internal dispatches ?
-    #if dispatch_target is not None:
-    #    return {'result': dispatch_target()}
+    if module_name in _INTERNAL_HANDLERS:
+        data = _INTERNAL_HANDLERS[module_name]()
+        if isinstance(data, RawResponse):
+            return data
+        return {'result': data}
+
+    if module_name in _INTERNAL_REQUEST_HANDLERS:
+        data = _INTERNAL_REQUEST_HANDLERS[module_name](*args)
+        if isinstance(data, RawResponse):
+            return data
+        return {'result': data}
 
     module_config = config.get_section(module_name)
-    _log.debug("module config: {0}".format(module_config))
+    _log.debug("module config: %s", module_config)
 
     if not module_config:
         raise ImportError("No module found to handle the request")
 
+    submit = kwargs.get('async') == 'yes'
+    if submit:
+        kwargs = dict(kwargs)
+        del kwargs['async']
+
     try:
-        module = get_module(module_name, config.modules_path)
-        module.configure(module_config)
-        data = module.handle_request(*args, **kwargs)
+        with profiling.timed('get_module'):
+            module = get_module(module_name, config.modules_path)
+        with profiling.timed('configure'):
+            module.configure(module_config)
+
+        # modules may estimate requests costs before handling them
+        cost = 0
+        if hasattr(module, 'estimate_cost'):
+            with profiling.timed('estimate_cost'):
+                cost = module.estimate_cost(*args, **kwargs)
+        # jobs have their own cost limit, checked before being queued
+        if submit or background:
+            admission.check_cost(cost,
+                                 int(module_config.get('max_job_cost', 0)))
+            if submit:
+                return {'result': _jobs.submit((module_name, args, kwargs),
+                                               run_job)}
+            max_cost = 0
+        else:
+            max_cost = int(module_config.get('max_cost', 0))
+        with _admission.cost_lane(cost, max_cost,
+                                  int(module_config.get('heavy_cost', 0))):
+            with profiling.timed('handle_request'):
+                data = module.handle_request(*args, **kwargs)
 
     except ImportError:
         raise ImportError("No module found to handle the request")
 
+    except (admission.RequestRejected, jobs.JobError):
+        raise
+
     except Exception as exc:
-        _log.error("handled module error: {0}".format(exc.message))
+        _log.error("handled module error: %s", exc.message)
         raise RuntimeError(exc.message)
 
     if kwargs.get('mutator'):
@@ -263,18 +617,287 @@ def dispatch(module_name, args, kwargs):
             mutator_name = kwargs['mutator']
             mutator_opts = kwargs.get('mutator_opts')
 
-            _log.debug('selected mutator: {0}'.format(mutator_name))
-            mutator = get_mutator(mutator_name)
+            _log.debug('selected mutator: %s', mutator_name)
+            with profiling.timed('get_mutator'):
+                mutator = get_pipeline(mutator_name)
+
+            if mutator.content_type is not None:
+                # exports are produced while they are sent to the client
+                _log.debug('streaming series through mutator')
+                return RawResponse(
+                    StreamedBody(mutator, module_name, data[0], data[1],
+                                 options=mutator_opts),
+                    mutator.content_type)
 
             _log.debug('sending series to mutator')
-            return {'result': mutator(module_name, data[0], data[1],
-                                      options=mutator_opts)}
+            with profiling.timed('mutate'):
+                response = {'result': mutator(module_name, data[0], data[1],
+                                              options=mutator_opts)}
 
-        except ImportError, AttributeError:
+        except (ImportError, AttributeError):
             raise ImportError("No mutator found to transform the response")
 
         except Exception as exc:
-            _log.error("handled mutator error: {0}".format(exc.message))
+            _log.error("handled mutator error: %s", exc.message)
             raise RuntimeError(exc.message)
+    elif kwargs.get('format') == 'frames':
+        # series are sent as binary frames, from their buffers when packed
+        headers = []
+        if len(data) > 2 and data[2]:
+            headers.append(('X-Dispytch-Errors', json.dumps(data[2])))
+        return RawResponse(StreamedBody(utils.series_frames, data[1]),
+                           'application/x-dispytch-frames', headers)
+    else:
+        response = {'result': data[1]}
+
+    # modules may report partial failures along with their data
+    if len(data) > 2 and data[2]:
+        response['errors'] = data[2]
+    return response
+
+
+def dispatch_batch(module_name, args, kwargs):
+    """Dispatch a batch of sub-requests
+
+    Sub-requests are read from the "_batch" iterator of kwargs, ie. a JSON
+    array posted to a dispatch, and are processed as they are read. Their
+    arguments complete the request ones.
+
+    :param str module_name: Module handling the requests
+    :param list args: Positionnal args of the request
+    :param dict kwargs: Named args of the request, with "_batch" iterator
+
+    :return: Responses of sub-requests
+    :rtype: dict
+    """
+    base = dict(kwargs)
+    batch = base.pop('_batch')
+    responses = []
+    for sub_request in batch:
+        if not isinstance(sub_request, dict):
+            responses.append({'error': "invalid sub-request"})
+            continue
+        sub_kwargs = dict(base)
+        sub_kwargs.update(sub_request)
+        try:
+            if config.coalesce:
+                response = coalesced_dispatch(module_name, list(args),
+                                              sub_kwargs)
+            else:
+                response = dispatch(module_name, list(args), sub_kwargs)
+        except Exception as exc:
+            response = {'error': exc.message}
+        if isinstance(response, RawResponse):
+            response = {'error': "streamed exports are not supported in "
+                                 "batches"}
+        responses.append(response)
+    return {'result': responses}
 
-    return {'result': data[1]}
+
+def coalesced_dispatch(module_name, args, kwargs):
+    """Dispatch request, sharing the result of identical in-flight requests
+
+    Requests are identical when their module, args and kwargs are the same.
+    Each request gets its own copy of the response dict, so that it may be
+    extended.
+
+    :param str module_name: Module handling the request
+    :param list args: Positionnal args to pass to the module
+    :param dict kwargs: Named args to pass to the module
+
+    :return: Data returned by module
+    :rtype: dict
+    """
+    key = json.dumps([module_name, args, kwargs], sort_keys=True)
+    data = _dispatches.do(key, dispatch, module_name, args, kwargs)
+    if isinstance(data, dict):
+        return dict(data)
+    return data
+
+
+def read_file_range(path, range_header=None):
+    """Read file, or the byte range requested by "Range" header
+
+    Only single byte ranges are supported, the whole file is read for other
+    ranges. The body is read by chunks while it is sent.
+
+    :param str path: File path
+    :param str range_header: Request "Range" header
+
+    :return: Response headers (:class:`list` of tuples) and body
+    :rtype: tuple
+    """
+    size = os.path.getsize(path)
+    headers = [('Accept-Ranges', 'bytes')]
+    byte_range = utils.parse_byte_range(range_header, size)
+    if byte_range is None:
+        (first, last) = (0, size - 1)
+    elif byte_range is utils.UNSATISFIABLE_RANGE:
+        headers.extend([('Status', '416 Range Not Satisfiable'),
+                        ('Content-Range', 'bytes */{0}'.format(size))])
+        return (headers, '')
+    else:
+        (first, last) = byte_range
+        headers.extend([('Status', '206 Partial Content'),
+                        ('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                            first, last, size))])
+
+    # the file is opened at once, so that it may be removed while it is sent
+    response_file = open(path, 'rb')
+    response_file.seek(first)
+    headers.append(('Content-Length', str(last - first + 1)))
+    return (headers, _read_chunks(response_file, last - first + 1))
+
+
+def _read_chunks(response_file, length, size=65536):
+    """Read file chunks, closing it once read
+
+    :param file response_file: File to read, from its current position
+    :param int length: Number of bytes to read
+    :param int size: Chunks size
+    :return: File chunks (:class:`generator`)
+    """
+    try:
+        while length > 0:
+            chunk = response_file.read(min(size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        response_file.close()
+
+
+def _metric_labels(module_name, args, kwargs):
+    """Build requests metrics labels
+
+    Labels values are bounded: methods unknown to their module and chains
+    of unknown mutators are labeled "other". Modules list their methods
+    with an optional "methods" function.
+
+    :param str module_name: Module handling the request
+    :param list args: Positionnal args of the request
+    :param dict kwargs: Named args of the request
+    :return: Labels values (:class:`dict`)
+    """
+    global _mutators_names
+    labels = {'module': module_name, 'method': '', 'mutator': ''}
+    if (module_name in _INTERNAL_HANDLERS or
+            module_name in _INTERNAL_REQUEST_HANDLERS):
+        return labels
+
+    method = kwargs.get('method') or (args[0] if args else '')
+    if method:
+        try:
+            module = get_module(module_name, config.modules_path)
+            known = module.methods() if hasattr(module, 'methods') else ()
+        except ImportError:
+            known = ()
+        labels['method'] = method if method in known else 'other'
+
+    chain = kwargs.get('mutator')
+    if chain:
+        if _mutators_names is None:
+            try:
+                _mutators_names = frozenset(list_mutators())
+            except (OSError, ImportError):
+                _mutators_names = frozenset()
+        try:
+            names = pipeline.stage_names(chain)
+        except pipeline.MutatorError:
+            names = None
+        if names and all(name in _mutators_names for name in names):
+            labels['mutator'] = "|".join(names)
+        else:
+            labels['mutator'] = 'other'
+    return labels
+
+
+def _count_bytes(chunks, module_name):
+    """Account streamed response chunks in metrics
+
+    :param chunks: Response body chunks
+    :param str module_name: Module that built the response
+    :return: Response body chunks (:class:`generator`)
+    """
+    for chunk in chunks:
+        metrics.RESPONSE_BYTES.inc(len(chunk), module=module_name)
+        yield chunk
+
+
+def process_request(method, request_uri, environ=None, stream=None):
+    """Process a request and serialize its response
+
+    Request phases are timed. Timings are returned as "Server-Timing" header
+    and/or as "_timings" response field, according to configuration.
+
+    :param str method: Method used for the request, may be GET or POST
+    :param str request_uri: Request URI
+    :param dict environ: Request environment, defaults to :data:`os.environ`
+    :param stream: Request body stream, defaults to :data:`sys.stdin`
+
+    :return: Response headers (:class:`list` of tuples) and body, as string
+             or iterable of chunks for streamed responses
+    :rtype: tuple
+    """
+    started = timeit.default_timer()
+    timings = profiling.start_request()
+    profile = _profiler.start()
+    labels = {'module': '', 'method': '', 'mutator': ''}
+    status = 'ok'
+    headers = []
+    environ = os.environ if environ is None else environ
+    try:
+        try:
+            _admission.admit_client(environ.get('REMOTE_ADDR'))
+            with _admission.in_flight():
+                with timings.phase('receive_request'):
+                    (module_name, args, kwargs) = receive_request(
+                        method, request_uri, environ, stream)
+                labels.update(_metric_labels(module_name, args, kwargs))
+                if '_batch' in kwargs:
+                    labels['method'] = 'batch'
+                    data = dispatch_batch(module_name, args, kwargs)
+                elif config.coalesce:
+                    data = coalesced_dispatch(module_name, args, kwargs)
+                else:
+                    data = dispatch(module_name, args, kwargs)
+        except admission.RequestRejected as exc:
+            status = 'rejected'
+            headers.extend(exc.headers())
+            data = {'error': exc.message}
+        except Exception as exc:
+            status = 'error'
+            data = {'error': exc.message}
+
+        if isinstance(data, RawResponse):
+            content_type = data.content_type
+            headers.extend(data.headers)
+            body = data.body
+            if data.path is not None:
+                (range_headers, body) = read_file_range(
+                    data.path, environ.get('HTTP_RANGE'))
+                headers.extend(range_headers)
+        else:
+            content_type = 'application/json'
+            if config.timings in ('field', 'both'):
+                data['_timings'] = timings.as_dict()
+
+            with timings.phase('serialize'):
+                body = utils.dumps_json(data, indent=2)
+    finally:
+        _profiler.stop(profile, request_uri or '')
+        profiling.end_request()
+
+    metrics.REQUESTS.inc(status=status, **labels)
+    metrics.REQUEST_DURATION.observe(timeit.default_timer() - started,
+                                     **labels)
+    if isinstance(body, basestring):
+        metrics.RESPONSE_BYTES.inc(len(body), module=labels['module'])
+    else:
+        body = _count_bytes(body, labels['module'])
+
+    headers.append(('Content-type', content_type))
+    if config.timings in ('header', 'both'):
+        headers.append(('Server-Timing', timings.server_timing()))
+    return (headers, body)
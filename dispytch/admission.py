@@ -0,0 +1,250 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Admission control of dispytch requests
+
+Requests are admitted in three steps:
+    - per client token buckets limit the requests rate of each client
+    - a bounded number of requests are processed at once, others are
+      rejected right away
+    - modules may estimate requests costs before handling them, requests
+      above a budget are rejected and expensive ones are queued in a heavy
+      lane processing a few of them at once
+
+Rejected requests raise :class:`RequestRejected`, holding the HTTP status to
+answer with.
+"""
+
+
+import time
+import logging
+import threading
+import contextlib
+
+from dispytch import metrics
+from dispytch import utils
+
+
+_log = logging.getLogger("dispytch.admission")
+
+REJECTED = metrics.counter('dispytch_rejected_requests_total',
+                           'Requests rejected by admission control',
+                           ('reason',))
+
+HTTP_STATUSES = {
+    413: "413 Request Entity Too Large",
+    429: "429 Too Many Requests",
+    503: "503 Service Unavailable",
+    }
+
+
+class RequestRejected(Exception):
+    """Request rejected by admission control
+    """
+
+    def __init__(self, message, status=503, retry_after=None):
+        """Initialization method
+
+        :param str message: Rejection reason
+        :param int status: HTTP status
+        :param int retry_after: Seconds after which the client may retry
+        """
+        super(RequestRejected, self).__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    def headers(self):
+        """Get HTTP headers of the rejection
+
+        :return: Headers names and values (:class:`list`)
+        """
+        headers = [('Status', HTTP_STATUSES[self.status])]
+        if self.retry_after is not None:
+            headers.append(('Retry-After', str(self.retry_after)))
+        return headers
+
+
+def check_cost(cost, max_cost):
+    """Reject a request more expensive than allowed
+
+    :param int cost: Request cost estimated by its module
+    :param int max_cost: Maximum cost of admitted requests, 0 disables it
+    :raise: RequestRejected
+    """
+    if max_cost and cost > max_cost:
+        REJECTED.inc(reason='cost')
+        raise RequestRejected(
+            "request too expensive ({0} > {1})".format(cost, max_cost), 413)
+
+
+class TokenBucket(object):
+    """Token bucket refilled at a constant rate
+    """
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst):
+        """Initialization method
+
+        :param int burst: Bucket capacity
+        """
+        self.tokens = float(burst)
+        self.updated = time.time()
+
+
+class ClientLimiter(object):
+    """Requests rate limiter per client
+
+    Buckets of the least recently seen clients are dropped once more than
+    ``max_clients`` are tracked.
+    """
+
+    def __init__(self, rate, burst, max_clients=10000):
+        """Initialization method
+
+        :param float rate: Requests per second allowed per client
+        :param int burst: Requests a client may send at once
+        :param int max_clients: Maximum number of tracked clients
+        """
+        self.rate = rate
+        self.burst = burst
+        self._buckets = utils.LRUCache(max_clients)
+        self._lock = threading.Lock()
+
+    def admit(self, client):
+        """Take a token from client bucket
+
+        :param str client: Client identifier
+        :raise: RequestRejected if the client has no token left
+        """
+        now = time.time()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = TokenBucket(self.burst)
+                self._buckets.set(client, bucket)
+            bucket.tokens = min(self.burst, bucket.tokens +
+                                (now - bucket.updated) * self.rate)
+            bucket.updated = now
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return
+            missing = 1 - bucket.tokens
+
+        REJECTED.inc(reason='rate')
+        raise RequestRejected("too many requests", 429,
+                              int(missing / self.rate) + 1)
+
+
+class Admission(object):
+    """Admission controller
+    """
+
+    def __init__(self, max_inflight=0, client_rate=0, client_burst=20,
+                 heavy_concurrency=2, heavy_timeout=10):
+        """Initialization method
+
+        Limits set to 0 are disabled.
+
+        :param int max_inflight: Maximum number of requests processed at once
+        :param float client_rate: Requests per second allowed per client
+        :param int client_burst: Requests a client may send at once
+        :param int heavy_concurrency: Expensive requests processed at once
+        :param float heavy_timeout: Maximum wait of expensive requests
+        """
+        self.max_inflight = max_inflight
+        self.heavy_timeout = heavy_timeout
+        self._inflight = 0
+        self._lock = threading.Lock()
+        self._heavy = threading.Semaphore(max(1, heavy_concurrency))
+        self._limiter = None
+        if client_rate > 0:
+            self._limiter = ClientLimiter(client_rate, client_burst)
+
+    def admit_client(self, client):
+        """Apply client rate limit
+
+        :param str client: Client identifier, ie. its address
+        :raise: RequestRejected
+        """
+        if self._limiter is not None and client:
+            self._limiter.admit(client)
+
+    @contextlib.contextmanager
+    def in_flight(self):
+        """Account a request in flight
+
+        :raise: RequestRejected if too many requests are in flight
+        """
+        with self._lock:
+            if self.max_inflight and self._inflight >= self.max_inflight:
+                full = True
+            else:
+                full = False
+                self._inflight += 1
+        if full:
+            REJECTED.inc(reason='overload')
+            raise RequestRejected("server overloaded", 503, 1)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._inflight -= 1
+
+    def _acquire_heavy(self):
+        """Wait for a heavy lane slot, up to the heavy timeout
+
+        :return: True if acquired (:class:`bool`)
+        """
+        deadline = time.time() + self.heavy_timeout
+        while True:
+            if self._heavy.acquire(False):
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+
+    @contextlib.contextmanager
+    def cost_lane(self, cost, max_cost=0, heavy_cost=0):
+        """Admit a request according to its estimated cost
+
+        :param int cost: Request cost estimated by its module
+        :param int max_cost: Maximum cost of admitted requests
+        :param int heavy_cost: Cost from which requests use the heavy lane
+        :raise: RequestRejected
+        """
+        check_cost(cost, max_cost)
+        if not heavy_cost or cost < heavy_cost:
+            yield
+            return
+
+        _log.debug("queuing expensive request (cost %s)", cost)
+        if not self._acquire_heavy():
+            REJECTED.inc(reason='heavy')
+            raise RequestRejected("too many expensive requests", 503,
+                                  max(1, int(self.heavy_timeout)))
+        try:
+            yield
+        finally:
+            self._heavy.release()
@@ -0,0 +1,239 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Requests bodies reading
+
+Bodies are read incrementally, within their announced length and the
+configured size limit. JSON arrays are parsed as a stream of items, so that
+batches of sub-requests may be processed while their body is read.
+"""
+
+
+import re
+import json
+import logging
+
+from dispytch import admission
+
+
+_log = logging.getLogger("dispytch.body")
+
+CHUNK_SIZE = 65536
+
+_WHITESPACES = ' \t\n\r'
+
+# JSON strings, unterminated string starts and brackets, scanned to find
+# where arrays, objects and strings end before decoding them
+_TOKEN_RE = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|"|[\[\]{}]')
+
+# characters ending JSON numbers and literals
+_SCALAR_END_RE = re.compile(r'[\s,\]}]')
+
+
+class BodyReader(object):
+    """Request body reader bounded by its length and a size limit
+    """
+
+    def __init__(self, stream, length=None, max_size=0):
+        """Initialization method
+
+        :param stream: Body stream
+        :param int length: Body length, None to read up to end of stream
+        :param int max_size: Maximum body size, 0 disables the limit
+        :raise: RequestRejected if the body is too large
+        """
+        if max_size and length is not None and length > max_size:
+            raise admission.RequestRejected("request body too large", 413)
+        self._stream = stream
+        self._remaining = length
+        self._max_size = max_size
+        self._read = 0
+
+    def read(self, size=CHUNK_SIZE):
+        """Read a chunk of body
+
+        :param int size: Maximum chunk size
+        :return: Body chunk, empty at end of body (:class:`str`)
+        :raise: RequestRejected if the body exceeds the size limit
+        """
+        if self._remaining is not None:
+            size = min(size, self._remaining)
+            if size <= 0:
+                return ''
+        chunk = self._stream.read(size)
+        self._read += len(chunk)
+        if self._remaining is not None:
+            self._remaining -= len(chunk)
+            if not chunk:
+                # truncated body
+                self._remaining = 0
+        if self._max_size and self._read > self._max_size:
+            raise admission.RequestRejected("request body too large", 413)
+        return chunk
+
+    def read_all(self):
+        """Read the whole body
+
+        :return: Body (:class:`str`)
+        """
+        chunks = []
+        for chunk in iter(self.read, ''):
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+
+class JSONStream(object):
+    """Incremental JSON body parser
+    """
+
+    def __init__(self, reader):
+        """Initialization method
+
+        :param BodyReader reader: Body reader
+        """
+        self._reader = reader
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Read next body chunk, dropping already parsed data
+
+        :return: False at end of body (:class:`bool`)
+        """
+        if self._eof:
+            return False
+        # chunks grow with the pending value, so that it is copied a bounded
+        # number of times
+        chunk = self._reader.read(max(CHUNK_SIZE,
+                                      len(self._buffer) - self._pos))
+        if not chunk:
+            self._eof = True
+            return False
+        self._buffer = self._buffer[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """Get next non-whitespace character
+
+        :return: Next character, empty at end of body (:class:`str`)
+        """
+        while True:
+            while (self._pos < len(self._buffer) and
+                   self._buffer[self._pos] in _WHITESPACES):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, characters):
+        """Consume next character, which must be one of characters
+
+        :param str characters: Expected characters
+        :return: Consumed character (:class:`str`)
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError("invalid JSON body near offset {0}".format(
+                self._pos))
+        self._pos += 1
+        return character
+
+    def _delimited_end(self):
+        """Read body up to the end of the next array, object or string
+
+        Body chunks are scanned once, the value being decoded when it is
+        complete.
+
+        :return: Value end offset in buffer (:class:`int`)
+        """
+        depth = 0
+        scan = self._pos
+        while True:
+            matched = _TOKEN_RE.search(self._buffer, scan)
+            if matched is None or matched.group() == '"':
+                # value continues in next chunk, an unterminated string is
+                # scanned again from its start
+                scan = len(self._buffer) if matched is None \
+                    else matched.start()
+                shift = self._pos
+                if not self._fill():
+                    raise ValueError("invalid JSON body")
+                scan -= shift
+                continue
+            scan = matched.end()
+            token = matched.group()
+            if token in '[{':
+                depth += 1
+            elif token in ']}':
+                depth -= 1
+            if depth <= 0:
+                return scan
+
+    def decode(self):
+        """Decode next JSON value
+
+        :return: Decoded value
+        """
+        if self.peek() in ('[', '{', '"'):
+            self._delimited_end()
+        else:
+            # numbers and literals end with a delimiter or the body
+            while (not _SCALAR_END_RE.search(self._buffer, self._pos) and
+                   self._fill()):
+                continue
+        try:
+            (value, self._pos) = self._decoder.raw_decode(self._buffer,
+                                                          self._pos)
+        except ValueError:
+            raise ValueError("invalid JSON body")
+        return value
+
+    def items(self):
+        """Iterate over the items of a JSON array body
+
+        :return: Array items (:class:`generator`)
+        """
+        self._expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+        else:
+            while True:
+                yield self.decode()
+                if self._expect(',]') == ']':
+                    break
+        if self.peek():
+            raise ValueError("unexpected data after JSON array")
+
+    def value(self):
+        """Decode the whole body as a single JSON value
+
+        :return: Decoded value
+        """
+        body = self._buffer[self._pos:] + self._reader.read_all()
+        (self._buffer, self._pos, self._eof) = ('', 0, True)
+        return json.loads(body)
@@ -0,0 +1,408 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Shared cache
+
+Fetched data may be kept in a cache shared by every dispytch process of a
+host, so that workers do not warm their own caches separately. Cached
+values are binary strings, callers serialize their data compactly (ie.
+with :mod:`marshal` or packed arrays).
+
+Backends:
+    none        caching disabled
+    memory      per-process LRU cache
+    shm         memory-mapped slab store (ie. under /dev/shm) shared by
+                processes, with LRU eviction
+    <module>.<class>    custom backend implementing :class:`Cache`
+"""
+
+
+import os
+import mmap
+import time
+import fcntl
+import struct
+import hashlib
+import logging
+import importlib
+import threading
+import contextlib
+import collections
+
+from dispytch import metrics
+
+
+_log = logging.getLogger("dispytch.cache")
+
+# configured backend, see configure
+BACKEND = None
+
+
+class Cache(object):
+    """Cache backend interface
+    """
+
+    def __init__(self, size, path=None):
+        """Initialization method
+
+        :param int size: Cache size in bytes
+        :param str path: Backend storage path, if any
+        """
+        self.size = size
+        self.path = path
+
+    def get(self, key):
+        """Get cached value
+
+        :param str key: Entry key
+        :return: Cached value or :obj:`None`
+        """
+        raise NotImplementedError()
+
+    def set(self, key, value, ttl=0):
+        """Cache value, evicting least recently used entries if needed
+
+        :param str key: Entry key
+        :param str value: Entry value
+        :param int ttl: Entry lifetime in seconds, 0 for no expiration
+        """
+        raise NotImplementedError()
+
+    def clear(self):
+        """Drop every cached entries
+        """
+        raise NotImplementedError()
+
+
+class MemoryCache(Cache):
+    """Per-process LRU cache, bounded by the size of its values
+    """
+
+    def __init__(self, size, path=None):
+        Cache.__init__(self, size, path)
+        self._entries = collections.OrderedDict()
+        self._used = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[1] and entry[1] < time.time():
+                self._used -= len(key) + len(entry[0])
+                return None
+            self._entries[key] = entry
+        return entry[0]
+
+    def set(self, key, value, ttl=0):
+        if len(key) + len(value) > self.size:
+            return
+        expires = time.time() + ttl if ttl else 0
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._used -= len(key) + len(previous[0])
+            self._entries[key] = (value, expires)
+            self._used += len(key) + len(value)
+            while self._used > self.size:
+                (old_key, old) = self._entries.popitem(last=False)
+                self._used -= len(old_key) + len(old[0])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._used = 0
+
+
+class SharedMemoryCache(Cache):
+    """Memory-mapped slab store shared by processes
+
+    The store file is split in slab classes of fixed size chunks. Chunks of
+    a class are grouped in sets of a few ways, an entry may only be stored
+    in the set selected by its key hash, replacing the least recently used
+    entry of the set. Lookups thus read a few chunks headers per class.
+
+    Processes lock the store file to update it, each process maps it once.
+    """
+
+    MAGIC = 'DSPC'
+    VERSION = 1
+    # chunks sizes of slab classes
+    CHUNK_SIZES = (1024, 4096, 16384, 65536, 262144, 1048576)
+    # chunks per set
+    WAYS = 8
+
+    _HEADER = struct.Struct('=4sIQ')
+    # key hash, last use, expiration, key and value lengths
+    _CHUNK = struct.Struct('=QddII')
+    _LAST_USE = struct.Struct('=d')
+
+    def __init__(self, size, path=None):
+        Cache.__init__(self, size, path or '/dev/shm/dispytch-cache')
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+        # slab classes as (chunk size, offset, number of sets)
+        self._classes = []
+        offset = self._HEADER.size
+        share = max(0, size - offset) // len(self.CHUNK_SIZES)
+        for chunk in self.CHUNK_SIZES:
+            sets = share // (chunk * self.WAYS)
+            if sets:
+                self._classes.append((chunk, offset, sets))
+                offset += sets * self.WAYS * chunk
+        self._length = offset
+
+    def _open(self):
+        """Map the store file, once per process
+
+        The store is initialized if it does not match this cache geometry.
+        """
+        if self._pid == os.getpid():
+            return
+        if self._fd is not None:
+            # mapping inherited from the parent process, its descriptor
+            # shares the parent lock
+            self._map.close()
+            os.close(self._fd)
+            (self._map, self._fd) = (None, None)
+
+        header = self._HEADER.pack(self.MAGIC, self.VERSION, self.size)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            size = os.fstat(fd).st_size
+            if size == 0:
+                self._initialize(fd, header)
+            elif size != self._length or os.read(fd, len(header)) != header:
+                # stores mapped by processes using another geometry must not
+                # be resized, they are replaced by a new store
+                _log.info("replacing shared cache %s", self.path)
+                replaced = fd
+                temporary = "{0}.{1}".format(self.path, os.getpid())
+                fd = os.open(temporary, os.O_RDWR | os.O_CREAT | os.O_TRUNC,
+                             0o600)
+                os.close(replaced)
+                self._initialize(fd, header)
+                os.rename(temporary, self.path)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            self._map = mmap.mmap(fd, self._length)
+        except Exception:
+            os.close(fd)
+            raise
+        (self._fd, self._pid) = (fd, os.getpid())
+
+    def _initialize(self, fd, header):
+        """Initialize an empty store
+
+        :param int fd: Store file descriptor
+        :param str header: Store header
+        """
+        _log.info("initializing shared cache %s", self.path)
+        os.ftruncate(fd, self._length)
+        os.lseek(fd, 0, os.SEEK_SET)
+        os.write(fd, header)
+
+    @contextlib.contextmanager
+    def _locked(self, operation):
+        """Lock the store, against threads and other processes
+
+        :param int operation: :data:`fcntl.LOCK_SH` or :data:`fcntl.LOCK_EX`
+        """
+        with self._lock:
+            self._open()
+            fcntl.flock(self._fd, operation)
+            try:
+                yield self._map
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _chunks(self, key_hash):
+        """List chunks of the sets selected by a key hash
+
+        :param int key_hash: Key hash
+        :return: Chunk size and offset (:class:`generator`)
+        """
+        for (chunk, offset, sets) in self._classes:
+            first = offset + (key_hash % sets) * self.WAYS * chunk
+            for way in range(self.WAYS):
+                yield (chunk, first + way * chunk)
+
+    def _find(self, store, key, key_hash):
+        """Find chunk holding an entry
+
+        :return: Chunk offset and header or :obj:`None`
+        """
+        for (chunk, offset) in self._chunks(key_hash):
+            header = self._CHUNK.unpack_from(store, offset)
+            if header[0] != key_hash or not header[1]:
+                continue
+            start = offset + self._CHUNK.size
+            if store[start:start + header[3]] == key:
+                return (offset, header)
+        return None
+
+    def get(self, key):
+        key_hash = _hash(key)
+        with self._locked(fcntl.LOCK_SH) as store:
+            found = self._find(store, key, key_hash)
+            if found is None:
+                return None
+            (offset, (_, _, expires, key_len, value_len)) = found
+            now = time.time()
+            if expires and expires < now:
+                return None
+            self._LAST_USE.pack_into(store, offset + 8, now)
+            start = offset + self._CHUNK.size + key_len
+            return store[start:start + value_len]
+
+    def set(self, key, value, ttl=0):
+        key_hash = _hash(key)
+        length = self._CHUNK.size + len(key) + len(value)
+        chunk_size = None
+        for (chunk, offset, sets) in self._classes:
+            if chunk >= length:
+                chunk_size = chunk
+                break
+        if chunk_size is None:
+            return
+
+        now = time.time()
+        with self._locked(fcntl.LOCK_EX) as store:
+            found = self._find(store, key, key_hash)
+            if found is not None:
+                self._LAST_USE.pack_into(store, found[0] + 8, 0)
+
+            # free chunk, expired one, or least recently used one of the set
+            victim = None
+            for (chunk, offset) in self._chunks(key_hash):
+                if chunk != chunk_size:
+                    continue
+                (_, last_use, expires) = self._CHUNK.unpack_from(store,
+                                                                 offset)[:3]
+                rank = 0 if not last_use or (expires and expires < now) \
+                    else last_use
+                if victim is None or rank < victim[0]:
+                    victim = (rank, offset)
+
+            offset = victim[1]
+            start = offset + self._CHUNK.size
+            store[start:start + len(key) + len(value)] = key + value
+            self._CHUNK.pack_into(store, offset, key_hash, now,
+                                  now + ttl if ttl else 0, len(key),
+                                  len(value))
+
+    def clear(self):
+        with self._locked(fcntl.LOCK_EX) as store:
+            for (chunk, offset, sets) in self._classes:
+                for idx in range(sets * self.WAYS):
+                    self._LAST_USE.pack_into(store, offset + idx * chunk + 8,
+                                             0)
+
+
+def _hash(key):
+    """Hash cache key
+
+    :param str key: Entry key
+    :return: Key hash (:class:`int`)
+    """
+    return struct.unpack('=Q', hashlib.md5(key).digest()[:8])[0]
+
+
+BACKENDS = {
+    'memory': MemoryCache,
+    'shm': SharedMemoryCache,
+    }
+
+
+def configure(backend=None, size=None, path=None):
+    """Configure cache backend
+
+    The backend is kept while its configuration does not change.
+
+    :param str backend: Backend name or "<module>.<class>" of a custom
+                        backend, "none" disables caching
+    :param int size: Cache size in bytes
+    :param str path: Backend storage path, if any
+    """
+    global BACKEND
+    if not backend or backend == 'none':
+        BACKEND = None
+        return
+
+    size = int(size or 67108864)
+    if backend in BACKENDS:
+        backend_class = BACKENDS[backend]
+    else:
+        (module_name, _, class_name) = backend.rpartition('.')
+        try:
+            backend_class = getattr(importlib.import_module(module_name),
+                                    class_name)
+        except (ImportError, AttributeError, ValueError):
+            raise RuntimeError("unknown cache backend: {0}".format(backend))
+
+    if (BACKEND is not None and BACKEND.__class__ is backend_class and
+            BACKEND.size == size and BACKEND.path == (path or BACKEND.path)):
+        return
+    BACKEND = backend_class(size, path)
+
+
+def get(namespace, key):
+    """Get value from configured cache
+
+    Cache errors are logged, lookups then miss.
+
+    :param str namespace: Cached data namespace, used in metrics
+    :param str key: Entry key
+    :return: Cached value or :obj:`None`
+    """
+    if BACKEND is None:
+        return None
+    try:
+        value = BACKEND.get("{0}:{1}".format(namespace, key))
+    except (EnvironmentError, mmap.error) as exc:
+        _log.warning("cache lookup failed: %s", exc)
+        value = None
+    metrics.CACHE_REQUESTS.inc(cache=namespace,
+                               result='miss' if value is None else 'hit')
+    return value
+
+
+def put(namespace, key, value, ttl=0):
+    """Cache value in configured cache
+
+    :param str namespace: Cached data namespace
+    :param str key: Entry key
+    :param str value: Entry value
+    :param int ttl: Entry lifetime in seconds, 0 for no expiration
+    """
+    if BACKEND is None:
+        return
+    try:
+        BACKEND.set("{0}:{1}".format(namespace, key), value, ttl)
+    except (EnvironmentError, mmap.error) as exc:
+        _log.warning("cache update failed: %s", exc)
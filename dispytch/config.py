@@ -24,6 +24,8 @@
 import ConfigParser
 import os
 
+from dispytch import routing
+
 
 __CONFIG = {}
 CONFIG_FILE = 'dispytch.conf'
@@ -31,6 +33,9 @@ CONFIG_FILE = 'dispytch.conf'
 # dirty patch for development
 CONFIG_FILE = os.path.sep.join([os.path.dirname(__file__), CONFIG_FILE])
 
+# configuration file may be overridden from environment (benchmarks, tests)
+CONFIG_FILE = os.environ.get('DISPYTCH_CONFIG', CONFIG_FILE)
+
 
 
 
@@ -105,11 +110,64 @@ def __configure():
     globals()['modules_path'] = cfg['modules']
     globals()['mutators_path'] = cfg['mutators']
     globals()['dispatches'] = __get_dispatches()
+    # requests timings may be returned as "header", "field" or "both"
+    globals()['timings'] = cfg.get('timings', 'no')
+    globals()['profile_every'] = int(cfg.get('profile_every', 0))
+    globals()['profile_dir'] = cfg.get('profile_dir', '/tmp/dispytch-profiles')
+    # identical concurrent requests share a single dispatch
+    globals()['coalesce'] = cfg.get('coalesce', 'yes') == 'yes'
+    # requests bodies size limit, 0 disables it
+    globals()['max_body_size'] = int(cfg.get('max_body_size', 10485760))
+    # admission control limits, 0 disables them
+    globals()['max_inflight'] = int(cfg.get('max_inflight', 0))
+    globals()['client_rate'] = float(cfg.get('client_rate', 0))
+    globals()['client_burst'] = int(cfg.get('client_burst', 20))
+    globals()['heavy_concurrency'] = int(cfg.get('heavy_concurrency', 2))
+    globals()['heavy_timeout'] = float(cfg.get('heavy_timeout', 10))
+    # cache shared by processes: none, memory, shm or <module>.<class>
+    globals()['cache'] = cfg.get('cache', 'none')
+    globals()['cache_size'] = int(cfg.get('cache_size', 67108864))
+    globals()['cache_path'] = cfg.get('cache_path', '/dev/shm/dispytch-cache')
+    # background jobs spool directory, workers threads, files lifetime and
+    # queued jobs bound
+    globals()['jobs_dir'] = cfg.get('jobs_dir', '/tmp/dispytch-jobs')
+    globals()['jobs_workers'] = int(cfg.get('jobs_workers', 2))
+    globals()['jobs_ttl'] = int(cfg.get('jobs_ttl', 86400))
+    globals()['max_jobs'] = int(cfg.get('max_jobs', 16))
+    # metrics snapshots shared by the persistent server workers
+    globals()['metrics_dir'] = cfg.get('metrics_dir',
+                                       '/dev/shm/dispytch-metrics')
+    # internal dispatches are relative to dispytch location
     globals()['internal_dispatches'] = {
-            '{0}/info'.format(location): "info",
-            '{0}/modules'.format(location): "list_modules",
-            '{0}/mutators'.format(location): "list_mutators"
+            '/info': "info",
+            '/modules': "list_modules",
+            '/mutators': "list_mutators",
+            '/metrics': "metrics",
+            '/jobs': "jobs",
             }
+    globals()['router'] = __compile_router()
+
+
+def __compile_router():
+    """Compile requests routing from configured dispatches
+
+    Modules path templates are read from the "routes" option of their
+    section, one template per line.
+
+    :return: Compiled router
+    :rtype: routing.Router
+    """
+    router = routing.Router()
+    for dispatch, section in dispatches.items():
+        templates = __CONFIG[section].get('routes', '').split('\n')
+        router.add(dispatch, section,
+                   [template.strip() for template in templates
+                    if template.strip()])
+
+    # internal dispatches take precedence over modules dispatches
+    for dispatch, target in internal_dispatches.items():
+        router.add(dispatch, target)
+    return router
 
 
 def print_section(section):
@@ -152,28 +210,32 @@ def get_dispatch(dispatch):
     :return: related section with options
     :rtype: tuple
     """
-    for section in __CONFIG:
-        if __CONFIG[section].has_key('dispatch'):
-            value = __CONFIG[section].get('dispatch')
-            if value == dispatch:
-                return (section, __CONFIG[section])
-
-    return (None, {})
+    section = dispatches.get(dispatch)
+    if section is None:
+        return (None, {})
+    return (section, __CONFIG[section])
 
 
 def logging():
     """Generate logging configuration
 
+    Subsystems loggers (ie. "dispytch.dispatch", "dispytch.munin.rrd") are
+    children of the "dispytch" logger. Their levels may be configured
+    separately using the "loggers" option:
+
+        loggers = dispytch.munin.rrd:debug, dispytch.server:warning
+
     :return: logging configuration to apply
     :rtype: dict
     """
     log = get_section('logging')
-    log_level = log.get('level', 'debug').upper()
+    log_level = log.get('level', 'info').upper()
     log_format = log.get('format',
                      '%(asctime)s %(name)s [%(levelname)s] %(message)s')
 
     log_conf = {
         'version': 1,
+        'disable_existing_loggers': False,
         'formatters': {
             'brief': {
                 'format': '[%(levelname)s] [%(filename)s:%(funcName)s] %(message)s'},
@@ -184,16 +246,20 @@ def logging():
             'dispytch': {
                 'level': log_level,
                 'handlers': ['null'],
-                'propagate': 'no',
+                'propagate': False,
                 },
             },
         }
 
+    for entry in log.get('loggers', '').split(','):
+        if ':' in entry:
+            (name, level) = entry.strip().split(':', 1)
+            log_conf['loggers'][name] = {'level': level.strip().upper()}
+
     if log.get('console') == 'yes':
         log_conf['handlers'].update({
             'console': {
                 'class': 'logging.StreamHandler',
-                'level': log_level,
                 'formatter': 'brief',
                 'stream': 'ext://sys.stdout',
                 },
@@ -204,11 +270,13 @@ def logging():
         log_conf['handlers'].update({
             'file': {
                 'class': 'logging.FileHandler',
-                'level': log_level,
                 'formatter': 'general',
                 'filename': log.get('file'),
             },
         })
+        if log.get('async') == 'yes':
+            log_conf['handlers']['file']['class'] = \
+                'dispytch.logqueue.QueueFileHandler'
         log_conf['loggers']['dispytch']['handlers'].append('file')
 
     return(log_conf)
@@ -0,0 +1,247 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Asynchronous jobs
+
+Expensive requests may be run as jobs by a pool of background threads of
+the persistent server. Jobs statuses and results are spooled to disk, so
+that any worker process may report them:
+
+    <jobs_dir>/<id>.json        job status
+    <jobs_dir>/<id>.jsonl.gz    job result, gzip'd JSON lines
+
+Results of modules returning series by node and datatype are written as a
+line per serie, other results as a single line.
+"""
+
+
+import os
+import re
+import json
+import gzip
+import time
+import uuid
+import Queue
+import logging
+import threading
+
+from dispytch import admission
+from dispytch import utils
+
+
+_log = logging.getLogger("dispytch.jobs")
+
+_JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+class JobError(Exception):
+    """Job request error
+    """
+
+
+def _series_records(result):
+    """Split a module result into JSON lines records
+
+    :param result: Module result
+    :return: Records (:class:`generator`)
+    """
+    if isinstance(result, dict) and all(
+            isinstance(datatypes, dict) and
+            all(isinstance(series, list) for series in datatypes.values())
+            for datatypes in result.values()):
+        for (node, datatypes) in result.items():
+            for (datatype, series) in datatypes.items():
+                for serie in series:
+                    record = {'node': node, 'datatype': datatype}
+                    record.update(serie)
+                    yield record
+    else:
+        yield result
+
+
+class JobManager(object):
+    """Jobs spooling and execution
+    """
+
+    def __init__(self, directory, workers=2, ttl=86400, max_jobs=16):
+        """Initialization method
+
+        :param str directory: Spool directory
+        :param int workers: Number of jobs run at once by a process
+        :param int ttl: Seconds jobs files are kept after their last update
+        :param int max_jobs: Number of jobs waiting to be run by a process
+        """
+        self.directory = directory
+        self.workers = workers
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self.enabled = False
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _path(self, job_id, suffix):
+        """Get job file path
+
+        :param str job_id: Job identifier
+        :param str suffix: File suffix
+        :return: File path (:class:`str`)
+        """
+        if not _JOB_ID_RE.match(job_id or ''):
+            raise JobError("invalid job id")
+        return os.path.join(self.directory, job_id + suffix)
+
+    def _write_status(self, status):
+        """Write job status atomically
+
+        :param dict status: Job status
+        """
+        path = self._path(status['id'], '.json')
+        with open(path + '.tmp', 'w') as status_file:
+            json.dump(status, status_file)
+        os.rename(path + '.tmp', path)
+
+    def _start(self, run):
+        """Start workers threads, once per process
+
+        :param run: Function running a request, yielding results
+        """
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(max(1, self.max_jobs))
+            for _ in range(max(1, self.workers)):
+                worker = threading.Thread(target=self._work, args=(run,))
+                worker.daemon = True
+                worker.start()
+            self._pid = os.getpid()
+
+    def _work(self, run):
+        """Worker thread main loop
+
+        :param run: Function running a request, yielding results
+        """
+        while True:
+            (status, request) = self._queue.get()
+            try:
+                self._run(status, request, run)
+            except Exception:
+                _log.exception("job %s failed", status['id'])
+
+    def _run(self, status, request, run):
+        """Run a job and spool its result
+
+        :param dict status: Job status
+        :param tuple request: Module name, args and kwargs of the request
+        :param run: Function running a request, yielding results
+        """
+        status.update({'status': 'running', 'started': time.time()})
+        self._write_status(status)
+
+        path = self._path(status['id'], '.jsonl.gz')
+        records = 0
+        errors = {}
+        try:
+            with gzip.open(path + '.tmp', 'wb') as result_file:
+                for response in run(*request):
+                    errors.update(response.get('errors', {}))
+                    for record in _series_records(response.get('result')):
+                        result_file.write(utils.dumps_json(record))
+                        result_file.write('\n')
+                        records += 1
+            os.rename(path + '.tmp', path)
+        except Exception as exc:
+            _log.error("job %s failed: %s", status['id'], exc)
+            if os.path.exists(path + '.tmp'):
+                os.unlink(path + '.tmp')
+            status.update({'status': 'failed', 'error': str(exc)})
+        else:
+            status.update({'status': 'done', 'records': records,
+                           'size': os.path.getsize(path)})
+            if errors:
+                status['errors'] = errors
+        status['finished'] = time.time()
+        self._write_status(status)
+
+    def cleanup(self):
+        """Remove expired jobs files
+        """
+        expired = time.time() - self.ttl
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.unlink(path)
+            except OSError:
+                continue
+
+    def submit(self, request, run):
+        """Submit a job
+
+        :param tuple request: Module name, args and kwargs of the request
+        :param run: Function running a request, yielding results
+        :return: Job status (:class:`dict`)
+        :raise: RequestRejected if too many jobs are waiting
+        """
+        if not self.enabled:
+            raise JobError("jobs require the persistent server")
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.cleanup()
+        self._start(run)
+
+        status = {'id': uuid.uuid4().hex, 'status': 'queued',
+                  'created': time.time(), 'module': request[0]}
+        self._write_status(status)
+        try:
+            self._queue.put_nowait((dict(status), request))
+        except Queue.Full:
+            os.unlink(self._path(status['id'], '.json'))
+            admission.REJECTED.inc(reason='jobs')
+            raise admission.RequestRejected("too many queued jobs", 503, 60)
+        _log.info("job %s queued", status['id'])
+        return status
+
+    def status(self, job_id):
+        """Get job status
+
+        :param str job_id: Job identifier
+        :return: Job status (:class:`dict`)
+        """
+        try:
+            with open(self._path(job_id, '.json')) as status_file:
+                return json.load(status_file)
+        except IOError:
+            raise JobError("unknown job")
+
+    def result_path(self, job_id):
+        """Get path of a job result
+
+        :param str job_id: Job identifier
+        :return: Result file path (:class:`str`)
+        """
+        status = self.status(job_id)
+        if status['status'] != 'done':
+            raise JobError("job is {0}".format(status['status']))
+        return self._path(job_id, '.jsonl.gz')
@@ -0,0 +1,125 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Asynchronous logging handler
+
+Records are queued by the logging thread and written to file by a
+background thread, so requests processing never waits for log writes.
+"""
+
+
+import os
+import Queue
+import atexit
+import logging
+import threading
+
+
+class QueueFileHandler(logging.Handler):
+    """Logging handler writing records to file from a background thread
+
+    Records are dropped when the queue is full rather than blocking the
+    logging thread. The writing thread is (re)started on first record
+    emitted by each process, so the handler survives workers forks.
+    """
+
+    def __init__(self, filename, mode='a', maxsize=10000):
+        """Initialization method
+
+        :param str filename: Log file path
+        :param str mode: Log file opening mode
+        :param int maxsize: Maximum number of queued records
+        """
+        logging.Handler.__init__(self)
+        self.filename = filename
+        self.mode = mode
+        self.maxsize = maxsize
+        self.dropped = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        atexit.register(self.close)
+
+    def _start(self):
+        """Start the writing thread of the current process
+        """
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = Queue.Queue(self.maxsize)
+            self._thread = threading.Thread(target=self._write,
+                                            args=(self._queue,),
+                                            name="dispytch-log-writer")
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _write(self, queue):
+        """Write queued records until a :obj:`None` record is received
+
+        :param queue: Records queue
+        """
+        handler = logging.FileHandler(self.filename, self.mode)
+        try:
+            while True:
+                record = queue.get()
+                if record is None:
+                    break
+                handler.setFormatter(self.formatter)
+                handler.handle(record)
+        finally:
+            handler.close()
+
+    def emit(self, record):
+        """Queue record to be written
+
+        :param record: Log record (:class:`logging.LogRecord`)
+        """
+        if self._pid != os.getpid():
+            self._start()
+
+        # message is rendered now as its arguments may change later
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                self.format(record)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """Flush queued records and stop the writing thread
+        """
+        if self._pid == os.getpid() and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(5)
+        self._pid = None
+        logging.Handler.close(self)
@@ -0,0 +1,467 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Runtime metrics of dispytch
+
+Metrics are kept per process and exposed in Prometheus text exposition
+format by the internal "metrics" dispatch. Workers of the persistent server
+share snapshots of their metrics in a directory (see :func:`share`), so
+that any worker exposes the metrics of all of them: counters and histograms
+are summed, gauges are labeled by worker process id.
+
+    from dispytch import metrics
+
+    FETCHES = metrics.counter('dispytch_things_total', 'Things done',
+                              ('kind',))
+    FETCHES.inc(kind='thing')
+"""
+
+
+import os
+import json
+import time
+import resource
+import threading
+
+
+# Default latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0)
+
+# seconds between snapshots of shared metrics
+SHARE_INTERVAL = 5
+
+_registry = []
+_lock = threading.Lock()
+
+# directory of workers metrics snapshots, None when not shared
+_shared_dir = None
+
+
+def _format_labels(names, values, extra=None):
+    """Format metric labels
+
+    :param tuple names: Labels names
+    :param tuple values: Labels values
+    :param tuple extra: Additional label name and value
+    :return: Formatted labels (:class:`str`)
+    """
+    labels = zip(names, values)
+    if extra is not None:
+        labels.append(extra)
+    if not labels:
+        return ""
+    return "{{{0}}}".format(",".join([
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                                           .replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+        for name, value in labels]))
+
+
+def _format_value(value):
+    """Format metric value
+
+    :param value: Metric value
+    :return: Formatted value (:class:`str`)
+    """
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric(object):
+    """Base metric class
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, description, labels=()):
+        """Initialization method
+
+        :param str name: Metric name
+        :param str description: Metric description
+        :param tuple labels: Labels names
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        """Get values key from labels
+
+        :param dict labels: Labels values
+        :return: Labels values ordered as labels names (:class:`tuple`)
+        """
+        return tuple([labels.get(name, '') for name in self.labels])
+
+    def values(self):
+        """Get a copy of metric values
+
+        :return: Values by labels values (:class:`dict`)
+        """
+        with _lock:
+            return dict(self._values)
+
+    def merge(self, snapshots):
+        """Merge values of workers snapshots
+
+        Values are summed, see :class:`Gauge` for gauges.
+
+        :param dict snapshots: Values by labels values, by worker
+        :return: Labels names and merged values (:class:`tuple`)
+        """
+        merged = {}
+        for values in snapshots.values():
+            for key, value in values.items():
+                merged[key] = merged.get(key, 0) + value
+        return (self.labels, merged)
+
+    def samples(self, labels=None, values=None):
+        """Get metric samples
+
+        :param tuple labels: Labels names, defaults to metric ones
+        :param dict values: Values to render, defaults to metric ones
+        :return: Samples lines (:class:`list`)
+        """
+        labels = self.labels if labels is None else labels
+        values = self.values() if values is None else values
+        return ["{0}{1} {2}".format(self.name,
+                                    _format_labels(labels, key),
+                                    _format_value(value))
+                for key, value in sorted(values.items())]
+
+    def render(self, snapshots=None):
+        """Render metric in text exposition format
+
+        :param dict snapshots: Workers values to merge, see :meth:`merge`
+        :return: Rendered metric (:class:`str`)
+        """
+        lines = ["# HELP {0} {1}".format(self.name, self.description),
+                 "# TYPE {0} {1}".format(self.name, self.kind)]
+        if snapshots is None:
+            lines.extend(self.samples())
+        else:
+            lines.extend(self.samples(*self.merge(snapshots)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Monotonic counter
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Increment counter
+
+        :param amount: Increment value
+        :param labels: Labels values
+        """
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Gauge, either set or computed by a callback when rendered
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=(), callback=None):
+        """Initialization method
+
+        :param str name: Metric name
+        :param str description: Metric description
+        :param tuple labels: Labels names
+        :param callback: Function returning the gauge value
+        """
+        Metric.__init__(self, name, description, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        """Set gauge value
+
+        :param value: Gauge value
+        :param labels: Labels values
+        """
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = value
+
+    def values(self):
+        if self.callback is not None:
+            self.set(self.callback())
+        return Metric.values(self)
+
+    def merge(self, snapshots):
+        """Label values of workers snapshots by worker
+
+        :param dict snapshots: Values by labels values, by worker
+        :return: Labels names and merged values (:class:`tuple`)
+        """
+        merged = {}
+        for worker, values in snapshots.items():
+            for key, value in values.items():
+                merged[key + (worker,)] = value
+        return (self.labels + ('worker',), merged)
+
+
+class Histogram(Metric):
+    """Histogram of observed values
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        """Initialization method
+
+        :param str name: Metric name
+        :param str description: Metric description
+        :param tuple labels: Labels names
+        :param tuple buckets: Buckets upper bounds
+        """
+        Metric.__init__(self, name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        """Observe a value
+
+        :param value: Observed value
+        :param labels: Labels values
+        """
+        key = self._key(labels)
+        with _lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0, 0.0]
+            entry = self._values[key]
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][idx] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def values(self):
+        with _lock:
+            return dict((key, [list(entry[0]), entry[1], entry[2]])
+                        for key, entry in self._values.items())
+
+    def merge(self, snapshots):
+        merged = {}
+        for values in snapshots.values():
+            for key, (buckets, count, total) in values.items():
+                entry = merged.setdefault(key, [[0] * len(buckets), 0, 0.0])
+                entry[0] = [merged_count + bucket_count
+                            for (merged_count, bucket_count)
+                            in zip(entry[0], buckets)]
+                entry[1] += count
+                entry[2] += total
+        return (self.labels, merged)
+
+    def samples(self, labels=None, values=None):
+        labels = self.labels if labels is None else labels
+        values = self.values() if values is None else values
+        lines = []
+        for key, (buckets, count, total) in sorted(values.items()):
+            for bound, bucket_count in zip(self.buckets, buckets):
+                lines.append("{0}_bucket{1} {2}".format(
+                    self.name,
+                    _format_labels(labels, key,
+                                   ('le', _format_value(bound))),
+                    bucket_count))
+            labels_text = _format_labels(labels, key)
+            lines.append("{0}_count{1} {2}".format(self.name, labels_text,
+                                                   count))
+            lines.append("{0}_sum{1} {2}".format(self.name, labels_text,
+                                                 _format_value(total)))
+        return lines
+
+
+def register(metric):
+    """Register metric to be rendered
+
+    :param metric: Metric to register (:class:`Metric`)
+    :return: Registered metric
+    """
+    with _lock:
+        for known in _registry:
+            if known.name == metric.name:
+                return known
+        _registry.append(metric)
+    return metric
+
+
+def counter(name, description, labels=()):
+    """Get registered counter, register it if needed
+
+    :return: Counter (:class:`Counter`)
+    """
+    return register(Counter(name, description, labels))
+
+
+def gauge(name, description, labels=(), callback=None):
+    """Get registered gauge, register it if needed
+
+    :return: Gauge (:class:`Gauge`)
+    """
+    return register(Gauge(name, description, labels, callback))
+
+
+def histogram(name, description, labels=(), buckets=DEFAULT_BUCKETS):
+    """Get registered histogram, register it if needed
+
+    :return: Histogram (:class:`Histogram`)
+    """
+    return register(Histogram(name, description, labels, buckets))
+
+
+def render():
+    """Render every registered metrics in text exposition format
+
+    Shared metrics of every worker are rendered, once the snapshot of this
+    process is updated.
+
+    :return: Rendered metrics (:class:`str`)
+    """
+    with _lock:
+        registered = list(_registry)
+    if _shared_dir is None:
+        return "\n".join([metric.render() for metric in registered]) + "\n"
+
+    _write_snapshot()
+    snapshots = _read_snapshots()
+    return "\n".join([
+        metric.render(dict((worker, snapshot.get(metric.name, {}))
+                           for (worker, snapshot) in snapshots.items()))
+        for metric in registered]) + "\n"
+
+
+def _write_snapshot():
+    """Write metrics snapshot of this process to the shared directory
+    """
+    with _lock:
+        registered = list(_registry)
+    snapshot = dict((metric.name, [[list(key), value] for (key, value)
+                                   in metric.values().items()])
+                    for metric in registered)
+    path = os.path.join(_shared_dir, "{0}.json".format(os.getpid()))
+    with open(path + '.tmp', 'w') as snapshot_file:
+        json.dump(snapshot, snapshot_file)
+    os.rename(path + '.tmp', path)
+
+
+def _read_snapshots():
+    """Read workers metrics snapshots
+
+    :return: Values by labels values, by metric name, by worker
+    :rtype: dict
+    """
+    snapshots = {}
+    for filename in os.listdir(_shared_dir):
+        (worker, ext) = os.path.splitext(filename)
+        if ext != '.json' or not worker.isdigit():
+            continue
+        try:
+            with open(os.path.join(_shared_dir, filename)) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (IOError, ValueError):
+            continue
+        snapshots[worker] = dict(
+            (name, dict((tuple(key), value) for (key, value) in values))
+            for (name, values) in snapshot.items())
+    return snapshots
+
+
+def reset_shared(directory):
+    """Remove workers metrics snapshots of a previous server
+
+    :param str directory: Directory of workers metrics snapshots
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for filename in os.listdir(directory):
+        if filename.endswith(('.json', '.tmp')):
+            os.unlink(os.path.join(directory, filename))
+
+
+def share(directory, interval=SHARE_INTERVAL):
+    """Share metrics of this process with other workers
+
+    A snapshot of the process metrics is written every interval seconds,
+    and when metrics are rendered.
+
+    :param str directory: Directory of workers metrics snapshots
+    :param int interval: Seconds between snapshots
+    """
+    global _shared_dir
+    _shared_dir = directory
+    _write_snapshot()
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                _write_snapshot()
+            except (IOError, OSError):
+                pass
+
+    thread = threading.Thread(target=loop, name="metrics-share")
+    thread.daemon = True
+    thread.start()
+
+
+def _resident_memory():
+    """Get process resident memory
+
+    :return: Resident memory in bytes (:class:`int`)
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+REQUESTS = counter('dispytch_requests_total', 'Handled requests',
+                   ('module', 'method', 'mutator', 'status'))
+REQUEST_DURATION = histogram('dispytch_request_duration_seconds',
+                             'Requests processing duration',
+                             ('module', 'method', 'mutator'))
+RESPONSE_BYTES = counter('dispytch_response_bytes_total',
+                         'Bytes of served responses bodies', ('module',))
+CACHE_REQUESTS = counter('dispytch_cache_requests_total',
+                         'Cache lookups by result (hit or miss)',
+                         ('cache', 'result'))
+RRD_FETCHES = counter('dispytch_rrd_fetches_total', 'Fetched RRD files')
+COALESCED_CALLS = counter('dispytch_coalesced_calls_total',
+                          'Calls served by an identical in-flight call',
+                          ('flight',))
+gauge('dispytch_process_resident_memory_bytes',
+      'Resident memory of the worker process', callback=_resident_memory)
+gauge('dispytch_process_max_resident_memory_bytes',
+      'Peak resident memory of the worker process',
+      callback=lambda: resource.getrusage(
+          resource.RUSAGE_SELF).ru_maxrss * 1024)
+gauge('dispytch_process_id', 'Worker process id', callback=os.getpid)
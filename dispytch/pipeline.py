@@ -0,0 +1,238 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+"""Mutators pipelines
+
+A mutator chain is a list of stages separated by "|", each stage being a
+mutator full name optionally followed by options::
+
+    munin.downsample(points=400)|munin.highcharts
+
+Stages are resolved in mutators modules as:
+    <module>.transform_<name>   streaming stage, series are passed through
+                                as an iterator and yielded one by one
+    <module>.mutate_to_<name>   final stage, mutating the whole response
+
+Streaming stages options are typed after the stage function defaults.
+Streaming stages yield new series instead of modifying the ones they are
+passed.
+
+Final mutators having a "content_type" attribute export the response in
+another format than JSON, as an iterable of chunks streamed to the client.
+As their exports may be produced several times from the same response,
+they must not modify it.
+"""
+
+
+import re
+import inspect
+import logging
+
+
+_log = logging.getLogger("dispytch.pipeline")
+
+_STAGE_RE = re.compile(r"^\s*([\w-]+)\.(\w+)\s*(?:\((.*)\))?\s*$")
+_BOOLEANS = {'yes': True, 'true': True, '1': True,
+             'no': False, 'false': False, '0': False}
+
+
+class MutatorError(Exception):
+    """Custom exception to handle mutator errors
+    """
+
+
+def _coerce(stage, name, value, default):
+    """Convert option value to the type of its default value
+
+    :param str stage: Stage name
+    :param str name: Option name
+    :param str value: Option value
+    :param default: Option default value
+    :return: Converted value
+    """
+    try:
+        if isinstance(default, bool):
+            return _BOOLEANS[value.lower()]
+        if isinstance(default, (int, long)):
+            return int(value)
+        if isinstance(default, float):
+            return float(value)
+    except (KeyError, ValueError):
+        raise MutatorError("invalid value for {0} option {1}: {2}".format(
+            stage, name, value))
+    return value
+
+
+def parse_options(options):
+    """Parse stage options
+
+    :param str options: Options as "name=value, name=value"
+    :return: Options (:class:`dict`)
+    """
+    parsed = {}
+    if not options or not options.strip():
+        return parsed
+    for option in options.split(','):
+        (name, sep, value) = option.partition('=')
+        if not sep or not name.strip():
+            raise MutatorError("invalid mutator option: {0}".format(option))
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+
+class Pipeline(object):
+    """Compiled mutators pipeline
+    """
+
+    def __init__(self, chain, stages, mutator=None, mutator_options=None):
+        """Initialization method
+
+        :param str chain: Mutator chain
+        :param list stages: Streaming stages as (function, options)
+        :param mutator: Final mutator function, if any
+        :param dict mutator_options: Final mutator options from the chain
+        """
+        self.chain = chain
+        self.stages = stages
+        self.mutator = mutator
+        self.mutator_options = mutator_options
+
+    @property
+    def content_type(self):
+        """Content type of responses exported by the final mutator
+
+        :return: Content type or :obj:`None` for JSON responses
+        """
+        return getattr(self.mutator, 'content_type', None)
+
+    def _stream(self, data):
+        """Pass series of a module response through streaming stages
+
+        :param data: Module response data
+        :return: Transformed response data
+        """
+        if isinstance(data, dict):
+            return dict((key, self._stream(value))
+                        for (key, value) in data.items())
+        if isinstance(data, list):
+            series = iter(data)
+            for (function, options) in self.stages:
+                series = function(series, **options)
+            return list(series)
+        return data
+
+    def __call__(self, module_name, info, data, options=None):
+        """Run pipeline on a module response
+
+        :param str module_name: Module that built the response
+        :param dict info: Module response infos
+        :param data: Module response data
+        :param options: Final mutator options, overridden by chain options
+        :return: Mutated response data
+        """
+        if self.stages:
+            data = self._stream(data)
+        if self.mutator is None:
+            return data
+
+        if self.mutator_options is not None:
+            options = self.mutator_options
+        if 'options' in inspect.getargspec(self.mutator).args:
+            return self.mutator(module_name, info, data, options=options)
+        return self.mutator(module_name, info, data)
+
+
+def _compile_stage(stage, function, options):
+    """Bind typed options to a streaming stage
+
+    :param str stage: Stage name
+    :param function: Stage function
+    :param dict options: Options from the chain
+    :return: Stage function and typed options (:class:`tuple`)
+    """
+    spec = inspect.getargspec(function)
+    defaults = dict(zip(spec.args[-len(spec.defaults or ()):],
+                        spec.defaults or ()))
+    typed = {}
+    for (name, value) in options.items():
+        if name not in defaults:
+            raise MutatorError("unknown option for {0}: {1}".format(stage,
+                                                                  name))
+        typed[name] = _coerce(stage, name, value, defaults[name])
+    return (function, typed)
+
+
+def stage_names(chain):
+    """Get mutators full names of a mutator chain, without their options
+
+    :param str chain: Mutator chain
+    :return: Mutators full names (:class:`list`)
+
+    :raise: MutatorError for invalid chains
+    """
+    names = []
+    for stage in chain.split('|'):
+        match = _STAGE_RE.match(stage)
+        if not match:
+            raise MutatorError("Invalid mutator name: {0}".format(stage))
+        names.append("{0}.{1}".format(*match.groups()[:2]))
+    return names
+
+
+def compile_pipeline(chain, load_module):
+    """Compile mutator chain
+
+    :param str chain: Mutator chain
+    :param load_module: Function loading a mutators module by name
+    :return: Compiled pipeline (:class:`Pipeline`)
+
+    :raise: MutatorError for invalid chains,
+            ImportError or AttributeError for unknown mutators
+    """
+    stages = []
+    mutator = None
+    mutator_options = None
+    names = chain.split('|')
+    for (idx, stage) in enumerate(names):
+        match = _STAGE_RE.match(stage)
+        if not match:
+            raise MutatorError("Invalid mutator name: {0}".format(stage))
+        (module_name, name, options) = match.groups()
+        options = parse_options(options)
+        module = load_module(module_name)
+        fullname = "{0}.{1}".format(module_name, name)
+
+        transform = getattr(module, "transform_{0}".format(name), None)
+        if transform is not None:
+            stages.append(_compile_stage(fullname, transform, options))
+            continue
+
+        if idx != len(names) - 1:
+            raise MutatorError("mutator {0} must end the chain".format(
+                fullname))
+        mutator = getattr(module, "mutate_to_{0}".format(name))
+        mutator_options = options or None
+
+    _log.debug("compiled mutators pipeline: %s", chain)
+    return Pipeline(chain, stages, mutator, mutator_options)
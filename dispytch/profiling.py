@@ -0,0 +1,194 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Requests timings and profiling hooks
+
+Requests are split in timed phases. Timings of the request being processed
+are available from anywhere (ie. modules) through :func:`timed`:
+
+    from dispytch import profiling
+
+    with profiling.timed('munin.fetch'):
+        fetch_something()
+
+Phases with the same name are accumulated.
+"""
+
+
+import os
+import time
+import timeit
+import cProfile
+import threading
+import contextlib
+
+
+_local = threading.local()
+
+
+class Timings(object):
+    """Timed phases of a request
+    """
+
+    def __init__(self):
+        """Initialization method
+        """
+        self.phases = []
+        self._index = {}
+
+    def add(self, name, seconds):
+        """Account time spent in a phase
+
+        :param str name: Phase name
+        :param float seconds: Time spent in the phase
+        """
+        if name in self._index:
+            self.phases[self._index[name]][1] += seconds
+        else:
+            self._index[name] = len(self.phases)
+            self.phases.append([name, seconds])
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a phase of the request
+
+        :param str name: Phase name
+        """
+        start = timeit.default_timer()
+        try:
+            yield
+        finally:
+            self.add(name, timeit.default_timer() - start)
+
+    def as_dict(self):
+        """Get phases durations
+
+        :return: Phases durations in milliseconds (:class:`dict`)
+        """
+        return dict((name, round(seconds * 1000, 3))
+                    for name, seconds in self.phases)
+
+    def server_timing(self):
+        """Format phases durations as Server-Timing header value
+
+        :return: Server-Timing header value (:class:`str`)
+        """
+        return ", ".join(["{0};dur={1:.3f}".format(name, seconds * 1000)
+                          for name, seconds in self.phases])
+
+
+def start_request():
+    """Start timing a new request in the current thread
+
+    :return: Request timings (:class:`Timings`)
+    """
+    _local.timings = Timings()
+    return _local.timings
+
+
+def end_request():
+    """Stop timing the request of the current thread
+
+    :return: Request timings (:class:`Timings`) or :obj:`None`
+    """
+    timings = getattr(_local, 'timings', None)
+    _local.timings = None
+    return timings
+
+
+def current():
+    """Get timings of the request of the current thread
+
+    :return: Request timings (:class:`Timings`) or :obj:`None`
+    """
+    return getattr(_local, 'timings', None)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Time a phase of the current request, if any
+
+    :param str name: Phase name
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        yield
+    else:
+        with timings.phase(name):
+            yield
+
+
+class SamplingProfiler(object):
+    """Profile one request every N requests with cProfile
+
+    Profiles are dumped in the configured directory and can be read using
+    the :mod:`pstats` module.
+    """
+
+    def __init__(self, every, directory):
+        """Initialization method
+
+        :param int every: Profile one request every ``every`` requests
+        :param str directory: Directory receiving dumped profiles
+        """
+        self.every = every
+        self.directory = directory
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start profiling the current request if it is sampled
+
+        :return: Running profile or :obj:`None`
+        """
+        if not self.every:
+            return None
+
+        with self._lock:
+            self._count += 1
+            if self._count % self.every:
+                return None
+
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, label=''):
+        """Stop profiling and dump the profile
+
+        :param profile: Running profile returned by :meth:`start`
+        :param str label: Label appended to the profile file name
+        :return: Dumped profile path (:class:`str`) or :obj:`None`
+        """
+        if profile is None:
+            return None
+
+        profile.disable()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        label = "".join([char if char.isalnum() else '_' for char in label])
+        path = os.path.join(self.directory, "{0:.6f}-{1}-{2}.prof".format(
+            time.time(), os.getpid(), label[:64]))
+        profile.dump_stats(path)
+        return path
@@ -0,0 +1,202 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Requests routing
+
+Dispatches are compiled once in a tree of path segments, so the most
+precise dispatch of a request is found in a single walk of its path.
+
+Modules may also declare path templates, matched against the rest of the
+path to extract named arguments in the same walk. Templates are made of
+literal segments and placeholders:
+
+    <name>          Any non-empty segment, passed as "name" argument
+    <name:a|b>      One of the listed segments, passed as "name" argument
+
+Example:
+    <method:by-id|by-ip>/<target>/<datatype>/<cf>/<start>/<stop>
+"""
+
+
+class RoutingError(Exception):
+    """Custom exception to handle invalid routes
+    """
+
+
+class _Node(object):
+    """Routing tree node
+    """
+
+    __slots__ = ('children', 'captures', 'wildcard', 'target', 'templates')
+
+    def __init__(self):
+        self.children = {}
+        # segment -> captured argument name for constrained placeholders
+        self.captures = {}
+        # (argument name, child node) for unconstrained placeholder
+        self.wildcard = None
+        self.target = None
+        self.templates = None
+
+
+def _split(path):
+    """Split path in segments
+
+    :param str path: Document path
+    :return: Path segments (:class:`list`)
+    """
+    return path.split('/')
+
+
+class Router(object):
+    """Compiled routing of document paths to dispatch targets
+    """
+
+    def __init__(self):
+        """Initialization method
+        """
+        self._root = _Node()
+
+    def add(self, dispatch, target, templates=()):
+        """Add a dispatch route
+
+        :param str dispatch: Dispatch path, without trailing "/"
+        :param str target: Dispatch target
+        :param list templates: Path templates of the dispatch target
+        """
+        node = self._root
+        for segment in _split(dispatch):
+            node = node.children.setdefault(segment, _Node())
+        node.target = (dispatch, target)
+
+        node.templates = None
+        for template in templates:
+            node.templates = node.templates or _Node()
+            self._add_template(node.templates,
+                               template.strip('/').split('/'), template)
+
+    def _add_template(self, node, segments, template):
+        """Compile remaining segments of a path template
+
+        :param node: Current templates tree node (:class:`_Node`)
+        :param list segments: Remaining template segments
+        :param str template: Compiled path template
+        """
+        if not segments:
+            node.target = template
+            return
+
+        (segment, remaining) = (segments[0], segments[1:])
+        if not (segment.startswith('<') and segment.endswith('>')):
+            child = node.children.setdefault(segment, _Node())
+            self._add_template(child, remaining, template)
+            return
+
+        name = segment[1:-1]
+        if ':' in name:
+            (name, choices) = name.split(':', 1)
+            for choice in choices.split('|'):
+                if node.captures.setdefault(choice, name) != name:
+                    raise RoutingError("conflicting placeholders in template:"
+                                       " {0}".format(template))
+                child = node.children.setdefault(choice, _Node())
+                self._add_template(child, remaining, template)
+            return
+
+        if node.wildcard is None:
+            node.wildcard = (name, _Node())
+        elif node.wildcard[0] != name:
+            raise RoutingError("conflicting placeholders in template: "
+                               "{0}".format(template))
+        self._add_template(node.wildcard[1], remaining, template)
+
+    def _match_template(self, node, segments, index, arguments):
+        """Match remaining segments against compiled templates
+
+        :param node: Current templates tree node (:class:`_Node`)
+        :param list segments: Path segments
+        :param int index: Index of the segment to match
+        :param dict arguments: Named arguments extracted so far
+
+        :return: Named arguments (:class:`dict`) or :obj:`None`
+        """
+        if index == len(segments):
+            return arguments if node.target is not None else None
+
+        segment = segments[index]
+        child = node.children.get(segment)
+        if child is not None:
+            name = node.captures.get(segment)
+            if name is not None:
+                arguments[name] = segment
+            matched = self._match_template(child, segments, index + 1,
+                                           arguments)
+            if matched is not None:
+                return matched
+            arguments.pop(name, None)
+
+        if node.wildcard is not None and segment:
+            (name, child) = node.wildcard
+            arguments[name] = segment
+            matched = self._match_template(child, segments, index + 1,
+                                           arguments)
+            if matched is not None:
+                return matched
+            arguments.pop(name, None)
+
+        return None
+
+    def route(self, docpath):
+        """Route document path to the most precise dispatch
+
+        Remaining path segments are returned as positional arguments, unless
+        they match one of the dispatch templates.
+
+        :param str docpath: Document path, without url-encoded arguments
+
+        :return: Dispatch, target, positional and named arguments or
+                 :obj:`None` if no dispatch matches
+        :rtype: tuple
+        """
+        segments = _split(docpath)
+        node = self._root
+        selected = None
+        depth = 0
+        for index, segment in enumerate(segments):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.target is not None:
+                (selected, depth) = (node, index + 1)
+
+        if selected is None:
+            return None
+
+        remaining = segments[depth:]
+        (dispatch, target) = selected.target
+        if selected.templates is not None:
+            arguments = self._match_template(selected.templates, remaining,
+                                             0, {})
+            if arguments is not None:
+                return (dispatch, target, [], arguments)
+        return (dispatch, target, remaining, {})
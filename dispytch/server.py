@@ -0,0 +1,295 @@
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Persistent dispytch server
+
+Requests are processed by long-running worker processes instead of one
+process per CGI request, so configurations, caches and metrics are kept
+between requests. The WSGI :func:`application` may be served by any WSGI
+server, or by the bundled threaded server using :func:`serve`.
+"""
+
+
+import os
+import socket
+import signal
+import logging
+import urllib
+import SocketServer
+from wsgiref import simple_server
+
+import dispytch
+from dispytch import config
+from dispytch import metrics
+
+
+_log = logging.getLogger("dispytch.server")
+
+# unread request bodies up to this size are discarded to keep connections
+# alive, larger ones end their connection
+DRAIN_LIMIT = 65536
+
+
+def request_uri(environ):
+    """Rebuild request URI from WSGI environment
+
+    :param dict environ: WSGI environment
+    :return: Request URI (:class:`str`)
+    """
+    if environ.get('REQUEST_URI'):
+        return environ['REQUEST_URI']
+
+    uri = urllib.quote(environ.get('SCRIPT_NAME', '') +
+                       environ.get('PATH_INFO', ''), safe="/;:@&=+$,!~*'()")
+    if environ.get('QUERY_STRING'):
+        uri = "{0}?{1}".format(uri, environ['QUERY_STRING'])
+    return uri
+
+
+def application(environ, start_response):
+    """WSGI application processing dispytch requests
+
+    :param dict environ: WSGI environment
+    :param start_response: WSGI response starter
+    :return: Response body chunks (:class:`list` or iterable)
+    """
+    (headers, body) = dispytch.process_request(
+        environ.get('REQUEST_METHOD', 'GET'), request_uri(environ),
+        environ, environ.get('wsgi.input'))
+    # rejected requests carry their status as CGI "Status" header
+    status = '200 OK'
+    for (name, value) in headers:
+        if name == 'Status':
+            status = value
+    headers = [header for header in headers if header[0] != 'Status']
+    if not isinstance(body, basestring):
+        # streamed responses are sent as they are produced
+        start_response(status, headers)
+        return body
+    headers.append(('Content-Length', str(len(body))))
+    start_response(status, headers)
+    return [body]
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                          simple_server.WSGIServer):
+    """WSGI server handling each request in its own thread
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class RequestInput(object):
+    """Request body stream bounded by the request Content-Length
+
+    Keeps track of the body part left unread by the application, so that
+    it is not parsed as the next request of the connection.
+    """
+
+    def __init__(self, stream, length):
+        """Initialization method
+
+        :param stream: Connection stream
+        :param int length: Request body length
+        """
+        self._stream = stream
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._stream.read(size) if size else ''
+        self.remaining = self.remaining - len(data) if data else 0
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._stream.readline(size) if size else ''
+        self.remaining = self.remaining - len(data) if data else 0
+        return data
+
+    def readlines(self, hint=None):
+        return list(iter(self.readline, ''))
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def drain(self, limit):
+        """Discard the unread body
+
+        :param int limit: Maximum size to discard
+        :return: True if the whole body was read (:class:`bool`)
+        """
+        while 0 < self.remaining <= limit:
+            try:
+                if not self.read(min(self.remaining, 65536)):
+                    return False
+            except socket.error:
+                return False
+        return self.remaining == 0
+
+
+class ServerHandler(simple_server.ServerHandler):
+    """WSGI handler answering with HTTP/1.1
+    """
+
+    http_version = "1.1"
+
+    def cleanup_headers(self):
+        simple_server.ServerHandler.cleanup_headers(self)
+        # responses of unknown length end with the connection, as those of
+        # requests whose body is too large to be discarded
+        if ('Content-Length' not in self.headers or
+                self.stdin.remaining > DRAIN_LIMIT):
+            self.headers['Connection'] = 'close'
+            self.request_handler.close_connection = 1
+
+
+class RequestHandler(simple_server.WSGIRequestHandler):
+    """WSGI request handler logging through dispytch logger
+
+    HTTP/1.1 connections are kept alive between requests, so that clients
+    such as federation front instances may reuse them.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # idle keep-alive connections timeout
+    timeout = 30
+
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        if len(self.raw_requestline) > 65536:
+            self.send_error(414)
+            self.close_connection = 1
+            return
+        if not self.parse_request():
+            return
+        if self.request_version != "HTTP/1.1":
+            self.close_connection = 1
+        # chunked bodies are not supported, their end is unknown
+        if self.headers.get('Transfer-Encoding'):
+            self.close_connection = 1
+
+        try:
+            length = max(0, int(self.headers.get('Content-Length') or 0))
+        except ValueError:
+            self.send_error(400)
+            self.close_connection = 1
+            return
+        body = RequestInput(self.rfile, length)
+        handler = ServerHandler(body, self.wfile, self.get_stderr(),
+                                self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        self.wfile.flush()
+        # the next request starts after this one body
+        if not self.close_connection and not body.drain(DRAIN_LIMIT):
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        _log.info("%s - %s", self.client_address[0], format % args)
+
+
+def parse_address(address):
+    """Parse listening address
+
+    :param str address: Address as "host:port" or "port"
+    :return: Host and port (:class:`tuple`)
+    """
+    if ':' in address:
+        (host, port) = address.rsplit(':', 1)
+        return (host, int(port))
+    return ('127.0.0.1', int(address))
+
+
+def serve(address=None, workers=None):
+    """Serve dispytch requests
+
+    The listening socket is bound once and shared by ``workers`` forked
+    processes, each handling requests in threads.
+
+    :param str address: Listening address, defaults to configured "listen"
+    :param int workers: Number of worker processes, defaults to configured
+                        "workers"
+    """
+    cfg = config.get_section('dispytch')
+    address = parse_address(address or cfg.get('listen', '127.0.0.1:8080'))
+    workers = int(workers or cfg.get('workers', 1))
+
+    # workers inherit modules configurations and indexes
+    dispytch.warm_up()
+
+    httpd = simple_server.make_server(address[0], address[1], application,
+                                      server_class=ThreadingWSGIServer,
+                                      handler_class=RequestHandler)
+    _log.info("serving on %s:%s with %s workers",
+              address[0], address[1], workers)
+    # jobs workers threads are started by each worker process
+    dispytch.enable_jobs()
+
+    # modules periodic tasks are run by the main process, once workers
+    # are forked
+    if workers <= 1:
+        dispytch.start_periodic_tasks()
+        httpd.serve_forever()
+        return
+
+    # workers share their metrics, exposed by any of them
+    metrics.reset_shared(config.metrics_dir)
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                metrics.share(config.metrics_dir)
+                httpd.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    metrics.share(config.metrics_dir)
+    dispytch.start_periodic_tasks()
+    try:
+        for pid in children:
+            os.waitpid(pid, 0)
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
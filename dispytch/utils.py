@@ -21,6 +21,30 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program; if not, see <http://www.gnu.org/licenses/>.
 
+import os
+import re
+import sys
+import json
+import array
+import Queue
+import struct
+import threading
+import collections
+
+from dispytch import metrics
+
+
+# byte range outside of the requested resource
+UNSATISFIABLE_RANGE = object()
+
+# series frames: magic, label length, start and step in seconds, values count
+# followed by the label and values, as little-endian doubles
+FRAME_HEADER = struct.Struct('<4sHqqI')
+FRAME_MAGIC = 'DSF1'
+
+# data points encoded at once by packed points JSON encoding
+_JSON_POINTS_CHUNK = 4096
+
 
 def merge_dict(dict_a, dict_b):
     """Utility function to recusively merge two dictionnaries
@@ -41,3 +65,360 @@ def merge_dict(dict_a, dict_b):
             dict_a[key] = val
 
     return dict_a
+
+
+def parse_byte_range(header, size):
+    """Parse HTTP "Range" header of a single byte range
+
+    :param str header: "Range" header, ie. "bytes=0-499", "bytes=500-" or
+                       "bytes=-500"
+    :param int size: Size of the requested resource
+
+    :return: First and last bytes positions, :data:`UNSATISFIABLE_RANGE` or
+             :obj:`None` if the header is absent or unsupported
+    :rtype: tuple
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    (first, _, last) = header[len('bytes='):].strip().partition('-')
+    try:
+        if not first:
+            # suffix range, last bytes of the resource
+            length = int(last)
+            if length <= 0 or size == 0:
+                return UNSATISFIABLE_RANGE
+            return (max(0, size - length), size - 1)
+        (first, last) = (int(first), int(last) if last else size - 1)
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        return UNSATISFIABLE_RANGE
+    return (first, min(last, size - 1))
+
+
+class PackedPoints(object):
+    """Serie data points backed by a buffer of packed floats
+
+    Points are regularly spaced from start, unknown values being NaN. Points
+    are encoded to JSON or frames directly from the buffer. Iterating yields
+    known points as (timestamp in ms, value), as lists of points do.
+    """
+
+    __slots__ = ('start', 'step', 'values')
+
+    def __init__(self, start, step, values):
+        """Initialization method
+
+        :param int start: Timestamp of the first value, in seconds
+        :param int step: Seconds between values
+        :param values: Values (:class:`array.array` of doubles)
+        """
+        self.start = start
+        self.step = step
+        self.values = values
+
+    def __iter__(self):
+        (start, step) = (self.start, self.step)
+        for (idx, val) in enumerate(self.values):
+            if val == val:
+                yield ((start + step * idx) * 1000, val)
+
+    def __len__(self):
+        return sum(1 for val in self.values if val == val)
+
+    def json(self):
+        """Encode known points as a JSON array of [timestamp, value]
+
+        :return: JSON text (:class:`str`)
+        """
+        (start, step) = (self.start * 1000, self.step * 1000)
+        chunks = []
+        for first in range(0, len(self.values), _JSON_POINTS_CHUNK):
+            window = self.values[first:first + _JSON_POINTS_CHUNK]
+            chunk = ", ".join(["[%d, %r]" % (start + step * (first + idx),
+                                             val)
+                               for (idx, val) in enumerate(window)
+                               if val == val])
+            if chunk:
+                chunks.append(chunk)
+        text = "[" + ", ".join(chunks) + "]"
+        if "inf" in text:
+            text = text.replace("inf", "Infinity")
+        return text
+
+    def frame(self, label):
+        """Encode values as a frame, see :func:`series_frames`
+
+        :param str label: Frame label
+        :return: Frame (:class:`str`)
+        """
+        values = self.values
+        if sys.byteorder != 'little':
+            values = array.array('d', values)
+            values.byteswap()
+        return (FRAME_HEADER.pack(FRAME_MAGIC, len(label), self.start,
+                                  self.step, len(self.values)) +
+                label + values.tostring())
+
+
+def dumps_json(data, indent=None):
+    """Serialize data to JSON, encoding packed points from their buffer
+
+    :param data: Data to serialize
+    :param int indent: Indentation of JSON arrays and objects
+    :return: JSON text (:class:`str`)
+    """
+    packed = []
+    marker = "\x00packed:{0}:".format(id(packed))
+
+    def default(obj):
+        if isinstance(obj, PackedPoints):
+            packed.append(obj)
+            return "{0}{1}".format(marker, len(packed) - 1)
+        raise TypeError("{0!r} is not JSON serializable".format(obj))
+
+    text = json.dumps(data, indent=indent, default=default)
+    if not packed:
+        return text
+    # markers are JSON strings, replaced by their packed points JSON
+    escaped = re.escape(json.dumps(marker)[1:-1])
+    parts = re.split(r'"{0}(\d+)"'.format(escaped), text)
+    for idx in range(1, len(parts), 2):
+        parts[idx] = packed[int(parts[idx])].json()
+    return "".join(parts)
+
+
+def series_frames(data, path=()):
+    """Encode series of a result as binary frames
+
+    Series are dicts with "name" and "data" fields, found in nested dicts
+    of the result. Each frame is labeled by the keys leading to its serie
+    and the serie name, joined by "/". Packed points are sent as is, NaN for
+    unknown values. Other series have a null step, their values being
+    interleaved timestamps (in ms) and values.
+
+    :param data: Module result
+    :param tuple path: Keys leading to data
+    :return: Frames (:class:`generator` of :class:`str`)
+    """
+    if isinstance(data, dict):
+        for key in sorted(data):
+            for frame in series_frames(data[key], path + (key,)):
+                yield frame
+    elif isinstance(data, list):
+        for serie in data:
+            if not isinstance(serie, dict) or 'data' not in serie:
+                continue
+            label = "/".join(path + (serie.get('name', ''),))
+            if isinstance(label, unicode):
+                label = label.encode('utf8')
+            points = serie['data']
+            if isinstance(points, PackedPoints):
+                yield points.frame(label)
+                continue
+            values = array.array('d', [float(field) for point in points
+                                       for field in point[:2]])
+            if sys.byteorder != 'little':
+                values.byteswap()
+            yield (FRAME_HEADER.pack(FRAME_MAGIC, len(label), 0, 0,
+                                     len(values) // 2) +
+                   label + values.tostring())
+
+
+class WorkerPool(object):
+    """Pool of threads applying functions to items concurrently
+
+    Threads are started on first use, once per process, and reused by the
+    following calls. The calling thread works too, so calls keep making
+    progress while the pool threads are busy with other calls.
+    """
+
+    def __init__(self, size):
+        """Initialize pool
+
+        :param int size: Number of threads of the pool
+        """
+        self.size = max(1, int(size))
+        self._lock = threading.Lock()
+        self._pid = None
+        self._calls = None
+
+    def _start(self):
+        """Start pool threads, once per process"""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._calls = Queue.Queue()
+            for _ in range(self.size):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+            self._pid = os.getpid()
+
+    def _work(self):
+        """Pool thread main loop, helping with queued calls"""
+        while True:
+            work = self._calls.get()
+            work()
+
+    def map(self, function, items):
+        """Apply function to items concurrently
+
+        Results are returned in items order, exceptions raised by the
+        function are returned in place of results.
+
+        :param function: Function to apply
+        :param list items: Function arguments
+        :return: Results (:class:`list`)
+        """
+        results = [None] * len(items)
+        pending = collections.deque(enumerate(items))
+        done = threading.Condition(threading.Lock())
+        state = {'done': 0}
+
+        def work():
+            while True:
+                try:
+                    (idx, item) = pending.popleft()
+                except IndexError:
+                    return
+                try:
+                    results[idx] = function(item)
+                except Exception as exc:
+                    results[idx] = exc
+                with done:
+                    state['done'] += 1
+                    if state['done'] == len(items):
+                        done.notify_all()
+
+        if len(items) > 1:
+            self._start()
+            for _ in range(min(self.size, len(items) - 1)):
+                self._calls.put(work)
+        work()
+        with done:
+            while state['done'] < len(items):
+                done.wait()
+        return results
+
+
+class LRUCache(object):
+    """Simple thread-safe LRU cache
+
+    Least recently used entries are evicted once the cache holds more than
+    ``size`` entries. Lookups of named caches are accounted in metrics.
+    """
+
+    def __init__(self, size, name=None):
+        """Initialization method
+
+        :param int size: Maximum number of cached entries
+        :param str name: Cache name used in metrics
+        """
+        self.size = size
+        self.name = name
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Get cached entry and mark it as recently used
+
+        :param key: Entry key
+        :param default: Value returned if entry is not cached
+        :return: Cached entry value
+        """
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                value = default
+            else:
+                self._entries[key] = value
+
+        if self.name is not None:
+            metrics.CACHE_REQUESTS.inc(
+                cache=self.name, result='miss' if value is default else 'hit')
+        return value
+
+    def set(self, key, value):
+        """Cache entry, evicting least recently used ones if needed
+
+        :param key: Entry key
+        :param value: Entry value
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached entries
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class _Call(object):
+    """In-flight call of a :class:`SingleFlight`
+    """
+
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesce identical concurrent calls
+
+    While a call is in flight, identical calls (same key) wait for it and
+    share its result, or its exception. Coalesced calls of named flights are
+    accounted in metrics.
+    """
+
+    def __init__(self, name=None):
+        """Initialization method
+
+        :param str name: Flight name used in metrics
+        """
+        self.name = name
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Call function, unless an identical call is in flight
+
+        :param key: Call key, identical calls share the same key
+        :param func: Function to call
+        :return: Function result, shared by coalesced calls
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if self.name is not None:
+                metrics.COALESCED_CALLS.inc(flight=self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
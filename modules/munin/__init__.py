@@ -33,32 +33,43 @@ Usage:
       /munin/list[/mutators]
       /munin/by-ip/<ip>/<datatype>/<cf>/<start>/<stop>[/<template>]
       /munin/by-id/<id>/<datatype>/<cf>/<start>/<stop>[/<template>]
+      /munin/aggregate/<ids>/<datatype>/<cf>/<start>/<stop>[?function=sum]
+      /munin/all/<id>/<cf>/<start>/<stop>
     Using url-encoded request:
       /munin/list[?ip=<ip>]
       /munin/by-ip?ip=<ip>&datatype=<datatype>&...
+      /munin/fetch?target=<id>&datatype=<datatype>&...[&by=ip]
 
 Known Fields:
     ip              IP address of the target used by Munin
-    id              Munin entry name in configuration
+    id              Munin entry name in configuration, multiple entries may be
+                    requested by id, separated by commas
     datatype        Munin datatype as shown in RRDs names
     cf              RRD consolidation function to use
     start           Start time as supported by RRD library
     stop            Stop time as supported by RRD library
     template        Template to use for returned datas structuration
+    stitch          Use the finest archive available for each part of the
+                    window ("yes"), series then list their segments steps
+    resolution      Requested step in seconds, served from rollups
+    function        Aggregation function of "aggregate" requests: sum, avg
+                    (default), min or max. Aggregated nodes are given by
+                    names or shell-style patterns, separated by commas
 
 Exemple:
     /munin/by-ip/1.1.1.1/cpu/AVERAGE/now-2h/now
     /munin/by-id/munin;config;id/processes/AVERAGE/1383260400/138585240
+    /munin/all/munin;config;id/AVERAGE/now-1d/now
 """
 
 
 import os
 import logging
 
-from . import infos, requests
+from . import federation, infos, prefetch, requests, rollups, rrd_utils
 
 
-_log = logging.getLogger("dispytch")
+_log = logging.getLogger("dispytch.munin")
 
 
 def selfcheck(config):
@@ -85,34 +96,121 @@ def configure(config):
 
     :param dict config: Configuration informations
     """
-    _log.debug("module config: {0}".format(config))
+    _log.debug("module config: %s", config)
     infos.init_config(config.get('config'),
                       config.get('datadir'),
-                      config.get('multipollers'))
+                      config.get('multipollers'),
+                      config.get('reload_interval'),
+                      config.get('graphs_cache_size'))
+    rrd_utils.configure(config.get('rrd_reader'), config.get('daemon'),
+                        config.get('cache_ttl'), config.get('fetch_workers'))
+    rollups.configure(config.get('rollups'), config.get('rollups_dir'),
+                      config.get('rollups_interval'))
+    prefetch.configure(config.get('prefetch_top'), config.get('prefetch_dir'),
+                       config.get('prefetch_interval'),
+                       config.get('prefetch_delay'),
+                       config.get('cache_ttl'))
+    federation.configure(config.get('peers'),
+                         config.get('peers_timeout'),
+                         config.get('reload_interval'))
     try:
         assert infos.config is not None
     except AssertionError:
         raise RuntimeError("unconfigured module")
 
 
-def handle_request(*args, **kwargs):
-    """Main module entry point
-    """
-
-    _log.debug("handling new request")
-    _log.debug("args: {0}".format(args))
-    _log.debug("kwargs: {0}".format(kwargs))
+def _arguments(args, kwargs):
+    """Aggregate positionnal and named request arguments
 
+    :param tuple args: Positionnal arguments
+    :param dict kwargs: Named arguments
+    :return: Request arguments (:class:`dict`)
+    """
     # Converting positionnal args to kwargs
     args = list(args)
     fields = ["method", "target", "datatype", "cf", "start", "stop"]
+    if args[:1] == ["all"]:
+        # node-wide requests fetch every datatype of the node
+        fields.remove("datatype")
     positionnal_args = dict(zip(fields[:len(args)], args))
 
     # arguments agreggation
-    arguments = kwargs
+    arguments = dict(kwargs)
     arguments.update(positionnal_args)
+    return arguments
+
+
+def estimate_cost(*args, **kwargs):
+    """Estimate request cost, in RRD data points to read
+    """
+    return requests.estimate_cost(_arguments(args, kwargs))
+
+
+def methods():
+    """Known methods of the module
+
+    :return: Methods names (:class:`list`)
+    """
+    return sorted(requests.KNOWN_METHODS)
+
+
+def periodic_tasks():
+    """Periodic tasks of the module, as (name, interval, function, offset)
+
+    :return: Periodic tasks (:class:`list`)
+    """
+    tasks = []
+    if rollups.ROLLUPS:
+        tasks.append(('munin.rollups', rollups.INTERVAL, rollups.build, 0))
+    if prefetch.enabled():
+        # popular requests are fetched again once pollers updated RRD files
+        tasks.append(('munin.prefetch', prefetch.INTERVAL, prefetch.warm,
+                      prefetch.DELAY))
+    return tasks
+
+
+def warm_up():
+    """Load Munin configuration, RRD directories indexes and peers nodes
+    lists before serving
+    """
+    infos.config.load()
+    federation.warm_up()
+    directories = set()
+    for name in infos.config.nodes:
+        node = infos.config.get_node(name)
+        directories.add(os.path.join(node.datadir,
+                                     "/".join(name.split(';')[:-1])))
+    for directory in sorted(directories):
+        try:
+            rrd_utils.index_rrd_directory(directory)
+        except OSError as exc:
+            _log.debug("unable to index %s: %s", directory, exc)
+    _log.info("loaded %d nodes and %d RRD directories",
+              len(infos.config.nodes), len(directories))
+
+
+def split_request(*args, **kwargs):
+    """Split multi-targets request in single target requests, run as jobs
+
+    :return: Positionnal and named arguments of requests (:class:`list`)
+    """
+    arguments = _arguments(args, kwargs)
+    if arguments.get('method') not in ('by-id', 'fetch'):
+        return [(args, kwargs)]
+    return [((), dict(arguments, target=target))
+            for target in arguments.get('target', '').split(',') if target]
+
+
+def handle_request(*args, **kwargs):
+    """Main module entry point
+    """
+
+    _log.debug("handling new request")
+    _log.debug("args: %s", args)
+    _log.debug("kwargs: %s", kwargs)
 
-    _log.debug("arguments: {0}".format(arguments))
+    arguments = _arguments(args, kwargs)
+    _log.debug("arguments: %s", arguments)
 
     # Unknown method will raise exception handled by dispatcher
     return requests.KNOWN_METHODS[arguments['method']](arguments)
@@ -0,0 +1,334 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Munin federation across dispytch instances
+
+A front dispytch instance may serve pollers hosted by other dispytch
+instances (peers). Peers are configured per poller with their munin
+dispatch URL, nodes served by each peer are learnt from its nodes list.
+Nodes lists are refreshed in background threads and shared with other
+dispytch processes through dispytch cache, so requests are not delayed by
+peers listings.
+Sub-requests are sent concurrently to peers over pooled HTTP connections,
+results are merged by the requests handlers.
+"""
+
+
+import json
+import time
+import socket
+import urllib
+import httplib
+import urlparse
+import logging
+import threading
+
+from dispytch import cache
+
+
+_log = logging.getLogger("dispytch.munin.federation")
+
+# maximum number of idle connections kept per peer
+POOL_SIZE = 4
+
+# configured peers, by URL
+peers = {}
+
+# peers nodes lists refresh interval
+_refresh_interval = 30
+
+
+class PeerError(Exception):
+    """Peer request error
+    """
+
+
+class Peer(object):
+    """dispytch instance serving some Munin pollers
+    """
+
+    def __init__(self, url, timeout):
+        """Initialization method
+
+        :param str url: Peer munin dispatch URL
+        :param float timeout: Requests timeout in seconds
+        """
+        parsed = urlparse.urlsplit(url)
+        if parsed.scheme not in ('http', 'https'):
+            raise RuntimeError("invalid peer URL: {0}".format(url))
+        self.url = url
+        self.timeout = timeout
+        self.pollers = []
+        self._https = parsed.scheme == 'https'
+        self._host = parsed.hostname
+        self._port = parsed.port
+        self._path = parsed.path.rstrip('/')
+        self._pool = []
+        self._lock = threading.Lock()
+        self._nodes = frozenset()
+        self._nodes_checked = None
+        self._nodes_lock = threading.Lock()
+
+    @property
+    def name(self):
+        """Peer name, from its pollers
+        """
+        return ",".join(self.pollers) or self.url
+
+    def _connection(self):
+        """Get an idle connection or open a new one
+
+        :return: Connection and reuse flag (:class:`tuple`)
+        """
+        with self._lock:
+            if self._pool:
+                return self._pool.pop(), True
+        if self._https:
+            conn = httplib.HTTPSConnection(self._host, self._port,
+                                           timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self._host, self._port,
+                                          timeout=self.timeout)
+        return conn, False
+
+    def _release(self, conn):
+        """Give a connection back to the pool
+
+        :param conn: Connection (:class:`httplib.HTTPConnection`)
+        """
+        with self._lock:
+            if len(self._pool) < POOL_SIZE:
+                self._pool.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, params):
+        """Send a request to the peer munin dispatch
+
+        A failing pooled connection may have been closed by the peer, the
+        request is then retried once on a new connection.
+
+        :param str method: Munin method
+        :param dict params: Request arguments
+        :return: Response result
+
+        :raise: PeerError
+        """
+        uri = "{0}/{1}?{2}".format(self._path, method,
+                                   urllib.urlencode(params))
+        while True:
+            (conn, reused) = self._connection()
+            try:
+                conn.request('GET', uri)
+                response = conn.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as exc:
+                conn.close()
+                if reused and not isinstance(exc, socket.timeout):
+                    continue
+                raise PeerError("{0}: {1}".format(self.name, exc))
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(conn)
+            break
+
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            raise PeerError("{0}: invalid response (HTTP {1})".format(
+                self.name, response.status))
+        if 'error' in payload:
+            raise PeerError("{0}: {1}".format(self.name, payload['error']))
+        return payload.get('result')
+
+    def _cached_nodes(self):
+        """Get nodes list learnt by any dispytch process from dispytch cache
+
+        :return: Listing timestamp and nodes names, or None (:class:`tuple`)
+        """
+        cached = cache.get('munin_peers', self.url)
+        if cached is None:
+            return None
+        (checked, nodes) = json.loads(cached)
+        return checked, frozenset(nodes)
+
+    def refresh(self):
+        """List nodes served by the peer
+
+        The last known list is kept when the peer cannot be reached.
+        """
+        try:
+            result = self.request('list', {'local': 'yes'})
+        except PeerError as exc:
+            _log.warning("unable to list peer nodes: %s", exc)
+            return
+        nodes = frozenset(result.get('nodes_list', []))
+        self._nodes = nodes
+        cache.put('munin_peers', self.url,
+                  json.dumps([time.time(), sorted(nodes)]))
+
+    def nodes(self):
+        """Get nodes served by the peer
+
+        The last known list is returned at once. Once older than the
+        refresh interval, it is refreshed in a background thread unless
+        another process refreshed it meanwhile. The peer is only listed
+        synchronously when its nodes were never listed.
+
+        :return: Nodes names (:class:`frozenset`)
+        """
+        with self._nodes_lock:
+            now = time.time()
+            if (self._nodes_checked is not None and
+                    now - self._nodes_checked < _refresh_interval):
+                return self._nodes
+            first = self._nodes_checked is None
+            self._nodes_checked = now
+
+            cached = self._cached_nodes()
+            if cached is not None:
+                self._nodes = cached[1]
+                if now - cached[0] < _refresh_interval:
+                    self._nodes_checked = cached[0]
+                    return self._nodes
+                first = False
+
+        if first:
+            self.refresh()
+        else:
+            thread = threading.Thread(target=self.refresh)
+            thread.daemon = True
+            thread.start()
+        return self._nodes
+
+    def close(self):
+        """Close idle connections
+        """
+        with self._lock:
+            for conn in self._pool:
+                conn.close()
+            self._pool = []
+
+
+def configure(spec, timeout=None, refresh_interval=None):
+    """Configure peers
+
+    Peers are kept while their configuration does not change, so their
+    connections are reused across requests.
+
+    :param str spec: Peers as "<poller> <url>" lines
+    :param str timeout: Peers requests timeout in seconds
+    :param str refresh_interval: Peers nodes lists refresh interval
+    """
+    global peers, _refresh_interval
+    timeout = float(timeout or 5)
+    _refresh_interval = int(refresh_interval or 30)
+
+    configured = {}
+    for line in (spec or "").splitlines():
+        if not line.strip():
+            continue
+        try:
+            (poller, url) = line.split()
+        except ValueError:
+            raise RuntimeError("invalid peer definition: {0}".format(line))
+        configured.setdefault(url, []).append(poller)
+
+    current = {}
+    for (url, pollers) in configured.items():
+        peer = peers.get(url)
+        if peer is None or peer.timeout != timeout:
+            peer = Peer(url, timeout)
+        peer.pollers = sorted(pollers)
+        current[url] = peer
+    for (url, peer) in peers.items():
+        if current.get(url) is not peer:
+            peer.close()
+    peers = current
+
+
+def warm_up():
+    """List peers nodes before serving requests
+    """
+    for peer in peers.values():
+        peer.nodes()
+
+
+def locate(node_name):
+    """Find peer serving a node
+
+    Peers nodes lists are the last known ones, see :meth:`Peer.nodes`.
+
+    :param str node_name: Munin node name
+    :return: Peer serving the node or None (:class:`Peer`)
+    """
+    for peer in peers.values():
+        if node_name in peer.nodes():
+            return peer
+    return None
+
+
+def fan_out(calls, local=None):
+    """Send requests to peers concurrently
+
+    :param list calls: Requests as (peer, method, params)
+    :param local: Function run meanwhile in the calling thread
+    :return: Local result, peers results as (peer, result) and errors by
+             peer name
+    :rtype: tuple
+    """
+    results = [None] * len(calls)
+
+    def call(idx, peer, method, params):
+        try:
+            results[idx] = (peer, peer.request(method, params))
+        except Exception as exc:
+            results[idx] = (peer, exc)
+
+    threads = []
+    for idx, (peer, method, params) in enumerate(calls):
+        thread = threading.Thread(target=call,
+                                  args=(idx, peer, method, params))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    local_result = local() if local is not None else None
+
+    succeeded = []
+    errors = {}
+    for (idx, thread) in enumerate(threads):
+        # connections timeout on their own, this bounds hung peers
+        thread.join(calls[idx][0].timeout * 2)
+        if results[idx] is None:
+            errors[calls[idx][0].name] = "request timed out"
+            continue
+        (peer, result) = results[idx]
+        if isinstance(result, Exception):
+            _log.warning("peer request failed: %s", result)
+            errors[peer.name] = str(result)
+        else:
+            succeeded.append((peer, result))
+    return local_result, succeeded, errors
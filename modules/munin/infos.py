@@ -27,12 +27,17 @@
 
 
 import os
+import time
+import marshal
 import logging
+import threading
 
+from dispytch import cache
 from dispytch import utils
+from dispytch import profiling
 
 
-_log = logging.getLogger("dispytch")
+_log = logging.getLogger("dispytch.munin.infos")
 
 
 def _parse_datafile_line(line):
@@ -54,136 +59,344 @@ def _parse_datafile_line(line):
     return {entry: {key: {option: value}}}
 
 
+class MuninPoller(object):
+    """Munin poller record
+
+    A single poller record is shared by every node it polls.
+    """
+
+    __slots__ = ('name', 'configpath', 'datadir', 'datafile')
+
+    def __init__(self, name, configpath, datadir):
+        """Initialization method
+
+        :param str name: Poller name
+        :param str configpath: Poller's configuration directory
+        :param str datadir: Poller's data directory
+        """
+        self.name = name
+        self.configpath = configpath
+        self.datadir = datadir
+        self.datafile = os.path.join(datadir, 'datafile')
+
+
+class MuninNode(object):
+    """Munin node record
+
+    Nodes are stored as compact records instead of free-form dictionnaries.
+    The node address is stored aside, other options are kept in the
+    ``options`` dictionnary, which is :obj:`None` when the node does not
+    define any other option. Graphs infos are not attached to nodes, they
+    are loaded on demand by :meth:`MuninConfig.get_graphs`.
+    """
+
+    __slots__ = ('name', 'address', 'options', 'poller')
+
+    def __init__(self, name):
+        """Initialization method
+
+        :param str name: Munin node name
+        """
+        self.name = name
+        self.address = None
+        self.options = None
+        self.poller = None
+
+    @property
+    def datadir(self):
+        """Node's data directory"""
+        return self.poller.datadir
+
+    @property
+    def datafile(self):
+        """Node's Munin datafile"""
+        return self.poller.datafile
+
+    def set_option(self, option, value):
+        """Set node option
+
+        :param str option: Option name
+        :param str value: Option value
+        """
+        if option == 'address':
+            self.address = value
+        elif self.options is None:
+            self.options = {option: value}
+        else:
+            self.options[option] = value
+
+    def get(self, option, default=None):
+        """Get node option
+
+        :param str option: Option name
+        :param default: Value returned if option is not set
+        :return: Option value
+        """
+        if option == 'address':
+            return self.address
+        if self.options is None:
+            return default
+        return self.options.get(option, default)
+
+    def as_dict(self, graphs=None):
+        """Get node as dictionnary, as it was exposed by previous releases
+
+        :param dict graphs: Node's graphs infos to include
+        :return: Node options and infos (:class:`dict`)
+        """
+        node = dict(self.options or {})
+        node.update({
+            'address': self.address,
+            '__poller': self.poller.name,
+            '__datadir': self.datadir,
+            '__datafile': self.datafile,
+            '__id': self.name,
+            })
+        if graphs is not None:
+            node['graphs'] = graphs
+        return node
+
+
 class MuninConfig(object):
     """Simple class to handle Munin configuration and infos
 
     This object provides several method for ease of configuration use.
+
+    Configuration files are tracked individually: when the configuration is
+    reloaded, only the ".conf" files which changed since the previous load
+    are parsed again. The nodes inventory is then swapped at once, so readers
+    never see a partially loaded configuration.
+
+    Nodes graphs infos are held in a bounded LRU cache, so memory usage does
+    not depend on the number of distinct nodes requested.
     """
 
-    def __init__(self, configpath, datadir, multipollers):
+    def __init__(self, configpath, datadir, multipollers, reload_interval=None,
+                 graphs_cache_size=None):
         """Initialization method
         """
         self.configpath = configpath
         self.datadir = datadir
         self.multiple_pollers = multipollers == "yes"
+        self.reload_interval = float(reload_interval or 0)
         self._nodes = None
+        self._sources = {}
+        self._pollers_index = {}
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._graphs = utils.LRUCache(int(graphs_cache_size or 256),
+                                      'munin_graphs')
 
     def clear(self):
         """Clear loaded configuration
         """
         self._nodes = None
+        self._sources = {}
+        self._graphs.clear()
 
-    def _parse_config(self, config_lines):
+    def _parse_config(self, config_file, filename=None):
         """Parse Munin style configuration lines
 
-        :param list config_lines: Lines read from configuration files
+        Lines are consumed one by one, so a file object may be parsed
+        without reading it at once. Options names are interned as they are
+        shared by every node.
 
-        :return: Parsed configuration as structure
+        :param config_file: Iterable of configuration lines
+        :param str filename: Name of the parsed file, used in errors
+
+        :return: Parsed nodes (:class:`MuninNode`) by names
         :rtype: dict
         """
-        config = {}
-        section = None
-        for line in config_lines:
+        nodes = {}
+        node = None
+        lineno = 0
+        for lineno, line in enumerate(config_file, 1):
             # remove comments from line
-            line = line.split('#', 1)[0].strip()
-            if not len(line):
+            if '#' in line:
+                line = line[:line.index('#')]
+            line = line.strip()
+            if not line:
                 continue
 
-            if line.startswith('['):
+            if line[0] == '[':
                 section = line[1:-1]
-                if section in config:
-                    raise SyntaxError('duplicate section: %s' % (section,))
+                if section in nodes:
+                    raise SyntaxError('{0}:{1}: duplicate section: {2}'.format(
+                        filename, lineno, section))
 
-                config[section] = {}
+                node = nodes[section] = MuninNode(section)
                 continue
 
-            option = line.strip().split(None, 1)
-            try:
-                config[section].update({option[0]: option[1]})
-            except IndexError:
-                raise SyntaxError('option without value: %s' % (option[0],))
-            except KeyError:
-                raise SyntaxError('orphan option: %s' % (option[0],))
+            option = line.split(None, 1)
+            if node is None:
+                raise SyntaxError('{0}:{1}: orphan option: {2}'.format(
+                    filename, lineno, option[0]))
+            if len(option) < 2:
+                raise SyntaxError('{0}:{1}: option without value: {2}'.format(
+                    filename, lineno, option[0]))
 
-        return config
+            node.set_option(intern(option[0]), option[1])
 
-    def _process_confs(self, path):
-        """Process every ".conf" files found in provided path
+        return nodes
 
-        :param str path: Configuration path holding ".conf" files
+    def _process_conf(self, cfg, poller):
+        """Parse a single ".conf" file and tag its nodes with poller infos
+
+        :param str cfg: Configuration file path
+        :param poller: Poller owning the file (:class:`MuninPoller`)
+
+        :return: Nodes defined in the file (:class:`dict`)
         """
-        configlines = []
-        for cfg in os.listdir(path):
-            cfg = os.path.join(path, cfg)
-            if os.path.isfile(cfg) and cfg.endswith('.conf'):
-                configlines.extend(open(cfg, 'r').readlines())
-            else:
+        _log.debug("parsing munin config file: %s", cfg)
+        with open(cfg, 'r') as cfd:
+            nodes = self._parse_config(cfd, cfg)
+
+        for node in nodes.values():
+            node.poller = poller
+        return nodes
+
+    def _process_confs(self, poller):
+        """Process every ".conf" files found in poller's configuration path
+
+        Files which did not change since the previous load are not parsed
+        again, their already loaded nodes are reused.
+
+        :param poller: Poller owning the files (:class:`MuninPoller`)
+
+        :return: Configuration files signatures and nodes (:class:`dict`)
+        """
+        sources = {}
+        known_nodes = {}
+        for cfg in sorted(os.listdir(poller.configpath)):
+            cfg = os.path.join(poller.configpath, cfg)
+            if not os.path.isfile(cfg) or not cfg.endswith('.conf'):
                 _log.warning(
-                    'skipping non-configuration element: {0}'.format(cfg))
+                    'skipping non-configuration element: %s', cfg)
+                continue
 
-        return self._parse_config(configlines)
+            stat = os.stat(cfg)
+            signature = (stat.st_ino, stat.st_size, stat.st_mtime)
+            previous = self._sources.get(cfg)
+            if previous is not None and previous[0] == signature:
+                nodes = previous[1]
+            else:
+                nodes = self._process_conf(cfg, poller)
+
+            for node in nodes:
+                if node in known_nodes:
+                    raise SyntaxError('{0}: duplicate section: {1} '
+                                      '(already defined in {2})'.format(
+                                          cfg, node, known_nodes[node]))
+                known_nodes[node] = cfg
+
+            sources[cfg] = (signature, nodes)
+
+        return sources
+
+    def _get_poller(self, name, configpath, datadir):
+        """Get poller record, reusing the already known one
+
+        :param str name: Poller name
+        :param str configpath: Poller's configuration directory
+        :param str datadir: Poller's data directory
+        :return: Poller record (:class:`MuninPoller`)
+        """
+        poller = self._pollers_index.get(name)
+        if (poller is None or poller.configpath != configpath or
+                poller.datadir != datadir):
+            poller = MuninPoller(name, configpath, datadir)
+            self._pollers_index[name] = poller
+        return poller
+
+    def _pollers(self):
+        """List configured pollers
+
+        :return: Pollers records (:class:`MuninPoller`)
+        :rtype: list
+        """
+        if self.multiple_pollers is not True:
+            return [self._get_poller("general", self.configpath,
+                                     self.datadir)]
+
+        pollers = os.listdir(self.configpath)
+        _log.debug("listed pollers: %s", pollers)
+        return [self._get_poller(poller,
+                                 os.path.join(self.configpath, poller),
+                                 os.path.join(self.datadir, poller))
+                for poller in pollers]
+
+    def _reload_due(self):
+        """Check if configuration files should be checked for changes
+
+        :return: :obj:`True` if the reload interval is elapsed
+        :rtype: bool
+        """
+        if not self.reload_interval:
+            return False
+        return time.time() - self._checked >= self.reload_interval
 
-    def load(self):
+    def load(self, force=False):
         """Load munin configuration files
+
+        Once loaded, the configuration is only reloaded when forced or when
+        the reload interval is elapsed. Only changed files are parsed again.
+        When reloading fails, the previous configuration is kept.
+
+        :param bool force: Force configuration files changes detection
         """
-        if self._nodes:
+        if self._nodes is not None and not force and not self._reload_due():
             _log.debug("munin config already loaded")
             return None
 
-        _log.debug("loading munin config")
-        _log.debug("configpath: {0}".format(self.configpath))
-
-        if not os.path.isdir(self.configpath):
-            _log.error('provided configuration path is not a directory')
-
-        self._nodes = {}
-        if self.multiple_pollers is True:
-            pollers = os.listdir(self.configpath)
-            _log.debug("listed pollers: {0}".format(pollers))
-            for poller in pollers:
-                configpath = os.path.join(self.configpath, poller)
-                datadir = os.path.join(self.datadir, poller)
-                for node, data in self._process_confs(configpath).items():
-                    data.update({
-                        '__poller': poller,
-                        '__datadir': datadir,
-                        '__datafile': os.path.join(datadir, 'datafile'),
-                        '__id': node
-                        })
-                    self._nodes[node] = data
-        else:
-            for node, data in self._process_confs(configpath).items():
-                data.update({
-                    '__poller': "general",
-                    '__datadir': self.datadir,
-                    '__datafile': os.path.join(self.datadir, 'datafile'),
-                    '__id': node
-                    })
-                self._nodes[node] = data
-
-        _log.debug("{0} nodes loaded".format(len(self._nodes)))
+        with self._lock, profiling.timed('munin.config_load'):
+            _log.debug("loading munin config")
+            _log.debug("configpath: %s", self.configpath)
+
+            if not os.path.isdir(self.configpath):
+                _log.error('provided configuration path is not a directory')
+
+            # Pollers are processed in order, so a node defined by multiple
+            # pollers is owned by the last one, as it used to be.
+            sources = {}
+            nodes = {}
+            try:
+                for poller in self._pollers():
+                    poller_sources = self._process_confs(poller)
+                    for cfg in sorted(poller_sources):
+                        nodes.update(poller_sources[cfg][1])
+                    sources.update(poller_sources)
+            except (SyntaxError, EnvironmentError) as exc:
+                if self._nodes is None:
+                    raise
+                # files are checked again once the reload interval elapsed
+                _log.error("unable to reload munin config, keeping the "
+                           "previous one: %s", exc)
+                self._checked = time.time()
+                return None
+
+            # Swap loaded configuration at once
+            self._sources = sources
+            self._nodes = nodes
+            self._checked = time.time()
+
+        _log.debug("%s nodes loaded", len(self._nodes))
         _log.debug("munin config loaded")
 
     def _load_node_graphs(self, node):
         """Load node's graphs infos from Munin datafile
 
-        :param str node: Munin node name
-        :return: :obj:`None`
-
-        :raise: KeyError if node is missing from configuration
-        :raise: KeyError if '__id' infos is missing from node
-        :raise: KeyError if '__datafile' infos is missing from node
+        :param node: Munin node (:class:`MuninNode`)
+        :return: Node's graphs infos (:class:`dict`)
         """
-        datafile = self._nodes[node]['__datafile']
-        node_id = self._nodes[node]['__id']
-        self._nodes[node]['graphs'] = {}
+        node_id = node.name
+        graphs = {}
 
         # munin datafile describe how graphs should be draw
         # lines may be one of the following:
         #   "munin;entry:datatype.key value with spaces"
         #   "munin;entry:datatype.serie.key value with spaces"
-        with open(datafile, "r") as dfile:
-            for line in dfile.readlines():
+        with open(node.datafile, "r") as dfile:
+            for line in dfile:
                 # Ignore heading line with munin version informations
                 if line.startswith("version "):
                     continue
@@ -195,8 +408,41 @@ class MuninConfig(object):
                     continue
 
                 infos = _parse_datafile_line(line.strip())
-                utils.merge_dict(self._nodes[node]['graphs'],
-                                 infos[node])
+                utils.merge_dict(graphs, infos[node_id])
+
+        return graphs
+
+    def get_graphs(self, node):
+        """Get node's graphs infos
+
+        Graphs infos are cached until the Munin datafile is updated, and
+        shared with other processes through dispytch cache. The cached
+        infos are returned, they must not be modified.
+
+        :param node: Munin node (:class:`MuninNode`)
+        :return: Node's graphs infos (:class:`dict`)
+        """
+        stat = os.stat(node.datafile)
+        signature = (node.datafile, stat.st_ino, stat.st_mtime)
+
+        cached = self._graphs.get(node.name)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+
+        shared_key = repr((node.name, signature))
+        shared = cache.get('munin_graphs_shared', shared_key)
+        if shared is not None:
+            graphs = marshal.loads(shared)
+        else:
+            with profiling.timed('munin.graphs_load'):
+                graphs = self._load_node_graphs(node)
+            try:
+                cache.put('munin_graphs_shared', shared_key,
+                          marshal.dumps(graphs))
+            except ValueError as exc:
+                _log.debug("unable to share graphs infos: %s", exc)
+        self._graphs.set(node.name, (signature, graphs))
+        return graphs
 
     @property
     def nodes(self):
@@ -204,40 +450,46 @@ class MuninConfig(object):
 
         :return: Loaded nodes names (:class:`list`)
         """
-        if not self._nodes:
-            self.load()
+        self.load()
         return self._nodes.keys()
 
     def get_node(self, node_name):
         """Get specific Munin node
 
-        Node configuration and graphs are loaded on call
-
         :param str node_name: Munin node name
-        :return: Munin node data (:class:`dict`) or :obj:`None`
+        :return: Munin node (:class:`MuninNode`) or :obj:`None`
         """
-        if node_name in self.nodes:
-            self._load_node_graphs(node_name)
-            return self._nodes[node_name]
+        self.load()
+        return self._nodes.get(node_name)
 
     def get_node_by_ip(self, node_ip):
         """Get specific Munin node by IP
 
-        Node configuration and graphs are loaded on call
-
         :param str node_ip: Munin node IP address
-        :return: Munin node data (:class:`dict`) or :obj:`None`
+        :return: Munin node (:class:`MuninNode`) or :obj:`None`
         """
-        for node in self.nodes:
-            if node_ip == self._nodes[node]['address']:
-                self._load_node_graphs(node)
-                return self._nodes[node]
+        self.load()
+        for node in self._nodes.values():
+            if node_ip == node.address:
+                return node
 
 
-def init_config(configpath, datadir, multipollers):
+def init_config(configpath, datadir, multipollers, reload_interval=None,
+                graphs_cache_size=None):
     """Initialize MuninConfig object and load configuration
+
+    An already initialized object with the same configuration is kept, so
+    the loaded nodes are reused between requests.
     """
-    globals()['config'] = MuninConfig(configpath, datadir, multipollers)
+    current = globals()['config']
+    if (current is not None and current.configpath == configpath and
+            current.datadir == datadir and
+            current.multiple_pollers == (multipollers == "yes")):
+        current.reload_interval = float(reload_interval or 0)
+        return
+
+    globals()['config'] = MuninConfig(configpath, datadir, multipollers,
+                                      reload_interval, graphs_cache_size)
 
 
 config = None
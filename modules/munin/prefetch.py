@@ -0,0 +1,209 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Munin popular requests warm-up
+
+Fetches of relative windows (ie. "now-1d" to "now") are recorded by every
+dispytch process in an append-only log. Just after each Munin update, the
+warm-up task merges the log in decaying popularity scores and fetches the
+most popular requests again, so that they are served from the dispytch
+cache (see the "cache" option, which must be shared by processes when the
+persistent server runs several workers). Without cache, requests are
+neither recorded nor warmed up.
+"""
+
+
+import os
+import json
+import time
+import errno
+import fcntl
+import logging
+
+from dispytch import cache
+
+from . import infos
+from . import rrd_utils
+
+
+_log = logging.getLogger("dispytch.munin.prefetch")
+
+# number of popular requests warmed up, 0 disables recording and warm-up
+TOP = 0
+# requests log and popularity scores directory
+DIRECTORY = None
+# seconds between warm-ups, Munin update interval
+INTERVAL = 300
+# seconds after the update interval boundary warm-ups are run at
+DELAY = 60
+
+# popularity scores factor applied at each warm-up
+DECAY = 0.5
+# scores under this threshold are forgotten
+MIN_SCORE = 0.1
+
+
+def configure(top=None, directory=None, interval=None, delay=None,
+              cache_ttl=None):
+    """Configure warm-up
+
+    Warmed up windows have to stay cached until the next warm-up, the cache
+    TTL may not be shorter than the warm-ups interval.
+
+    :param int top: Number of popular requests warmed up
+    :param str directory: Requests log and popularity scores directory
+    :param int interval: Seconds between warm-ups
+    :param int delay: Seconds after the interval boundary
+    :param int cache_ttl: Seconds fetched RRD windows are cached
+    """
+    global TOP, DIRECTORY, INTERVAL, DELAY
+    TOP = int(top or 0)
+    DIRECTORY = directory or '/var/lib/dispytch/prefetch'
+    INTERVAL = int(interval or 300)
+    DELAY = int(delay or 0)
+    if TOP and int(cache_ttl or 0) < INTERVAL:
+        raise RuntimeError("prefetch requires a cache_ttl of at least "
+                           "prefetch_interval ({0}s)".format(INTERVAL))
+
+
+def enabled():
+    """Check if requests are recorded and warmed up
+
+    Warm-ups are pointless without a cache backend to fill.
+
+    :return: Warm-up status (:class:`bool`)
+    """
+    return bool(TOP) and cache.BACKEND is not None
+
+
+def record(node, datatype, cf, start, stop, stitch=False):
+    """Record a fetch request
+
+    Only requests of relative windows are recorded, others would not be
+    requested again.
+
+    :param str node: Munin node name
+    :param str datatype: Munin datatype
+    :param str cf: Consolidation function
+    :param str start: Start time
+    :param str stop: Stop time
+    :param bool stitch: Archives are stitched
+    """
+    if not enabled():
+        return
+    (start, stop) = (str(start).strip(), str(stop).strip())
+    if not (start.startswith('now') and stop.startswith('now')):
+        return
+
+    line = json.dumps([node, datatype, str(cf).upper(), start, stop,
+                       bool(stitch)]) + '\n'
+    path = os.path.join(DIRECTORY, 'requests.log')
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                _log.debug("unable to record request: %s", exc)
+                return
+            try:
+                os.makedirs(DIRECTORY)
+            except OSError:
+                pass
+            continue
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        return
+
+
+def popular():
+    """Update popularity scores with recorded requests
+
+    :return: Most popular requests as (node, datatype, cf, start, stop,
+             stitch)
+    :rtype: list
+    """
+    if not os.path.isdir(DIRECTORY):
+        return []
+    log_path = os.path.join(DIRECTORY, 'requests.log')
+    scores_path = os.path.join(DIRECTORY, 'popularity.json')
+
+    with open(os.path.join(DIRECTORY, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(scores_path) as scores_file:
+                scores = json.load(scores_file)
+        except (IOError, ValueError):
+            scores = {}
+        for key in scores:
+            scores[key] *= DECAY
+
+        # the log is renamed, so that requests recorded meanwhile are kept
+        rotated = "{0}.{1}".format(log_path, os.getpid())
+        try:
+            os.rename(log_path, rotated)
+        except OSError:
+            pass
+        else:
+            with open(rotated) as log_file:
+                for line in log_file:
+                    line = line.strip()
+                    if line:
+                        scores[line] = scores.get(line, 0) + 1
+            os.unlink(rotated)
+
+        scores = dict((key, score) for (key, score) in scores.items()
+                      if score >= MIN_SCORE)
+        with open(scores_path + '.tmp', 'w') as scores_file:
+            json.dump(scores, scores_file)
+        os.rename(scores_path + '.tmp', scores_path)
+
+    ranked = sorted(scores.items(), key=lambda item: -item[1])[:TOP]
+    return [[field.encode('utf-8') if isinstance(field, unicode) else field
+             for field in json.loads(key)]
+            for (key, score) in ranked]
+
+
+def warm():
+    """Fetch most popular requests again
+    """
+    if not enabled():
+        return
+    started = time.time()
+    requests = popular()
+    for (node_name, datatype, cf, start, stop, stitch) in requests:
+        node = infos.config.get_node(node_name)
+        if node is None:
+            continue
+        try:
+            infos.config.get_graphs(node)
+            rrd_utils.get_munin_entry_metrics(node.datadir, node.name,
+                                              datatype, cf, start, stop,
+                                              stitch=stitch)
+        except Exception as exc:
+            _log.debug("unable to warm up %s %s: %s", node_name, datatype,
+                       exc)
+    _log.info("warmed up %d popular requests in %.3fs", len(requests),
+              time.time() - started)
@@ -25,18 +25,35 @@
 """Munin requests module
 """
 
+import time
+import fnmatch
 import logging
 
+from dispytch import admission
+from dispytch import profiling
+
 from . import infos
+from . import federation
+from . import prefetch
+from . import rollups
+from . import rrd_reader
 from . import rrd_utils
 
 
-_log = logging.getLogger("dispytch")
+_log = logging.getLogger("dispytch.munin.requests")
+
+# Munin update interval, the finest resolution of its RRD files
+MUNIN_STEP = 300
+
+# window assumed for time specifications which cannot be resolved
+DEFAULT_WINDOW = 86400
 
 
 def handle_request_list(arguments):
     """Handle "list" request
 
+    Nodes served by federation peers are listed along with local ones.
+
     :param dict arguments: Dictionnary of arguments
 
     :return: Dictionnary of available data
@@ -45,16 +62,121 @@ def handle_request_list(arguments):
     target = arguments.get('target')
 
     if target:
-        available = {target: infos.config.get_node(target)}
+        node = infos.config.get_node(target)
+        available = {target: None}
+        if node:
+            available[target] = node.as_dict(infos.config.get_graphs(node))
+        elif not arguments.get('local'):
+            peer = federation.locate(target)
+            if peer is not None:
+                available = peer.request('list', {'target': target,
+                                                  'local': 'yes'})
     else:
-        available = {'nodes_list': infos.config.nodes}
+        nodes = list(infos.config.nodes)
+        if not arguments.get('local'):
+            for peer in federation.peers.values():
+                nodes.extend(peer.nodes())
+        available = {'nodes_list': nodes}
 
     return (None, available)
 
 
+def _peer_params(munin_args, targets, by=None):
+    """Build peers fetch request arguments
+
+    :param dict munin_args: Dictionnary of arguments built by Munin module
+    :param list targets: Targets to fetch
+    :param str by: Targets kind, "ip" for IP addresses
+    :return: Request arguments (:class:`dict`)
+    """
+    params = {'target': ",".join(targets)}
+    for field in ('datatype', 'cf', 'start', 'stop', 'stitch', 'resolution'):
+        if munin_args.get(field) is not None:
+            params[field] = munin_args[field]
+    if by is not None:
+        params['by'] = by
+    return params
+
+
+def _packed(munin_args):
+    """Tell if series may be kept packed
+
+    Packed series (see :class:`dispytch.utils.PackedPoints`) are sent from
+    their buffers, without mutator.
+
+    :param dict munin_args: Dictionnary of arguments built by Munin module
+    :return: Series may be packed (:class:`bool`)
+    """
+    return not munin_args.get('mutator')
+
+
+def _fetch_nodes(nodes, munin_args):
+    """Fetch series of local nodes
+
+    Series are served from rollups when one matches the requested window.
+
+    :param list nodes: Munin nodes (:class:`infos.MuninNode`)
+    :param dict munin_args: Dictionnary of arguments built by Munin module
+
+    :return: Graph infos and series by node (:class:`tuple`)
+    """
+    datatype = munin_args.get('datatype')
+    graph_info = None
+    series = {}
+    for node in nodes:
+        _log.debug("selected munin node: %s", node.name)
+        rolled = None
+        if munin_args.get('stitch') != "yes":
+            rolled = rollups.lookup(node.name, datatype, munin_args.get('cf'),
+                                    munin_args.get('start'),
+                                    munin_args.get('stop'),
+                                    munin_args.get('resolution'))
+        if rolled is not None:
+            series[node.name] = {datatype: rolled}
+        else:
+            prefetch.record(node.name, datatype, munin_args.get('cf'),
+                            munin_args.get('start'), munin_args.get('stop'),
+                            munin_args.get('stitch') == "yes")
+            series.update(rrd_utils.get_munin_entry_metrics(
+                    node.datadir, node.name,
+                    datatype, munin_args.get('cf'),
+                    munin_args.get('start'), munin_args.get('stop'),
+                    stitch=munin_args.get('stitch') == "yes",
+                    packed=_packed(munin_args)))
+        if graph_info is None:
+            graph_info = infos.config.get_graphs(node).get(datatype)
+    return (graph_info, series)
+
+
+def _merge_peers(local, results, errors):
+    """Merge local and peers series
+
+    :param tuple local: Local graph infos and series
+    :param list results: Peers fetch results as (peer, result)
+    :param dict errors: Peers errors by peer name
+
+    :return: Graph infos, series and peers errors (:class:`tuple`)
+    """
+    (graph_info, series) = local if local is not None else (None, {})
+    for (peer, result) in results:
+        series.update(result['series'])
+        if graph_info is None:
+            graph_info = result['info']
+
+    if errors and not series:
+        raise RuntimeError("federation peers failed: {0}".format(
+            "; ".join(sorted(errors.values()))))
+    if errors:
+        return (graph_info, series, errors)
+    return (graph_info, series)
+
+
 def handle_request_byid(munin_args):
     """Handle "by-id" request
 
+    Multiple nodes may be requested, separated by commas. Nodes served by
+    federation peers are fetched from them concurrently.
+
     :param dict munin_args: Dictionnary of arguments built by Munin module
 
     :return: Dictionnary of fetched data
@@ -64,23 +186,39 @@ def handle_request_byid(munin_args):
     if not munin_args.get('target'):
         raise ValueError('missing node from request')
 
-    node = infos.config.get_node(munin_args['target'])
-    if not node:
-        raise ValueError('unknown requested node')
+    nodes = []
+    remote = {}
+    with profiling.timed('munin.lookup'):
+        for target in munin_args['target'].split(','):
+            node = infos.config.get_node(target)
+            if node:
+                nodes.append(node)
+                continue
+            peer = None
+            if not munin_args.get('local'):
+                peer = federation.locate(target)
+            if peer is None:
+                raise ValueError('unknown requested node')
+            remote.setdefault(peer, []).append(target)
 
-    _log.debug("selected munin node: {0}".format(node['__id']))
-    series = rrd_utils.get_munin_entry_metrics(
-                node['__datadir'], node['__id'],
-                munin_args.get('datatype'), munin_args.get('cf'),
-                munin_args.get('start'), munin_args.get('stop'))
+    if not remote:
+        return _fetch_nodes(nodes, munin_args)
 
-    graph_info = node.get('graphs', {}).get(munin_args.get('datatype'))
-    return (graph_info, series)
+    calls = [(peer, 'fetch', _peer_params(munin_args, targets))
+             for (peer, targets) in remote.items()]
+    with profiling.timed('munin.federation'):
+        (local, results, errors) = federation.fan_out(
+            calls, lambda: _fetch_nodes(nodes, munin_args) if nodes else None)
+    return _merge_peers(local, results, errors)
 
 
 def handle_request_byip(munin_args):
     """Handle "by-ip" request
 
+    Unknown IP addresses are looked up on every federation peer, the
+    request is rejected as unavailable when the address is unknown to
+    peers which answered while others failed.
+
     :param dict arguments: Dictionnary of arguments
 
     :return: Dictionnary of fetched data
@@ -91,18 +229,212 @@ def handle_request_byip(munin_args):
     if ipaddr is None:
         raise ValueError('missing IP from request')
 
-    node = infos.config.get_node_by_ip(munin_args['target'])
-    if not node:
+    with profiling.timed('munin.lookup'):
+        node = infos.config.get_node_by_ip(munin_args['target'])
+    if node:
+        return _fetch_nodes([node], munin_args)
+    if munin_args.get('local') or not federation.peers:
         raise ValueError('unknown requested IP')
 
-    _log.debug("selected munin node: {0}".format(node['__id']))
-    series = rrd_utils.get_munin_entry_metrics(
-                node['__datadir'], node['__id'],
-                munin_args.get('datatype'), munin_args.get('cf'),
-                munin_args.get('start'), munin_args.get('stop'))
+    params = _peer_params(munin_args, [ipaddr], by='ip')
+    params['local'] = 'yes'
+    calls = [(peer, 'fetch', params) for peer in federation.peers.values()]
+    with profiling.timed('munin.federation'):
+        (_, results, errors) = federation.fan_out(calls)
+    for (peer, result) in results:
+        if result['series']:
+            return (result['info'], result['series'])
+    # the address may be served by a peer which did not answer
+    if errors:
+        raise admission.RequestRejected(
+            "federation peers unavailable: {0}".format(
+                "; ".join(sorted(errors.values()))), 503)
+    raise ValueError('unknown requested IP')
 
-    graph_info = node.get('graphs', {}).get(munin_args.get('datatype'))
-    return (graph_info, series)
+
+def handle_request_fetch(munin_args):
+    """Handle "fetch" request, sent by federation front instances
+
+    Only local nodes are served, graph infos are returned with series.
+    Unknown IP addresses get no series.
+
+    :param dict munin_args: Dictionnary of arguments built by Munin module
+
+    :return: Dictionnary of fetched data and graph infos
+    :rtype: dict
+    """
+    munin_args['local'] = 'yes'
+    if munin_args.get('by') == 'ip':
+        # unknown addresses are answered with no series, so that front
+        # instances tell them from failing peers
+        if infos.config.get_node_by_ip(munin_args.get('target')) is None:
+            return (None, {'info': None, 'series': {}})
+        fetched = handle_request_byip(munin_args)
+    else:
+        fetched = handle_request_byid(munin_args)
+    return (fetched[0], {'info': fetched[0], 'series': fetched[1]})
+
+
+def handle_request_all(munin_args):
+    """Handle "all" request
+
+    Every datatype of a node is fetched at once: RRD files are found in one
+    pass of the node directory and fetched concurrently. Graph infos of the
+    node are returned with series, datatypes failing to be fetched are
+    reported as errors.
+
+    :param dict munin_args: Dictionnary of arguments built by Munin module
+
+    :return: Dictionnary of graphs infos and fetched data
+    :rtype: dict
+    """
+    target = munin_args.get('target')
+    if not target:
+        raise ValueError('missing node from request')
+
+    with profiling.timed('munin.lookup'):
+        node = infos.config.get_node(target)
+    if node is None:
+        peer = None
+        if not munin_args.get('local'):
+            peer = federation.locate(target)
+        if peer is None:
+            raise ValueError('unknown requested node')
+        params = _peer_params(munin_args, [target])
+        params['local'] = 'yes'
+        with profiling.timed('munin.federation'):
+            result = peer.request('all', params)
+        return (result['info'], result)
+
+    graphs = infos.config.get_graphs(node)
+    (series, errors) = rrd_utils.get_munin_node_metrics(
+        node.datadir, node.name, list(graphs), munin_args.get('cf'),
+        munin_args.get('start'), munin_args.get('stop'),
+        stitch=munin_args.get('stitch') == "yes",
+        packed=_packed(munin_args))
+    fetched = {'info': graphs, 'series': series}
+    if errors:
+        return (graphs, fetched, errors)
+    return (graphs, fetched)
+
+
+def _select_nodes(selectors, local=False):
+    """Select nodes names matching selectors
+
+    :param list selectors: Nodes names or shell-style patterns
+    :param bool local: Only select local nodes
+    :return: Nodes names (:class:`list`)
+    """
+    names = list(infos.config.nodes)
+    if not local:
+        for peer in federation.peers.values():
+            names.extend(peer.nodes())
+
+    selected = []
+    for selector in selectors:
+        if not any(char in selector for char in '*?['):
+            selected.append(selector)
+            continue
+        selected.extend(sorted(name for name in names
+                               if fnmatch.fnmatchcase(name, selector)))
+    return selected
+
+
+def handle_request_aggregate(munin_args):
+    """Handle "aggregate" request
+
+    Series of several nodes are aggregated by name, values at the same time
+    being summed, averaged, or reduced to their minimum or maximum. Nodes
+    are given by names or shell-style patterns, separated by commas, and
+    aggregates are served from rollups when one matches.
+
+    :param dict munin_args: Dictionnary of arguments built by Munin module
+
+    :return: Dictionnary of aggregated data, by aggregate key
+    :rtype: dict
+    """
+    target = munin_args.get('target')
+    if not target:
+        raise ValueError('missing nodes from request')
+    function = munin_args.get('function', 'avg')
+    if function not in rollups.AGGREGATES:
+        raise ValueError('unknown aggregation function')
+    datatype = munin_args.get('datatype')
+    key = rollups.aggregate_key(function, target)
+
+    names = _select_nodes(target.split(','), munin_args.get('local'))
+    if not names:
+        raise ValueError('no node matching request')
+
+    rolled = rollups.lookup(key, datatype, munin_args.get('cf'),
+                            munin_args.get('start'), munin_args.get('stop'),
+                            munin_args.get('resolution'))
+    if rolled is not None:
+        graph_info = None
+        for name in names:
+            node = infos.config.get_node(name)
+            if node is not None:
+                graph_info = infos.config.get_graphs(node).get(datatype)
+                break
+        return (graph_info, {key: {datatype: rolled}})
+
+    fetched = handle_request_byid(dict(munin_args, target=",".join(names)))
+    aggregated = rollups.aggregate_series(
+        [datatypes.get(datatype, []) for datatypes in fetched[1].values()],
+        function)
+    return (fetched[0], {key: {datatype: aggregated}}) + fetched[2:]
+
+
+def estimate_cost(munin_args):
+    """Estimate request cost before handling it
+
+    The cost is the number of data points to read: RRD files matched on
+    local nodes times the points of the window at Munin resolution. Nodes
+    served by federation peers are accounted by the peers.
+
+    :param dict munin_args: Dictionnary of arguments built by Munin module
+
+    :return: Estimated cost (:class:`int`)
+    """
+    target = munin_args.get('target')
+    if munin_args.get('method') not in ('by-id', 'by-ip', 'fetch',
+                                        'aggregate', 'all'):
+        return 0
+    if not target:
+        return 0
+
+    if munin_args['method'] == 'by-ip' or munin_args.get('by') == 'ip':
+        nodes = [infos.config.get_node_by_ip(target)]
+    elif munin_args['method'] == 'aggregate':
+        nodes = [infos.config.get_node(name)
+                 for name in _select_nodes(target.split(','), local=True)]
+    else:
+        nodes = [infos.config.get_node(name) for name in target.split(',')]
+
+    files = 0
+    for node in nodes:
+        if node is None:
+            continue
+        try:
+            if munin_args['method'] == 'all':
+                graphs = infos.config.get_graphs(node)
+                files += sum(len(rrds) for rrds in rrd_utils.find_node_rrds(
+                    node.datadir, node.name, list(graphs)).values())
+            else:
+                files += len(rrd_utils.find_munin_rrds(
+                    node.datadir, node.name, munin_args.get('datatype')))
+        except OSError:
+            continue
+
+    now = int(time.time())
+    try:
+        window = (rrd_reader.parse_time(munin_args.get('stop', 'now'), now,
+                                        approximate=True) -
+                  rrd_reader.parse_time(munin_args.get('start'), now,
+                                        approximate=True))
+    except rrd_reader.UnsupportedRRD:
+        window = DEFAULT_WINDOW
+    return files * max(1, window // MUNIN_STEP)
 
 
 # Reference known methods to handle
@@ -110,5 +442,8 @@ KNOWN_METHODS = {
     'list': handle_request_list,
     'by-id': handle_request_byid,
     'by-ip': handle_request_byip,
+    'fetch': handle_request_fetch,
+    'aggregate': handle_request_aggregate,
+    'all': handle_request_all,
     }
 
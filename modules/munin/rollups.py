@@ -0,0 +1,452 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Munin rollups
+
+Long-range views of frequently requested graphs may be precomputed, so that
+they are served from small files instead of re-reading and re-reducing the
+same RRD regions. Rollups are configured in the "rollups" option of the
+module section, one per line:
+
+    <nodes selector> <datatype> [<cf>] <window>:<step> [<window>:<step> ...]
+
+Example:
+    poller0;* cpu 31d:7200 1y:86400
+
+Nodes selectors are node names or shell-style patterns. For each view, the
+series of the last window are averaged in buckets of step seconds, for each
+matching node and aggregated across nodes (see :data:`AGGREGATES`).
+
+A view serves requests covered by its window, with the requested
+"resolution" as step or, without resolution, spanning at least half of its
+window. Rollups are rebuilt every "rollups_interval" seconds, by the
+persistent server or the "dispytch tasks" command.
+"""
+
+
+import os
+import time
+import array
+import fcntl
+import struct
+import urllib
+import fnmatch
+import logging
+import collections
+
+from dispytch import metrics
+
+from . import infos
+from . import rrd_reader
+from . import rrd_utils
+
+
+_log = logging.getLogger("dispytch.munin.rollups")
+
+# cross-nodes aggregation functions
+AGGREGATES = ('sum', 'avg', 'min', 'max')
+
+# configured rollups
+ROLLUPS = []
+# rollups files directory
+DIRECTORY = None
+# seconds between rollups builds
+INTERVAL = 3600
+
+# rollup file: magic, build time, first bucket, step, buckets and series
+_HEADER = struct.Struct('=4sqqqII')
+_MAGIC = 'DRU1'
+_NAME = struct.Struct('=H')
+
+_NAN = float('nan')
+
+
+class Rollup(object):
+    """Configured rollup
+    """
+
+    __slots__ = ('selector', 'datatype', 'cf', 'views')
+
+    def __init__(self, line):
+        """Initialization method
+
+        :param str line: Rollup configuration line
+        """
+        fields = line.split()
+        if len(fields) < 3:
+            raise ValueError("invalid rollup: {0}".format(line))
+        (self.selector, self.datatype) = fields[:2]
+        self.cf = "AVERAGE"
+        if fields[2].upper() in ("AVERAGE", "MIN", "MAX", "LAST"):
+            self.cf = fields.pop(2).upper()
+
+        self.views = []
+        for view in fields[2:]:
+            (window, _, step) = view.partition(':')
+            try:
+                self.views.append((parse_duration(window),
+                                   parse_duration(step)))
+            except (rrd_reader.UnsupportedRRD, ValueError):
+                raise ValueError("invalid rollup view: {0}".format(view))
+        if not self.views:
+            raise ValueError("invalid rollup: {0}".format(line))
+        self.views.sort(key=lambda view: view[1])
+
+    def matches(self, node_name):
+        """Check if a node is selected by the rollup
+
+        :param str node_name: Munin node name
+        :return: Node selection (:class:`bool`)
+        """
+        return fnmatch.fnmatchcase(node_name, self.selector)
+
+
+def parse_duration(spec):
+    """Parse duration as seconds or "<count><unit>", ie. "31d"
+
+    :param str spec: Duration specification
+    :return: Duration in seconds (:class:`int`)
+    """
+    if spec.isdigit():
+        duration = int(spec)
+    else:
+        duration = -rrd_reader.parse_time("now-{0}".format(spec), 0,
+                                          approximate=True)
+    if duration <= 0:
+        raise ValueError("invalid duration: {0}".format(spec))
+    return duration
+
+
+def aggregate_key(function, selector):
+    """Build key of nodes aggregate series
+
+    :param str function: Aggregation function
+    :param str selector: Nodes selector
+    :return: Aggregate key (:class:`str`)
+    """
+    return "{0}({1})".format(function, selector)
+
+
+def configure(rollups=None, directory=None, interval=None):
+    """Configure rollups
+
+    :param str rollups: Rollups configuration lines
+    :param str directory: Rollups files directory
+    :param int interval: Seconds between rollups builds
+    """
+    global ROLLUPS, DIRECTORY, INTERVAL
+    ROLLUPS = [Rollup(line) for line in (rollups or '').split('\n')
+               if line.strip()]
+    DIRECTORY = directory or '/var/lib/dispytch/rollups'
+    INTERVAL = int(interval or 3600)
+
+
+def _path(key, datatype, cf, step):
+    """Get rollup file path
+
+    :param str key: Node name or aggregate key
+    :param str datatype: Munin datatype
+    :param str cf: Consolidation function
+    :param int step: Rollup step
+    :return: Rollup file path (:class:`str`)
+    """
+    filename = "{0}.{1}.{2}.{3}.rollup".format(
+        urllib.quote(key, safe=''), urllib.quote(datatype, safe=''), cf, step)
+    return os.path.join(DIRECTORY, filename)
+
+
+def write_rollup(path, built, start, step, series):
+    """Write rollup file atomically
+
+    :param str path: Rollup file path
+    :param int built: Build timestamp
+    :param int start: First bucket timestamp
+    :param int step: Buckets step
+    :param list series: Series as (name, values :class:`array.array`)
+    """
+    count = len(series[0][1]) if series else 0
+    chunks = [_HEADER.pack(_MAGIC, built, start, step, count, len(series))]
+    for (name, values) in series:
+        chunks.append(_NAME.pack(len(name)))
+        chunks.append(name)
+    for (name, values) in series:
+        chunks.append(values.tostring())
+
+    with open(path + '.tmp', 'wb') as rollup_file:
+        rollup_file.write(''.join(chunks))
+    os.rename(path + '.tmp', path)
+
+
+def read_rollup(path):
+    """Read rollup file
+
+    :param str path: Rollup file path
+    :return: Build timestamp, first bucket timestamp, step and series as
+             (name, values :class:`array.array`)
+    :rtype: tuple
+    """
+    with open(path, 'rb') as rollup_file:
+        data = rollup_file.read()
+    (magic, built, start, step, count, series_count) = _HEADER.unpack_from(data)
+    if magic != _MAGIC:
+        raise ValueError("invalid rollup file: {0}".format(path))
+
+    offset = _HEADER.size
+    names = []
+    for _ in range(series_count):
+        (length,) = _NAME.unpack_from(data, offset)
+        offset += _NAME.size
+        names.append(data[offset:offset + length])
+        offset += length
+
+    series = []
+    size = count * array.array('d').itemsize
+    for name in names:
+        values = array.array('d')
+        values.fromstring(data[offset:offset + size])
+        offset += size
+        series.append((name, values))
+    return (built, start, step, series)
+
+
+def _reduce(values, function):
+    """Reduce values with an aggregation function
+
+    :param list values: Known values
+    :param str function: Aggregation function
+    :return: Reduced value (:class:`float`)
+    """
+    if function == 'sum':
+        return float(sum(values))
+    if function == 'avg':
+        return float(sum(values)) / len(values)
+    if function == 'min':
+        return min(values)
+    return max(values)
+
+
+def aggregate_series(nodes_series, function):
+    """Aggregate series of several nodes by name
+
+    Values of series with the same name are aggregated by timestamp.
+
+    :param list nodes_series: Series lists of nodes
+    :param str function: Aggregation function
+    :return: Aggregated series (:class:`list`)
+    """
+    points = collections.OrderedDict()
+    for series in nodes_series:
+        for serie in series:
+            by_time = points.setdefault(serie['name'], {})
+            for (timestamp, value) in serie['data']:
+                by_time.setdefault(timestamp, []).append(value)
+
+    return [{'name': name,
+             'data': [(timestamp, _reduce(by_time[timestamp], function))
+                      for timestamp in sorted(by_time)]}
+            for (name, by_time) in points.items()]
+
+
+def _buckets(data, start, step, count):
+    """Average data points in buckets
+
+    :param list data: Serie data points, timestamps in ms
+    :param int start: First bucket timestamp
+    :param int step: Buckets step
+    :param int count: Number of buckets
+    :return: Buckets values, NaN for unknown (:class:`array.array`)
+    """
+    sums = [0.0] * count
+    counts = [0] * count
+    for (timestamp, value) in data:
+        idx = (timestamp // 1000 - start) // step
+        if 0 <= idx < count:
+            sums[idx] += value
+            counts[idx] += 1
+    return array.array('d', [total / number if number else _NAN
+                             for (total, number) in zip(sums, counts)])
+
+
+def _aggregate_buckets(nodes_buckets, function):
+    """Aggregate buckets of several nodes by serie name
+
+    :param list nodes_buckets: Series as (name, buckets) of each node
+    :param str function: Aggregation function
+    :return: Aggregated series as (name, buckets) (:class:`list`)
+    """
+    by_name = collections.OrderedDict()
+    for series in nodes_buckets:
+        for (name, values) in series:
+            by_name.setdefault(name, []).append(values)
+
+    aggregated = []
+    for (name, arrays) in by_name.items():
+        values = array.array('d')
+        for bucket in zip(*arrays):
+            known = [value for value in bucket if value == value]
+            values.append(_reduce(known, function) if known else _NAN)
+        aggregated.append((name, values))
+    return aggregated
+
+
+def build_rollup(rollup, now):
+    """Build rollup files of a configured rollup
+
+    :param Rollup rollup: Configured rollup
+    :param int now: Build timestamp
+    """
+    nodes = [infos.config.get_node(name)
+             for name in sorted(infos.config.nodes) if rollup.matches(name)]
+    for (window, step) in rollup.views:
+        start = now - window - (now - window) % step
+        count = (now - start) // step + 1
+
+        nodes_buckets = []
+        for node in nodes:
+            series = rrd_utils.get_munin_entry_metrics(
+                node.datadir, node.name, rollup.datatype, rollup.cf,
+                str(start), str(now))[node.name][rollup.datatype]
+            buckets = [(serie['name'], _buckets(serie['data'], start, step,
+                                                count))
+                       for serie in series]
+            write_rollup(_path(node.name, rollup.datatype, rollup.cf, step),
+                         now, start, step, buckets)
+            nodes_buckets.append(buckets)
+
+        for function in AGGREGATES:
+            write_rollup(_path(aggregate_key(function, rollup.selector),
+                               rollup.datatype, rollup.cf, step),
+                         now, start, step,
+                         _aggregate_buckets(nodes_buckets, function))
+
+
+def build(now=None):
+    """Build configured rollups
+
+    Rollups are built by one process at once, builds are skipped while the
+    previous one is recent enough.
+
+    :param int now: Build timestamp, defaults to current time
+    """
+    if not ROLLUPS:
+        return
+    if not os.path.isdir(DIRECTORY):
+        os.makedirs(DIRECTORY)
+    now = int(now or time.time())
+
+    with open(os.path.join(DIRECTORY, '.lock'), 'a') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            _log.debug("rollups are being built by another process")
+            return
+        stamp = os.path.join(DIRECTORY, '.built')
+        if (os.path.exists(stamp) and
+                now - os.path.getmtime(stamp) < INTERVAL / 2):
+            _log.debug("rollups are recent enough")
+            return
+
+        started = time.time()
+        for rollup in ROLLUPS:
+            try:
+                build_rollup(rollup, now)
+            except Exception as exc:
+                _log.error("unable to build rollup %s %s: %s",
+                           rollup.selector, rollup.datatype, exc)
+        with open(stamp, 'a'):
+            os.utime(stamp, None)
+        _log.info("rollups built in %.3fs", time.time() - started)
+
+
+def lookup(key, datatype, cf, start, end, resolution=None, now=None):
+    """Get series of a node or aggregate from rollups
+
+    :param str key: Node name or aggregate key
+    :param str datatype: Munin datatype
+    :param str cf: Consolidation function
+    :param str start: Start time
+    :param str end: End time
+    :param int resolution: Requested step, if any
+    :param int now: Current timestamp, defaults to current time
+
+    :return: Series (:class:`list`) or :obj:`None` if no rollup matches
+    """
+    if not ROLLUPS:
+        return None
+    now = int(now or time.time())
+    try:
+        (start, end) = (rrd_reader.parse_time(start, now),
+                        rrd_reader.parse_time(end, now))
+        resolution = int(resolution) if resolution else None
+    except (rrd_reader.UnsupportedRRD, ValueError):
+        return None
+
+    cf = str(cf).upper()
+    for rollup in ROLLUPS:
+        if rollup.datatype != datatype or rollup.cf != cf:
+            continue
+        if key not in [aggregate_key(function, rollup.selector)
+                       for function in AGGREGATES] and \
+                not rollup.matches(key):
+            continue
+        for (window, step) in rollup.views:
+            if resolution is not None and step != resolution:
+                continue
+            if resolution is None and not window // 2 <= end - start <= window:
+                continue
+            series = _read_window(_path(key, datatype, cf, step), start, end)
+            if series is not None:
+                metrics.CACHE_REQUESTS.inc(cache='munin_rollups',
+                                           result='hit')
+                return series
+    metrics.CACHE_REQUESTS.inc(cache='munin_rollups', result='miss')
+    return None
+
+
+def _read_window(path, start, end):
+    """Read series of a window from a rollup file
+
+    The rollup must cover the window, its last bucket being the most recent
+    data served.
+
+    :param str path: Rollup file path
+    :param int start: Window start timestamp
+    :param int end: Window end timestamp
+    :return: Series (:class:`list`) or :obj:`None`
+    """
+    try:
+        (built, first, step, series) = read_rollup(path)
+    except (IOError, ValueError, struct.error) as exc:
+        _log.debug("unable to read rollup %s: %s", path, exc)
+        return None
+    if start < first or end > built + step:
+        return None
+
+    begin = max(0, (start - first) // step)
+    stop = (end - first) // step + 1
+    return [{'name': name,
+             'data': [((first + step * idx) * 1000, values[idx])
+                      for idx in range(begin, min(stop, len(values)))
+                      if values[idx] == values[idx]]}
+            for (name, values) in series]
@@ -0,0 +1,371 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""Native RRD reader for Munin RRD files
+
+Munin RRD files have a fixed layout: a single data source named "42" and
+standard archives. This reader memory-maps RRD files, parses their header
+once (headers are cached per file) and extracts the requested archive
+window as a packed float array, without going through rrdtool.
+
+Only native RRD files of format version 0003/0004 written on 64 bits
+platforms are supported. :class:`UnsupportedRRD` is raised for anything
+else (other layouts, unsupported time specifications), so callers may
+fall back to rrdtool.
+"""
+
+
+import os
+import re
+import mmap
+import time
+import array
+import struct
+import logging
+
+from dispytch import utils
+
+
+_log = logging.getLogger("dispytch.munin.rrd")
+
+# rrd_format.h structures sizes on LP64 platforms
+_STAT_HEAD = struct.Struct("=4s5s7xdQQQ80x")
+_DS_DEF = struct.Struct("=20s20s80x")
+_RRA_DEF = struct.Struct("=20s4xQQ80x")
+_LIVE_HEAD = struct.Struct("=qq")
+_PDP_PREP_SIZE = 112
+_CDP_PREP_SIZE = 80
+_RRA_PTR = struct.Struct("=Q")
+_VALUE_SIZE = 8
+
+_FLOAT_COOKIE = 8.642135E130
+_SUPPORTED_VERSIONS = ('0003', '0004')
+
+_TIME_UNITS = {
+    's': 1, 'sec': 1, 'second': 1, 'seconds': 1,
+    'min': 60, 'minute': 60, 'minutes': 60,
+    'h': 3600, 'hour': 3600, 'hours': 3600,
+    'd': 86400, 'day': 86400, 'days': 86400,
+    'w': 604800, 'week': 604800, 'weeks': 604800,
+    }
+_TIME_RE = re.compile(r"^now(?:([+-])(\d+)([a-z]+))?$")
+
+# calendar units, only resolved approximately
+_APPROXIMATE_UNITS = {
+    'mon': 2592000, 'month': 2592000, 'months': 2592000,
+    'y': 31536000, 'year': 31536000, 'years': 31536000,
+    }
+
+_headers = utils.LRUCache(1024, 'munin_rrd_headers')
+
+
+class UnsupportedRRD(Exception):
+    """RRD file or request not supported by the native reader
+    """
+
+
+class RRDHeader(object):
+    """Static part of a RRD file header
+    """
+
+    __slots__ = ('ds_names', 'pdp_step', 'rras', 'live_head_offset',
+                 'rra_ptr_offset')
+
+    def __init__(self, ds_names, pdp_step, rras, live_head_offset,
+                 rra_ptr_offset):
+        """Initialization method
+
+        :param tuple ds_names: Data sources names
+        :param int pdp_step: Primary data points step
+        :param list rras: Archives as (cf, row_cnt, pdp_cnt, data offset)
+        :param int live_head_offset: Offset of the live header
+        :param int rra_ptr_offset: Offset of the archives pointers
+        """
+        self.ds_names = ds_names
+        self.pdp_step = pdp_step
+        self.rras = rras
+        self.live_head_offset = live_head_offset
+        self.rra_ptr_offset = rra_ptr_offset
+
+
+def _cstring(value):
+    """Get C string from fixed size buffer
+
+    :param str value: Buffer
+    :return: String up to the first null byte (:class:`str`)
+    """
+    return value.split('\0', 1)[0]
+
+
+def parse_header(data, size):
+    """Parse static part of RRD header
+
+    :param data: RRD file content (:class:`mmap.mmap` or :class:`str`)
+    :param int size: RRD file size
+    :return: Parsed header (:class:`RRDHeader`)
+
+    :raise: UnsupportedRRD if the file layout is not supported
+    """
+    if struct.calcsize("l") != 8:
+        raise UnsupportedRRD("only 64 bits platforms are supported")
+    if size < _STAT_HEAD.size:
+        raise UnsupportedRRD("truncated RRD file")
+
+    (cookie, version, float_cookie, ds_cnt, rra_cnt,
+     pdp_step) = _STAT_HEAD.unpack_from(data, 0)
+    if cookie != "RRD\0" or _cstring(version) not in _SUPPORTED_VERSIONS:
+        raise UnsupportedRRD("unsupported RRD format")
+    if float_cookie != _FLOAT_COOKIE:
+        raise UnsupportedRRD("RRD file from another architecture")
+
+    offset = _STAT_HEAD.size
+    ds_names = []
+    for _ in range(ds_cnt):
+        ds_names.append(_cstring(_DS_DEF.unpack_from(data, offset)[0]))
+        offset += _DS_DEF.size
+
+    rra_defs = []
+    for _ in range(rra_cnt):
+        (cf_name, row_cnt, pdp_cnt) = _RRA_DEF.unpack_from(data, offset)
+        rra_defs.append((_cstring(cf_name), row_cnt, pdp_cnt))
+        offset += _RRA_DEF.size
+
+    live_head_offset = offset
+    offset += _LIVE_HEAD.size
+    offset += _PDP_PREP_SIZE * ds_cnt
+    offset += _CDP_PREP_SIZE * ds_cnt * rra_cnt
+    rra_ptr_offset = offset
+    offset += _RRA_PTR.size * rra_cnt
+
+    rras = []
+    for (cf_name, row_cnt, pdp_cnt) in rra_defs:
+        rras.append((cf_name, row_cnt, pdp_cnt, offset))
+        offset += row_cnt * ds_cnt * _VALUE_SIZE
+
+    if offset != size:
+        raise UnsupportedRRD("unexpected RRD file size")
+
+    return RRDHeader(tuple(ds_names), pdp_step, rras, live_head_offset,
+                     rra_ptr_offset)
+
+
+def parse_time(spec, now, approximate=False):
+    """Parse time specification
+
+    Only absolute timestamps and "now[+-]<count><unit>" specifications are
+    supported, with units from seconds to weeks. Months and years are
+    supported as 30 and 365 days when ``approximate`` is set, as rrdtool
+    resolves them on the calendar.
+
+    :param str spec: Time specification
+    :param int now: Current timestamp
+    :param bool approximate: Resolve calendar units approximately
+    :return: Timestamp (:class:`int`)
+
+    :raise: UnsupportedRRD if the specification is not supported
+    """
+    spec = str(spec).strip()
+    if spec.isdigit():
+        return int(spec)
+
+    units = _TIME_UNITS
+    if approximate:
+        units = dict(_TIME_UNITS, **_APPROXIMATE_UNITS)
+    match = _TIME_RE.match(spec)
+    if not match or (match.group(3) and match.group(3) not in units):
+        raise UnsupportedRRD("unsupported time specification: {0}".format(
+            spec))
+
+    if not match.group(1):
+        return now
+    offset = int(match.group(2)) * units[match.group(3)]
+    return now + offset if match.group(1) == '+' else now - offset
+
+
+def select_rra(header, cf, start, end, last_up, step=1):
+    """Select archive as rrdtool fetch does
+
+    The archive fully covering the requested window with the step closest
+    to the requested one is preferred, or the one covering the largest part
+    of the window.
+
+    :param RRDHeader header: RRD header
+    :param str cf: Consolidation function
+    :param int start: Window start
+    :param int end: Window end
+    :param int last_up: Last update of the RRD file
+    :param int step: Requested step
+    :return: Selected archive index (:class:`int`)
+
+    :raise: UnsupportedRRD if no archive uses the consolidation function
+    """
+    best_full = None
+    best_part = None
+    for index, (cf_name, row_cnt, pdp_cnt, _) in enumerate(header.rras):
+        if cf_name != cf:
+            continue
+
+        rra_step = header.pdp_step * pdp_cnt
+        cal_end = last_up - last_up % rra_step
+        cal_start = cal_end - rra_step * row_cnt
+        step_diff = abs(step - rra_step)
+
+        if cal_start <= start:
+            if best_full is None or step_diff < best_full[0]:
+                best_full = (step_diff, index)
+        else:
+            match = (end - start) - (cal_start - start)
+            if (best_part is None or match > best_part[0] or
+                    (match == best_part[0] and step_diff < best_part[1])):
+                best_part = (match, step_diff, index)
+
+    if best_full is not None:
+        return best_full[1]
+    if best_part is not None:
+        return best_part[2]
+    raise UnsupportedRRD("no archive for consolidation function {0}".format(
+        cf))
+
+
+def _read_rows(data, rra, cur_row, first, count):
+    """Read archive rows, starting from the oldest ones
+
+    :param data: RRD file content (:class:`mmap.mmap`)
+    :param tuple rra: Archive infos (cf, row_cnt, pdp_cnt, data offset)
+    :param int cur_row: Index of the most recent row
+    :param int first: Index of the first row to read, 0 being the oldest
+    :param int count: Number of rows to read
+    :return: Rows values (:class:`array.array`)
+    """
+    (_, row_cnt, _, offset) = rra
+    values = array.array('d')
+    index = (cur_row + 1 + first) % row_cnt
+    while count > 0:
+        chunk = min(count, row_cnt - index)
+        values.fromstring(data[offset + index * _VALUE_SIZE:
+                               offset + (index + chunk) * _VALUE_SIZE])
+        count -= chunk
+        index = 0
+    return values
+
+
+def _open(path):
+    """Memory-map RRD file and get its header
+
+    :param str path: RRD file path
+    :return: RRD file content and header (:class:`tuple`)
+
+    :raise: UnsupportedRRD if the file layout is not supported
+    """
+    with open(path, 'rb') as rrd_file:
+        stat = os.fstat(rrd_file.fileno())
+        data = mmap.mmap(rrd_file.fileno(), stat.st_size,
+                         access=mmap.ACCESS_READ)
+    try:
+        key = (path, stat.st_ino, stat.st_size)
+        header = _headers.get(key)
+        if header is None:
+            header = parse_header(data, stat.st_size)
+            _headers.set(key, header)
+        if len(header.ds_names) != 1:
+            raise UnsupportedRRD("multiple data sources")
+    except Exception:
+        data.close()
+        raise
+    return data, header
+
+
+def archives(path):
+    """Get RRD file archives layout
+
+    :param str path: RRD file path
+    :return: Last update timestamp and archives as (cf, step, rows)
+    :rtype: tuple
+
+    :raise: UnsupportedRRD if the file layout is not supported
+    """
+    data, header = _open(path)
+    try:
+        last_up = _LIVE_HEAD.unpack_from(data, header.live_head_offset)[0]
+    finally:
+        data.close()
+    return last_up, [(cf_name, header.pdp_step * pdp_cnt, row_cnt)
+                     for (cf_name, row_cnt, pdp_cnt, _) in header.rras]
+
+
+def fetch(path, cf, start, end, now=None, resolution=None):
+    """Fetch data from a single data source RRD file
+
+    Values are returned as rrdtool does: the first value is the one of
+    timestamp ``start + step``, unknown values are NaN.
+
+    :param str path: RRD file path
+    :param str cf: Consolidation function
+    :param str start: Start time
+    :param str end: End time
+    :param int now: Current timestamp, used by relative time specifications
+    :param int resolution: Requested step, as rrdtool fetch -r
+    :return: Fetched range, data source names and values as packed floats
+    :rtype: tuple
+
+    :raise: UnsupportedRRD if the file or the request is not supported
+    """
+    now = int(time.time()) if now is None else now
+    start = parse_time(start, now)
+    end = parse_time(end, now)
+    if start >= end:
+        raise UnsupportedRRD("start must be before end")
+
+    data, header = _open(path)
+    try:
+        last_up = _LIVE_HEAD.unpack_from(data, header.live_head_offset)[0]
+        index = select_rra(header, str(cf), start, end, last_up,
+                           int(resolution or 1))
+        rra = header.rras[index]
+        cur_row = _RRA_PTR.unpack_from(
+            data, header.rra_ptr_offset + _RRA_PTR.size * index)[0]
+
+        step = header.pdp_step * rra[2]
+        start -= start % step
+        end += step - end % step
+        rows = (end - start) // step
+
+        # row 0 (the oldest) holds the value of timestamp cal_start + step
+        row_cnt = rra[1]
+        cal_end = last_up - last_up % step
+        cal_start = cal_end - step * row_cnt
+        first = (start - cal_start) // step
+        before = min(rows, max(0, -first))
+        after = min(rows - before, max(0, (end - cal_end) // step))
+        count = rows - before - after
+
+        values = array.array('d', [float('nan')]) * before
+        if count > 0:
+            values.extend(_read_rows(data, rra, cur_row, first + before,
+                                     count))
+        values.extend(array.array('d', [float('nan')]) * after)
+    finally:
+        data.close()
+
+    return ((start, end, step), header.ds_names, values)
@@ -28,14 +28,97 @@
 
 import os
 import re
+import time
+import array
+import socket
+import marshal
 import logging
 import rrdtool
+import threading
 
+from dispytch import cache
+from dispytch import metrics
+from dispytch import profiling
+from dispytch import utils
 
-_log = logging.getLogger("dispytch")
+from . import rrd_reader, rrdcached
 
 
-def fetch_rrd(path, cf, start, end, opts=[]):
+_log = logging.getLogger("dispytch.munin.rrd")
+
+# RRD reader in use, "rrdtool" or "native"
+READER = "rrdtool"
+
+# rrdcached client flushing RRD files before fetching them
+DAEMON = None
+
+# seconds fetched RRD windows are kept in dispytch cache
+CACHE_TTL = 0
+
+# maximum number of concurrent RRD fetches of a node-wide request
+FETCH_WORKERS = 8
+
+# in-flight fetches, identical concurrent fetches are coalesced
+_fetches = utils.SingleFlight('rrd_fetch')
+
+# threads fetching the RRD files of node-wide requests, shared by requests
+_fetch_pool = utils.WorkerPool(FETCH_WORKERS)
+
+# rrdtool bindings are not documented as thread-safe, calls are serialized
+_rrdtool_lock = threading.Lock()
+
+
+def configure(reader=None, daemon=None, cache_ttl=None, fetch_workers=None):
+    """Configure RRD utilities
+
+    The rrdcached client is kept while its address does not change, so its
+    connection is reused across requests.
+
+    :param str reader: RRD reader to use, "rrdtool" or "native"
+    :param str daemon: rrdcached address, as accepted by rrdtool --daemon
+    :param int cache_ttl: Seconds fetched windows are cached, 0 disables
+    :param int fetch_workers: Maximum number of concurrent fetches of
+                              node-wide requests
+    """
+    global READER, DAEMON, CACHE_TTL, FETCH_WORKERS, _fetch_pool
+    reader = reader or "rrdtool"
+    if reader not in ("rrdtool", "native"):
+        raise RuntimeError("unknown RRD reader: {0}".format(reader))
+    READER = reader
+    CACHE_TTL = int(cache_ttl or 0)
+    FETCH_WORKERS = max(1, int(fetch_workers or 8))
+    if _fetch_pool.size != FETCH_WORKERS:
+        _fetch_pool = utils.WorkerPool(FETCH_WORKERS)
+
+    if not daemon:
+        if DAEMON is not None:
+            DAEMON.close()
+        DAEMON = None
+    elif DAEMON is None or DAEMON.address != daemon:
+        if DAEMON is not None:
+            DAEMON.close()
+        DAEMON = rrdcached.RRDCachedClient(daemon)
+
+
+def flush_rrds(paths):
+    """Flush pending updates of RRD files through rrdcached
+
+    Fetching stale data is preferred to failing the request when rrdcached
+    is not reachable.
+
+    :param list paths: RRD files paths
+    """
+    if DAEMON is None or not paths:
+        return
+    with profiling.timed('munin.rrd_flush'):
+        try:
+            DAEMON.flush(paths)
+        except (socket.error, rrdcached.RRDCachedError, ValueError) as exc:
+            _log.warning("unable to flush RRD files through rrdcached at "
+                         "%s: %s", DAEMON.address, exc)
+
+
+def fetch_rrd(path, cf, start, end, opts=[], resolution=None):
     """Fetch informations from rrd file
 
     :param str path: RRD file path
@@ -43,96 +126,436 @@ def fetch_rrd(path, cf, start, end, opts=[]):
     :param str start: Start time
     :param str end: End time
     :param list opts: Additional arguments to pass to rrdtool
+    :param int resolution: Requested step (rrdtool -r option)
 
     :return: RRD fetched data
     :rtype: list
+
+    Using the native reader, values are returned as a packed array of floats
+    with NaN for unknown values. Requests not supported by the native reader
+    fall back to rrdtool. Identical concurrent fetches share their result,
+    which must not be modified.
+
+    Fetched windows are kept in dispytch cache until the RRD file changes,
+    at most for CACHE_TTL seconds as relative windows move with time.
+    """
+    key = (path, str(cf), str(start), str(end), tuple(opts), resolution)
+    return _fetches.do(key, _fetch_rrd, path, cf, start, end, opts,
+                       resolution)
+
+
+def _encode_window(rrd_datas):
+    """Encode fetched RRD data for dispytch cache
+
+    Values are packed as floats, NaN for unknown values.
+
+    :param list rrd_datas: RRD fetched data
+    :return: Encoded data (:class:`str`)
+    """
+    (timeinfo, names, values) = rrd_datas
+    native = isinstance(values, array.array)
+    if not native:
+        values = array.array('d', [float('nan') if val is None else val
+                                   for vals in values for val in vals])
+    return marshal.dumps((tuple(timeinfo), tuple(names), native,
+                          values.tostring()))
+
+
+def _decode_window(data):
+    """Decode fetched RRD data from dispytch cache
+
+    :param str data: Encoded data
+    :return: RRD fetched data (:class:`tuple`)
+    """
+    (timeinfo, names, native, packed) = marshal.loads(data)
+    values = array.array('d')
+    values.fromstring(packed)
+    # single data source windows are kept packed, as native reader ones
+    if not native and len(names) > 1:
+        width = len(names)
+        values = [tuple(None if val != val else val
+                        for val in values[idx:idx + width])
+                  for idx in range(0, len(values), width)]
+    return (timeinfo, names, values)
+
+
+def _fetch_rrd(path, cf, start, end, opts, resolution):
+    """Fetch informations from rrd file, see :func:`fetch_rrd`
+    """
+    cache_key = None
+    if CACHE_TTL:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            pass
+        else:
+            cache_key = repr((path, stat.st_ino, stat.st_mtime, str(cf),
+                              str(start), str(end), tuple(opts), resolution))
+            cached = cache.get('munin_rrd_windows', cache_key)
+            if cached is not None:
+                return _decode_window(cached)
+
+    rrd_datas = _read_rrd(path, cf, start, end, opts, resolution)
+    if cache_key is not None:
+        cache.put('munin_rrd_windows', cache_key, _encode_window(rrd_datas),
+                  CACHE_TTL)
+    return rrd_datas
+
+
+def _read_rrd(path, cf, start, end, opts, resolution):
+    """Read informations from rrd file, see :func:`fetch_rrd`
     """
+    metrics.RRD_FETCHES.inc()
+    if READER == "native" and not opts:
+        try:
+            with profiling.timed('munin.rrd_fetch'):
+                return rrd_reader.fetch(path, cf, start, end,
+                                        resolution=resolution)
+        except rrd_reader.UnsupportedRRD as exc:
+            _log.debug("native reader fallback for %s: %s", path, exc)
+
     args = [path,
             str(cf),
             "-s", str(start),
             "-e", str(end),
             ]
+    if resolution:
+        args.extend(["-r", str(resolution)])
     args.extend(opts)
-    return rrdtool.fetch(args)
+    with profiling.timed('munin.rrd_fetch'), _rrdtool_lock:
+        return rrdtool.fetch(args)
 
 
-def get_rrd_metrics(path, cf, start, end, opts=[]):
-    """Get transformed metrics from rrd file
+def get_rrd_archives(path, cf):
+    """Get RRD file archives using a consolidation function
+
+    Only the archive with the most rows is kept for each step.
 
     :param str path: RRD file path
-    :param str cf: RRD consolidation function to use
-    :param str start: Start time
-    :param str end: End time
-    :param list opts: Additional arguments to pass to rrdtool
+    :param str cf: RRD consolidation function
 
-    :return: Structured RRD fetched data
-    :rtype: dict
+    :return: Last update timestamp and archives as (step, rows) sorted by step
+    :rtype: tuple
     """
-    rrd_datas = fetch_rrd(path, cf, start, end)
-    _log.debug("fetched RRD data infos: {0}".format(rrd_datas[0]))
-    _log.debug("fetched RRD data series: {0}".format(len(rrd_datas[1])))
+    layout = None
+    if READER == "native":
+        try:
+            layout = rrd_reader.archives(path)
+        except rrd_reader.UnsupportedRRD as exc:
+            _log.debug("native reader fallback for %s: %s", path, exc)
+
+    if layout is None:
+        with _rrdtool_lock:
+            info = rrdtool.info(path)
+        rras = []
+        idx = 0
+        while 'rra[{0}].cf'.format(idx) in info:
+            rra = 'rra[{0}].'.format(idx)
+            rras.append((info[rra + 'cf'],
+                         info['step'] * info[rra + 'pdp_per_row'],
+                         info[rra + 'rows']))
+            idx += 1
+        layout = (info['last_update'], rras)
+
+    (last_up, rras) = layout
+    archives = {}
+    for (rra_cf, step, rows) in rras:
+        if rra_cf == cf and rows > archives.get(step, 0):
+            archives[step] = rows
+    return last_up, sorted(archives.items())
+
+
+def stitch_segments(archives, last_up, start, end):
+    """Split a time window across archives resolutions
+
+    Each archive serves the part of the window it covers which is not served
+    by a finer archive. Boundaries are aligned on the coarser archive step.
+
+    :param list archives: Archives as (step, rows) sorted by step
+    :param int last_up: RRD file last update timestamp
+    :param int start: Window start timestamp
+    :param int end: Window end timestamp
+
+    :return: Segments as (start, end, step), oldest first (:class:`list`)
+    """
+    segments = []
+    cursor = end
+    for idx, (step, rows) in enumerate(archives):
+        if idx + 1 < len(archives):
+            covered = last_up - last_up % step - step * rows
+            coarser = archives[idx + 1][0]
+            boundary = max(start, -(-covered // coarser) * coarser)
+        else:
+            boundary = start
+
+        if boundary < cursor:
+            segments.append((boundary, cursor, step))
+            cursor = boundary
+        if cursor <= start:
+            break
+
+    segments.reverse()
+    return segments
+
+
+def _build_series(rrd_datas, until=None, packed=False):
+    """Build series from fetched RRD data
+
+    Packed series keep fetched values buffers as data points, see
+    :class:`dispytch.utils.PackedPoints`, instead of lists of points.
+
+    :param list rrd_datas: RRD fetched data
+    :param int until: Exclusive limit of data points timestamps, in seconds
+    :param bool packed: Build packed series
+
+    :return: Structured RRD fetched data (:class:`list`)
+    """
+    _log.debug("fetched RRD data infos: %s", rrd_datas[0])
+    _log.debug("fetched RRD data series: %s", len(rrd_datas[1]))
 
     (starttime, stoptime, step) = rrd_datas[0]
     names = rrd_datas[1]
     values = rrd_datas[2]
+    if until is not None:
+        values = values[:max(0, (until - starttime + step - 1) // step)]
 
-    # Munin daemon caches some data and RRD datas is not so fresh
+    # Munin daemon caches some data and RRD datas is not so fresh, unless
+    # flushed through rrdcached (see flush_rrds)
     # Skip None values (which have not been flushed yet)
     # Timestamps are returned as ms so with are compliant with most of graphing
     # systems (like Highcharts for example)
     # returned series must be of the form:
     #   [[time, val], [time, val], [time, val], ...]
+    if packed:
+        if not isinstance(values, array.array):
+            columns = zip(*values) or [()] * len(names)
+            columns = [array.array('d', [float('nan') if val is None else val
+                                         for val in column])
+                       for column in columns]
+        else:
+            columns = [values]
+        return [{'name': name, 'data': utils.PackedPoints(starttime, step,
+                                                         column)}
+                for (name, column) in zip(names, columns)]
+
     series = []
     for name in names:
         series.append({'name': name, 'data': []})
 
-    for vidx, vals in enumerate(values):
-        for idx, val in enumerate(vals):
-            if val is not None:
-                series[idx]['data'].append(
-                        ((starttime + step * vidx) * 1000, val))
+    if isinstance(values, array.array):
+        # packed values from the native reader, unknown values are NaN
+        data = series[0]['data']
+        for vidx, val in enumerate(values):
+            if val == val:
+                data.append(((starttime + step * vidx) * 1000, val))
+    else:
+        for vidx, vals in enumerate(values):
+            for idx, val in enumerate(vals):
+                if val is not None:
+                    series[idx]['data'].append(
+                            ((starttime + step * vidx) * 1000, val))
 
-    for idx, serie in enumerate(series):
-        _log.debug("serie {0} RRD data points: {1}".format(idx,
-                                                           len(serie['data'])))
+    if _log.isEnabledFor(logging.DEBUG):
+        for idx, serie in enumerate(series):
+            _log.debug("serie %s RRD data points: %s", idx, len(serie['data']))
     return series
 
 
-def get_munin_entry_metrics(datadir, node, datatype, cf, start, end, opts=[]):
-    """Get transformed RRD metrics from munin node
+def get_rrd_metrics(path, cf, start, end, opts=[], packed=False):
+    """Get transformed metrics from rrd file
 
-    :param str datadir: Directory containing Munin node's RRDs
-    :param str node: Munin node name
+    :param str path: RRD file path
     :param str cf: RRD consolidation function to use
     :param str start: Start time
     :param str end: End time
     :param list opts: Additional arguments to pass to rrdtool
+    :param bool packed: Keep fetched values buffers as data points
 
-    :return: Structured RRD fetched data (:class:`dict`)
+    :return: Structured RRD fetched data
+    :rtype: dict
+    """
+    return _build_series(fetch_rrd(path, cf, start, end), packed=packed)
+
+
+def get_stitched_rrd_metrics(path, cf, start, end):
+    """Get transformed metrics from rrd file, stitching archives
+
+    The finest archive serves the recent part of the window and coarser
+    archives the older parts. Each serie lists its segments with their
+    step, timestamps in ms as data points.
+
+    :param str path: RRD file path
+    :param str cf: RRD consolidation function to use
+    :param str start: Start time
+    :param str end: End time
+
+    :return: Structured RRD fetched data
+    :rtype: dict
+    """
+    now = int(time.time())
+    try:
+        start = rrd_reader.parse_time(start, now)
+        end = rrd_reader.parse_time(end, now)
+    except rrd_reader.UnsupportedRRD as exc:
+        # time specifications relative to each other are left to rrdtool
+        _log.debug("unable to stitch archives: %s", exc)
+        segments = []
+    else:
+        (last_up, archives) = get_rrd_archives(path, str(cf))
+        segments = stitch_segments(archives, last_up, start, end)
+
+    if len(segments) < 2:
+        rrd_datas = fetch_rrd(path, cf, start, end)
+        series = _build_series(rrd_datas)
+        (seg_start, seg_end, step) = rrd_datas[0]
+        for serie in series:
+            serie['segments'] = [{'start': seg_start * 1000,
+                                  'end': seg_end * 1000,
+                                  'step': step}]
+        return series
+
+    series = None
+    for idx, (seg_start, seg_end, step) in enumerate(segments):
+        rrd_datas = fetch_rrd(path, cf, seg_start, seg_end, resolution=step)
+        last = idx == len(segments) - 1
+        seg_series = _build_series(rrd_datas, None if last else seg_end)
+        segment = {'start': seg_start * 1000,
+                   'end': seg_end * 1000,
+                   'step': rrd_datas[0][2]}
+        if series is None:
+            series = seg_series
+            for serie in series:
+                serie['segments'] = [segment]
+            continue
+        for serie, seg_serie in zip(series, seg_series):
+            serie['data'].extend(seg_serie['data'])
+            serie['segments'].append(segment)
+    return series
+
+
+# munin RRD files are named <host>-<datatype>-<datasubtype>-<X>.rrd, where
+# <host> may contain dashes but <datasubtype> cannot
+_RRD_NAME_RE = re.compile(r"^(.+)-([^-]+)-.\.rrd$")
+
+# RRD files indexes of munin directories, by directory
+_directories = utils.LRUCache(1024, 'munin_rrd_dirs')
+
+
+def index_rrd_directory(rrdstore):
+    """Index RRD files of a munin directory
+
+    Indexes are kept until the directory is modified, so that the directory
+    is not listed for each request.
+
+    :param str rrdstore: Munin RRD files directory
+    :return: RRD files paths by subtype, by "<host>-<datatype>" prefix
+    :rtype: dict
+    """
+    mtime = os.stat(rrdstore).st_mtime
+    cached = _directories.get(rrdstore)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    index = {}
+    with profiling.timed('munin.rrd_scan'):
+        for rrdfile in os.listdir(rrdstore):
+            match = _RRD_NAME_RE.match(rrdfile)
+            if match:
+                (prefix, subtype) = match.groups()
+                index.setdefault(prefix, {})[subtype] = os.path.join(
+                    rrdstore, rrdfile)
+    _directories.set(rrdstore, (mtime, index))
+    return index
+
+
+def find_munin_rrds(datadir, node, datatype):
+    """Find RRD files of a munin node datatype
+
+    :param str datadir: Directory containing Munin node's RRDs
+    :param str node: Munin node name
+    :param str datatype: Munin datatype
+
+    :return: RRD files paths by datatype subtype (:class:`dict`)
     """
-    # munin RRD files comonly are: <host>-<datatype>-<datasubtype>-<X>.rrd
-    # where <host> can contain dashes (-)
-    # and <datasubtype> cannot contain dashes (-)
-    # selection is made against: <host>-<datatype>-[^-]+-x.rrd
     rrdpath = "/".join(node.split(';')[:-1])
     host = node.split(';')[-1]
     rrdstore = os.path.join(datadir, rrdpath)
 
-    subtype_pattern = r"{0}-{1}-([^-]+)-.\.rrd".format(host, datatype)
-    subtype_re = re.compile(subtype_pattern)
+    _log.debug("rrdstore: %s", rrdstore)
+    rrd_candidates = dict(index_rrd_directory(rrdstore).get(
+        "{0}-{1}".format(host, datatype), {}))
+
+    _log.debug("selected rrds: %s", rrd_candidates)
+    return rrd_candidates
+
+
+def find_node_rrds(datadir, node, datatypes):
+    """Find RRD files of munin node datatypes, in one directory pass
+
+    :param str datadir: Directory containing Munin node's RRDs
+    :param str node: Munin node name
+    :param list datatypes: Munin datatypes
+
+    :return: RRD files paths by subtype, by datatype (:class:`dict`)
+    """
+    rrdstore = os.path.join(datadir, "/".join(node.split(';')[:-1]))
+    host = node.split(';')[-1]
+    index = index_rrd_directory(rrdstore)
+
+    rrds = {}
+    for datatype in datatypes:
+        found = index.get("{0}-{1}".format(host, datatype))
+        if found:
+            rrds[datatype] = dict(found)
+    return rrds
+
 
-    _log.debug("rrdstore: ".format(rrdstore))
+def _get_munin_serie(subtype, rrdfile, cf, start, end, stitch=False,
+                     packed=False):
+    """Get transformed RRD metrics of a munin RRD file
 
-    rrd_candidates = {}
-    for rrdfile in os.listdir(rrdstore):
-        subtype = subtype_re.match(rrdfile)
-        if subtype:
-            subtype_name = subtype.groups()[0]
-            rrd_candidates.update({
-                subtype_name: os.path.join(rrdstore, rrdfile)
-                })
+    :param str subtype: Munin datatype subtype
+    :param str rrdfile: RRD file path
+    :param str cf: RRD consolidation function to use
+    :param str start: Start time
+    :param str end: End time
+    :param bool stitch: Stitch archives resolutions
+    :param bool packed: Keep fetched values buffers as data points, unless
+                        stitching archives
+
+    :return: Serie (:class:`dict`) or :obj:`None` if not a munin RRD file
+    """
+    if stitch:
+        rrd_metrics = get_stitched_rrd_metrics(rrdfile, cf, start, end)
+    else:
+        rrd_metrics = get_rrd_metrics(rrdfile, cf, start, end, packed=packed)
 
-    _log.debug("selected rrds: {0}".format(rrd_candidates))
+    # munin rrd only contains one field named "42", check it, or skip
+    if len(rrd_metrics) > 1 or rrd_metrics[0]['name'] != "42":
+        return None
+
+    rrd_metrics[0]['name'] = subtype
+    return rrd_metrics[0]
+
+
+def get_munin_entry_metrics(datadir, node, datatype, cf, start, end, opts=[],
+                            stitch=False, packed=False):
+    """Get transformed RRD metrics from munin node
+
+    :param str datadir: Directory containing Munin node's RRDs
+    :param str node: Munin node name
+    :param str cf: RRD consolidation function to use
+    :param str start: Start time
+    :param str end: End time
+    :param list opts: Additional arguments to pass to rrdtool
+    :param bool stitch: Stitch archives resolutions (see
+                        :func:`get_stitched_rrd_metrics`)
+    :param bool packed: Keep fetched values buffers as data points
+
+    :return: Structured RRD fetched data (:class:`dict`)
+    """
+    rrd_candidates = find_munin_rrds(datadir, node, datatype)
+    flush_rrds(list(rrd_candidates.values()))
 
     # returned series must be under the form:
     #   series = [{'name': "serieA",
@@ -145,14 +568,53 @@ def get_munin_entry_metrics(datadir, node, datatype, cf, start, end, opts=[]):
     # munin's rrd contains only one field, so we aggregate multiple RRD data
     series = []
     for subtype, rrdfile in rrd_candidates.items():
-        rrd_metrics = get_rrd_metrics(rrdfile, cf, start, end)
+        serie = _get_munin_serie(subtype, rrdfile, cf, start, end, stitch,
+                                 packed)
+        if serie is not None:
+            series.append(serie)
 
-        # munin rrd only contains one field named "42", check it, or skip
-        if len(rrd_metrics) > 1 or rrd_metrics[0]['name'] != "42":
-            continue
+    return {node: {datatype: series}}
 
-        serie = {'name': subtype, 'data': rrd_metrics[0]['data']}
-        series.append(serie)
 
-    return {node: {datatype: series}}
+def get_munin_node_metrics(datadir, node, datatypes, cf, start, end,
+                           stitch=False, packed=False):
+    """Get transformed RRD metrics of several datatypes from munin node
+
+    RRD files are found in one pass of the node directory, flushed at once
+    and fetched concurrently by the threads pool shared by requests. Files
+    falling back to rrdtool are fetched one at a time. Datatypes whose files
+    fail to be fetched are reported as errors.
+
+    :param str datadir: Directory containing Munin node's RRDs
+    :param str node: Munin node name
+    :param list datatypes: Munin datatypes
+    :param str cf: RRD consolidation function to use
+    :param str start: Start time
+    :param str end: End time
+    :param bool stitch: Stitch archives resolutions
+    :param bool packed: Keep fetched values buffers as data points
+
+    :return: Structured RRD fetched data and errors by datatype
+    :rtype: tuple
+    """
+    rrds = find_node_rrds(datadir, node, datatypes)
+    files = [(datatype, subtype, rrdfile)
+             for (datatype, subtypes) in sorted(rrds.items())
+             for (subtype, rrdfile) in sorted(subtypes.items())]
+    flush_rrds([rrdfile for (_, _, rrdfile) in files])
+
+    with profiling.timed('munin.node_fetch'):
+        results = _fetch_pool.map(
+            lambda entry: _get_munin_serie(entry[1], entry[2], cf, start,
+                                           end, stitch, packed),
+            files)
 
+    series = dict((datatype, []) for datatype in rrds)
+    errors = {}
+    for ((datatype, subtype, rrdfile), serie) in zip(files, results):
+        if isinstance(serie, Exception):
+            _log.warning("unable to fetch %s: %s", rrdfile, serie)
+            errors[datatype] = str(serie)
+        elif serie is not None:
+            series[datatype].append(serie)
+    return ({node: series}, errors)
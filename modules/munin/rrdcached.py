@@ -0,0 +1,170 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program; if not, see <http://www.gnu.org/licenses/>.
+
+"""rrdcached client
+
+Munin pollers may write RRD files through rrdcached, recent updates then
+stay in the daemon cache until flushed. This client keeps a connection to
+the daemon across fetches and flushes every RRD file of a request at once
+(commands are pipelined) before reading them.
+"""
+
+
+import os
+import socket
+import logging
+import threading
+
+
+_log = logging.getLogger("dispytch.munin.rrd")
+
+DEFAULT_PORT = 42217
+
+
+class RRDCachedError(Exception):
+    """rrdcached communication error
+    """
+
+
+def parse_address(address):
+    """Parse rrdcached address as accepted by rrdtool --daemon
+
+    :param str address: "unix:<path>", "<path>" or "<host>[:<port>]"
+    :return: Socket family and address (:class:`tuple`)
+    """
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    if address.startswith('/'):
+        return socket.AF_UNIX, address
+
+    if address.startswith('['):
+        host, _, port = address[1:].partition(']')
+        port = port.lstrip(':') or DEFAULT_PORT
+    elif address.count(':') == 1:
+        host, port = address.split(':')
+    else:
+        host, port = address, DEFAULT_PORT
+
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    return family, (host, int(port))
+
+
+class RRDCachedClient(object):
+    """rrdcached client keeping its connection across requests
+    """
+
+    def __init__(self, address, timeout=5.0):
+        """Initialization method
+
+        :param str address: rrdcached address
+        :param float timeout: Socket timeout in seconds
+        """
+        self.address = address
+        self.timeout = timeout
+        self._family, self._sockaddr = parse_address(address)
+        self._sock = None
+        self._reader = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Connect to rrdcached, once per process
+        """
+        if self._sock is not None and self._pid == os.getpid():
+            return
+        self.close()
+        sock = socket.socket(self._family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self._sockaddr)
+        except socket.error:
+            sock.close()
+            raise
+        self._sock = sock
+        self._reader = sock.makefile('rb')
+        self._pid = os.getpid()
+        _log.debug("connected to rrdcached at %s", self.address)
+
+    def close(self):
+        """Close connection to rrdcached
+        """
+        if self._sock is not None and self._pid == os.getpid():
+            self._reader.close()
+            self._sock.close()
+        self._sock = None
+        self._reader = None
+
+    def _read_response(self):
+        """Read a command response
+
+        :return: Response status and message (:class:`tuple`)
+        """
+        line = self._reader.readline()
+        if not line:
+            raise RRDCachedError("connection closed by rrdcached")
+        status, _, message = line.rstrip('\n').partition(' ')
+        status = int(status)
+        # positive status announces as many additional lines
+        for _ in range(max(0, status)):
+            self._reader.readline()
+        return status, message
+
+    def _pipeline(self, commands):
+        """Send commands at once and read their responses
+
+        :param list commands: Commands lines
+        :return: Responses (:class:`list`)
+        """
+        self._connect()
+        self._sock.sendall("".join("{0}\n".format(command)
+                                   for command in commands))
+        return [self._read_response() for _ in commands]
+
+    def flush(self, paths):
+        """Flush RRD files pending updates
+
+        Commands are pipelined, a broken connection is reopened once.
+        Files unknown to rrdcached have nothing to flush and are ignored.
+
+        :param list paths: RRD files paths
+        """
+        commands = ["FLUSH {0}".format(path) for path in paths]
+        if not commands:
+            return
+        with self._lock:
+            try:
+                try:
+                    responses = self._pipeline(commands)
+                except (socket.error, RRDCachedError) as exc:
+                    _log.debug("rrdcached connection lost: %s", exc)
+                    self.close()
+                    responses = self._pipeline(commands)
+            except (socket.error, RRDCachedError, ValueError):
+                self.close()
+                raise
+
+        if _log.isEnabledFor(logging.DEBUG):
+            for path, (status, message) in zip(paths, responses):
+                if status < 0:
+                    _log.debug("rrdcached flush of %s: %s", path, message)
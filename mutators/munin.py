@@ -27,10 +27,16 @@
 
 import os
 import sys
+import csv
+import json
+import math
+import heapq
 import logging
+import cStringIO
+import collections
 
 
-_log = logging.getLogger("dispytch")
+_log = logging.getLogger("dispytch.mutators.munin")
 
 
 # Meaningful series
@@ -147,6 +153,260 @@ def __aggregate_series(data):
     return aggregated_series
 
 
+def __nodes_series(data):
+    """Get series by node and datatype of a munin response
+
+    Node-wide ("all") responses hold them along with the node graphs infos.
+
+    :param dict data: Munin response
+    :return: Nodes RRD series (:class:`dict`)
+    """
+    if sorted(data) == ['info', 'series']:
+        return data['series']
+    return data
+
+
+def __export_series(data):
+    """List series of nodes and datatypes to export
+
+    :param dict data: Nodes RRD series
+    :return: Exported name and serie (:class:`generator`)
+    """
+    for node in sorted(data):
+        for datatype in sorted(data[node]):
+            for serie in data[node][datatype]:
+                yield ("{0}/{1}/{2}".format(node, datatype, serie['name']),
+                       serie)
+
+
+def __indexed_points(idx, data):
+    """Tag serie data points with the serie index
+
+    :param int idx: Serie index
+    :param list data: Serie data points
+    :return: Timestamp, index and value (:class:`generator`)
+    """
+    for point in data:
+        yield (point[0], idx, point[1])
+
+
+def __chunked(lines, size=65536):
+    """Group exported lines in chunks written at once to the response
+
+    :param iterator lines: Exported lines
+    :param int size: Minimum chunks size in bytes
+    :return: Response chunks (:class:`generator`)
+    """
+    (chunk, length) = ([], 0)
+    for line in lines:
+        chunk.append(line)
+        length += len(line)
+        if length >= size:
+            yield ''.join(chunk)
+            (chunk, length) = ([], 0)
+    if chunk:
+        yield ''.join(chunk)
+
+
+def __average(values):
+    """Average of values
+
+    :param list values: Values
+    :return: Average value (:class:`float`)
+    """
+    return float(sum(values)) / len(values)
+
+
+__DOWNSAMPLE_REDUCERS = {
+    'average': __average,
+    'min': min,
+    'max': max,
+    }
+
+
+def transform_downsample(series, points=800, method="average"):
+    """Downsample series to a maximum number of points
+
+    Consecutive data points are grouped and each group is reduced to its
+    first timestamp and the average, min or max of its values.
+
+    :param iterator series: RRD series
+    :param int points: Maximum number of points per serie
+    :param str method: Reduction method, "average", "min" or "max"
+    :return: Downsampled RRD series (:class:`generator`)
+    """
+    if method not in __DOWNSAMPLE_REDUCERS:
+        raise ValueError("unknown downsample method: {0}".format(method))
+    reduce_values = __DOWNSAMPLE_REDUCERS[method]
+
+    for serie in series:
+        data = serie['data']
+        if points > 0 and len(data) > points:
+            size = -(-len(data) // points)
+            serie = dict(serie, data=[
+                (data[idx][0],
+                 reduce_values([point[1] for point in data[idx:idx + size]]))
+                for idx in range(0, len(data), size)])
+        yield serie
+
+
+def transform_rate(series, per=1, nonnegative=False):
+    """Derive series values
+
+    Each data point is replaced by the variation from the previous one,
+    divided by the elapsed time. Series from Munin DERIVE and COUNTER
+    datasources already are rates, use this on GAUGE counters.
+
+    :param iterator series: RRD series
+    :param int per: Rate period in seconds
+    :param bool nonnegative: Drop negative rates (counters resets)
+    :return: Derived RRD series (:class:`generator`)
+    """
+    for serie in series:
+        derived = []
+        previous = None
+        for point in serie['data']:
+            if previous is not None and point[0] > previous[0]:
+                # timestamps are in ms
+                rate = ((point[1] - previous[1]) * 1000.0 * per /
+                        (point[0] - previous[0]))
+                if rate >= 0 or not nonnegative:
+                    derived.append((point[0], rate))
+            previous = point
+        yield dict(serie, data=derived)
+
+
+def transform_moving_average(series, window=5):
+    """Smooth series with a moving average
+
+    :param iterator series: RRD series
+    :param int window: Number of data points averaged
+    :return: Smoothed RRD series (:class:`generator`)
+    """
+    if window < 1:
+        raise ValueError("moving average window must be positive")
+    for serie in series:
+        smoothed = []
+        values = collections.deque()
+        total = 0.0
+        for point in serie['data']:
+            values.append(point[1])
+            total += point[1]
+            if len(values) > window:
+                total -= values.popleft()
+            smoothed.append((point[0], total / len(values)))
+        yield dict(serie, data=smoothed)
+
+
+def transform_ewma(series, alpha=0.3):
+    """Smooth series with an exponentially weighted moving average
+
+    :param iterator series: RRD series
+    :param float alpha: Smoothing factor, between 0 and 1
+    :return: Smoothed RRD series (:class:`generator`)
+    """
+    if not 0 < alpha <= 1:
+        raise ValueError("ewma alpha must be between 0 and 1")
+    for serie in series:
+        smoothed = []
+        average = None
+        for point in serie['data']:
+            if average is None:
+                average = point[1]
+            else:
+                average += alpha * (point[1] - average)
+            smoothed.append((point[0], average))
+        yield dict(serie, data=smoothed)
+
+
+def __rolling_extremum(data, window, keep):
+    """Rolling extremum of data points values
+
+    Candidates values are kept in a monotonic queue, so that each data point
+    is handled once.
+
+    :param list data: Serie data points
+    :param int window: Number of data points in the rolling window
+    :param keep: Function telling if a candidate beats a new value
+    :return: Rolling extremum data points (:class:`list`)
+    """
+    if window < 1:
+        raise ValueError("rolling window must be positive")
+    rolled = []
+    candidates = collections.deque()
+    for idx, point in enumerate(data):
+        while candidates and not keep(candidates[-1][1], point[1]):
+            candidates.pop()
+        candidates.append((idx, point[1]))
+        if candidates[0][0] <= idx - window:
+            candidates.popleft()
+        rolled.append((point[0], candidates[0][1]))
+    return rolled
+
+
+def transform_rolling_min(series, window=5):
+    """Rolling minimum of series
+
+    :param iterator series: RRD series
+    :param int window: Number of data points in the rolling window
+    :return: RRD series rolling minimums (:class:`generator`)
+    """
+    for serie in series:
+        yield dict(serie, data=__rolling_extremum(
+            serie['data'], window, lambda kept, new: kept < new))
+
+
+def transform_rolling_max(series, window=5):
+    """Rolling maximum of series
+
+    :param iterator series: RRD series
+    :param int window: Number of data points in the rolling window
+    :return: RRD series rolling maximums (:class:`generator`)
+    """
+    for serie in series:
+        yield dict(serie, data=__rolling_extremum(
+            serie['data'], window, lambda kept, new: kept > new))
+
+
+def transform_percentiles(series, period=3600, percentiles="50:95"):
+    """Percentiles of series over time windows
+
+    Data points are grouped in windows of ``period`` seconds, each serie is
+    replaced by one serie per percentile (nearest rank), named
+    "<serie> p<percentile>", with a data point per window.
+
+    :param iterator series: RRD series
+    :param int period: Windows length in seconds
+    :param str percentiles: Percentiles separated by ":"
+    :return: RRD series percentiles (:class:`generator`)
+    """
+    try:
+        ranks = [float(rank) for rank in percentiles.split(':')]
+    except ValueError:
+        raise ValueError("invalid percentiles: {0}".format(percentiles))
+    if period < 1 or not all(0 < rank <= 100 for rank in ranks):
+        raise ValueError("invalid percentiles period or ranks")
+
+    for serie in series:
+        windows = collections.OrderedDict()
+        for point in serie['data']:
+            start = point[0] - point[0] % (period * 1000)
+            windows.setdefault(start, []).append(point[1])
+
+        bands = [[] for _ in ranks]
+        for start, values in windows.items():
+            values.sort()
+            for idx, rank in enumerate(ranks):
+                position = max(0, int(math.ceil(rank * len(values) / 100)) - 1)
+                bands[idx].append((start, values[position]))
+
+        for rank, data in zip(ranks, bands):
+            band = dict(serie)
+            band['name'] = "{0} p{1:g}".format(serie['name'], rank)
+            band['data'] = data
+            yield band
+
+
 def mutate_to_highcharts_pie(module_name, info, series):
     """Mutate raw RRD series to pie structured series
 
@@ -182,7 +442,7 @@ def mutate_to_highcharts(module_name, info, data, options=None):
     _log.debug('mutating series')
 
     if module_name != "munin":
-        _log.debug('series from unhandled module {0}'.format(module_name))
+        _log.debug('series from unhandled module %s', module_name)
         _log.debug('skipping series mutation')
         return series
 
@@ -224,7 +484,7 @@ def mutate_to_highcharts(module_name, info, data, options=None):
     series_to_negate = []
     stacks = {}
     for serie in series:
-        _log.debug("extending serie: {0} (pass#1)".format(serie['name']))
+        _log.debug("extending serie: %s (pass#1)", serie['name'])
         s_info = info.get(serie['name'], {})
 
         # specific for "df*" plugins with wrong labels
@@ -240,7 +500,8 @@ def mutate_to_highcharts(module_name, info, data, options=None):
             if prev_name not in stacks:
                 stacks[prev_name] = {'stack': prev_name,
                                      'stacking': 'normal'}
-            s_info['draw'] = prev_draw
+            # graphs infos are shared, they are not modified
+            s_info = dict(s_info, draw=prev_draw)
             stacks[serie['name']] = stacks[prev_name]
         else:
             (prev_name, prev_draw) = (serie['name'], s_info.get('draw'))
@@ -250,7 +511,7 @@ def mutate_to_highcharts(module_name, info, data, options=None):
 
     # Loop on series to apply "stack" and "negate" extensions
     for serie in series:
-        _log.debug("extending serie: {0} (pass#2)".format(serie['name']))
+        _log.debug("extending serie: %s (pass#2)", serie['name'])
 
         if serie['name'] in stacks:
             serie.update(stacks[serie['name']])
@@ -261,3 +522,83 @@ def mutate_to_highcharts(module_name, info, data, options=None):
         mutated_series['series'].append(serie)
 
     return mutated_series
+
+
+def __csv_lines(data):
+    """Export series as CSV lines
+
+    :param dict data: Nodes RRD series
+    :return: CSV lines (:class:`generator`)
+    """
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+
+    def line(fields):
+        writer.writerow(fields)
+        value = buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+        return value
+
+    columns = list(__export_series(data))
+    yield line(['timestamp'] + [name for (name, serie) in columns])
+
+    # series are merged on their timestamps, holding one row at a time
+    points = heapq.merge(*[__indexed_points(idx, serie['data'])
+                           for (idx, (name, serie)) in enumerate(columns)])
+    (timestamp, row) = (None, None)
+    for (point_time, idx, value) in points:
+        if point_time != timestamp:
+            if row is not None:
+                yield line([timestamp // 1000] + row)
+            (timestamp, row) = (point_time, [''] * len(columns))
+        row[idx] = value
+    if row is not None:
+        yield line([timestamp // 1000] + row)
+
+
+def mutate_to_csv(module_name, info, data, options=None):
+    """Export RRD series as CSV, streamed to the response
+
+    The first column holds timestamps in seconds, followed by a column per
+    serie named "<node>/<datatype>/<serie>". Rows are aligned on the series
+    timestamps, missing values are left empty.
+
+    :param dict data: RRD Series
+    :param dict info: Munin node graph infos
+    :return: CSV chunks (:class:`generator`)
+    """
+    return __chunked(__csv_lines(__nodes_series(data)))
+
+mutate_to_csv.content_type = 'text/csv; charset=utf-8'
+
+
+def __jsonl_lines(data):
+    """Export series data points as JSON lines
+
+    :param dict data: Nodes RRD series
+    :return: JSON lines (:class:`generator`)
+    """
+    for node in sorted(data):
+        for datatype in sorted(data[node]):
+            for serie in data[node][datatype]:
+                for point in serie['data']:
+                    yield json.dumps({'node': node, 'datatype': datatype,
+                                      'serie': serie['name'],
+                                      'timestamp': point[0] // 1000,
+                                      'value': point[1]}) + '\n'
+
+
+def mutate_to_jsonl(module_name, info, data, options=None):
+    """Export RRD series as JSON lines, streamed to the response
+
+    Each line is a data point object, with "node", "datatype", "serie",
+    "timestamp" (in seconds) and "value" fields.
+
+    :param dict data: RRD Series
+    :param dict info: Munin node graph infos
+    :return: JSON lines chunks (:class:`generator`)
+    """
+    return __chunked(__jsonl_lines(__nodes_series(data)))
+
+mutate_to_jsonl.content_type = 'application/x-ndjson'
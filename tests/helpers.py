@@ -0,0 +1,53 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+
+
+"""Tests helpers
+"""
+
+
+import os
+import imp
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DATA_DIR = os.path.join(ROOT, 'tests', 'data')
+
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'modules'))
+
+
+def load_munin_module(name):
+    """Load a munin module file without its package
+
+    The munin package imports rrdtool, while modules such as the native RRD
+    reader or the rrdcached client do not depend on it.
+
+    :param str name: Module name
+    :return: Loaded module
+    """
+    module_name = "munin_{0}".format(name)
+    if module_name not in sys.modules:
+        imp.load_source(module_name, os.path.join(ROOT, 'modules', 'munin',
+                                                  name + '.py'))
+    return sys.modules[module_name]
@@ -0,0 +1,300 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+
+
+"""Munin federation tests
+
+Three local dispytch servers are started on a generated Munin tree: two
+peers serving one poller each and a front instance serving the last
+poller, the peers ones being located and fetched through federation. The
+munin module depends on rrdtool, these tests are skipped when its python
+bindings are not installed.
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import urllib2
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'modules'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+try:
+    import rrdtool
+    from munin import federation
+except ImportError:
+    rrdtool = None
+
+import generator
+
+SKIP_REASON = "rrdtool python bindings not installed"
+
+
+def free_port():
+    """Get a free local TCP port
+
+    :return: Port number (:class:`int`)
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Instance(object):
+    """Local dispytch server serving a single poller of a generated tree
+    """
+
+    def __init__(self, tree, directory, poller, peers=None):
+        """Initialization method
+
+        :param dict tree: Generated tree description
+        :param str directory: Instance directory
+        :param str poller: Poller served by the instance
+        :param list peers: Federation peers as (poller, Instance)
+        """
+        self.poller = poller
+        self.port = free_port()
+        self.url = "http://127.0.0.1:{0}/d/munin".format(self.port)
+        configpath = os.path.join(directory, "pollers")
+        os.makedirs(configpath)
+        os.symlink(os.path.join(tree['path'], "pollers", poller),
+                   os.path.join(configpath, poller))
+        self.config_file = os.path.join(directory, "dispytch.conf")
+        self.log_file = os.path.join(directory, "server.log")
+        generator.write_dispytch_config(
+            self.config_file, configpath, os.path.join(tree['path'], "db"),
+            [(peer_poller, peer.url) for (peer_poller, peer) in peers or []])
+        self.process = None
+
+    def start(self):
+        """Start the server and wait for it to answer
+        """
+        env = dict(os.environ, DISPYTCH_CONFIG=self.config_file,
+                   PYTHONPATH=os.pathsep.join(
+                       [ROOT] + os.environ.get('PYTHONPATH', '').split(
+                           os.pathsep)))
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, "bin", "dispytch"), "serve",
+             "127.0.0.1:{0}".format(self.port)],
+            env=env, stdout=open(self.log_file, 'w'),
+            stderr=subprocess.STDOUT)
+        deadline = time.time() + 10
+        while True:
+            try:
+                self.get("list", local="yes")
+                return
+            except (urllib2.URLError, socket.error):
+                if time.time() > deadline or self.process.poll() is not None:
+                    raise RuntimeError("{0} server did not start: {1}".format(
+                        self.poller, open(self.log_file).read()))
+                time.sleep(0.1)
+
+    def stop(self):
+        """Stop the server
+        """
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+    def request(self, path, **params):
+        """Request the server munin dispatch
+
+        :param str path: Request path, relative to munin dispatch
+        :return: HTTP status and decoded response (:class:`tuple`)
+        """
+        url = "{0}/{1}".format(self.url, path)
+        if params:
+            url += "?" + "&".join("{0}={1}".format(*item)
+                                  for item in sorted(params.items()))
+        try:
+            response = urllib2.urlopen(url, timeout=10)
+        except urllib2.HTTPError as exc:
+            response = exc
+        try:
+            return response.code, json.loads(response.read())
+        finally:
+            response.close()
+
+    def get(self, path, **params):
+        """Request the server munin dispatch
+
+        :param str path: Request path, relative to munin dispatch
+        :return: Decoded response (:class:`dict`)
+        """
+        return self.request(path, **params)[1]
+
+
+class DeadPeer(object):
+    """Federation peer not listening
+    """
+
+    def __init__(self):
+        self.url = "http://127.0.0.1:{0}/d/munin".format(free_port())
+
+
+@unittest.skipIf(rrdtool is None, SKIP_REASON)
+class FederationTest(unittest.TestCase):
+    """Front instance federating two peers
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp(prefix="dispytch-tests-")
+        cls.tree = generator.generate(os.path.join(cls.tmpdir, "tree"),
+                                      pollers=3, nodes=2, history=2)
+        cls.nodes = dict(
+            ("poller{0}".format(idx), generator.node_names(idx, 2))
+            for idx in range(3))
+        cls.peers = [
+            Instance(cls.tree, os.path.join(cls.tmpdir, poller), poller)
+            for poller in ("poller1", "poller2")]
+        cls.front = Instance(cls.tree, os.path.join(cls.tmpdir, "poller0"),
+                             "poller0", [(peer.poller, peer)
+                                         for peer in cls.peers])
+        # front instance whose only peer is down
+        cls.orphan = Instance(cls.tree, os.path.join(cls.tmpdir, "orphan"),
+                              "poller0", [("poller1", DeadPeer())])
+        cls.instances = cls.peers + [cls.front, cls.orphan]
+        try:
+            for instance in cls.instances:
+                instance.start()
+        except Exception:
+            cls.tearDownClass()
+            raise
+
+    @classmethod
+    def tearDownClass(cls):
+        for instance in cls.instances:
+            instance.stop()
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        spec = "\n".join("{0} {1}".format(peer.poller, peer.url)
+                         for peer in self.peers)
+        federation.configure(spec, timeout=2)
+
+    def tearDown(self):
+        federation.configure(None)
+
+    def by_id(self, instance, targets, **params):
+        """Request the last hour of targets cpu graphs
+
+        :return: Decoded response (:class:`dict`)
+        """
+        return instance.get("by-id/{0}/cpu/AVERAGE/{1}/{2}".format(
+            ",".join(targets), self.tree['stop'] - 3600, self.tree['stop']),
+            **params)
+
+    def test_locate(self):
+        for peer in self.peers:
+            for node in self.nodes[peer.poller]:
+                self.assertEqual(federation.locate(node).url, peer.url)
+        for node in self.nodes['poller0'] + ["unknown;node"]:
+            self.assertIsNone(federation.locate(node))
+
+    def test_locate_refresh_in_background(self):
+        # peer accepting connections but never answering
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        self.addCleanup(server.close)
+        federation.configure("poller9 http://127.0.0.1:{0}/d/munin".format(
+            server.getsockname()[1]), timeout=1, refresh_interval=1)
+        peer = federation.peers.values()[0]
+        peer._nodes = frozenset(["poller9;host"])
+        peer._nodes_checked = time.time() - 10
+
+        # last known list is served while the peer is listed in background
+        started = time.time()
+        self.assertIs(federation.locate("poller9;host"), peer)
+        self.assertIsNone(federation.locate("poller9;other"))
+        self.assertLess(time.time() - started, 0.5)
+        time.sleep(1.5)
+        self.assertEqual(peer.nodes(), frozenset(["poller9;host"]))
+
+    def test_list(self):
+        nodes = self.front.get("list")['result']['nodes_list']
+        self.assertEqual(sorted(nodes),
+                         sorted(sum(self.nodes.values(), [])))
+        local = self.front.get("list", local="yes")['result']['nodes_list']
+        self.assertEqual(sorted(local), sorted(self.nodes['poller0']))
+
+    def test_by_id_forwarding(self):
+        node = self.nodes['poller1'][0]
+        forwarded = self.by_id(self.front, [node])
+        direct = self.by_id(self.peers[0], [node])
+        self.assertNotIn('error', forwarded)
+        self.assertEqual(forwarded['result'], direct['result'])
+
+    def test_by_id_merge(self):
+        targets = [names[0] for (_, names) in sorted(self.nodes.items())]
+        response = self.by_id(self.front, targets)
+        self.assertNotIn('error', response)
+        self.assertNotIn('errors', response)
+        self.assertEqual(set(response['result']), set(targets))
+        for target in targets:
+            self.assertTrue(response['result'][target]['cpu'])
+
+    def by_ip(self, instance, address):
+        """Request the last hour of a node cpu graphs by IP address
+
+        :return: HTTP status and decoded response (:class:`tuple`)
+        """
+        return instance.request("by-ip/{0}/cpu/AVERAGE/{1}/{2}".format(
+            address, self.tree['stop'] - 3600, self.tree['stop']))
+
+    def test_by_ip_unknown(self):
+        (status, response) = self.by_ip(self.front, "192.0.2.1")
+        self.assertEqual(status, 200)
+        self.assertEqual(response['error'], "unknown requested IP")
+
+    def test_by_ip_peer_down(self):
+        # the address may be served by the peer which did not answer
+        (status, response) = self.by_ip(self.orphan, "192.0.2.1")
+        self.assertEqual(status, 503)
+        self.assertIn("federation peers unavailable", response['error'])
+
+    def test_by_ip_local(self):
+        (status, response) = self.by_ip(self.orphan, "10.0.0.0")
+        self.assertEqual(status, 200)
+        self.assertNotIn('error', response)
+
+    def test_by_id_local(self):
+        response = self.by_id(self.front, [self.nodes['poller1'][0]],
+                              local="yes")
+        self.assertIn('error', response)
+
+
+if __name__ == '__main__':
+    unittest.main()
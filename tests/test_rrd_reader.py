@@ -0,0 +1,402 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+
+
+"""Native RRD reader tests
+
+Values fetched by the native reader are checked on a small RRD file
+committed in tests/data, and compared with rrdtool ones on RRD files
+created with Munin archives when the rrdtool python bindings are
+installed.
+
+tests/data/node-load-load-g.rrd is a 64 bits RRD file (format 0003) with a
+single GAUGE data source, a 300 seconds step, last updated at
+FIXTURE_LAST_UP, and these archives:
+
+    AVERAGE 12 rows of 1 step, value of timestamp FIXTURE_END - k * 300
+            is 100 - k, unknown for k in (5, 6)
+    MAX     same rows, values + 0.5
+    AVERAGE 10 rows of 6 steps, value of timestamp FIXTURE_END - k * 1800
+            is 200 - k, unknown for k = 7
+    MAX     same rows, values + 0.5
+"""
+
+
+import os
+import math
+import shutil
+import tempfile
+import unittest
+
+from helpers import DATA_DIR, load_munin_module
+
+rrd_reader = load_munin_module('rrd_reader')
+
+try:
+    import rrdtool
+except ImportError:
+    rrdtool = None
+
+SKIP_REASON = "rrdtool python bindings not installed"
+
+FIXTURE = os.path.join(DATA_DIR, "node-load-load-g.rrd")
+FIXTURE_END = 1400000400
+FIXTURE_LAST_UP = FIXTURE_END + 137
+NAN = float('nan')
+
+
+def fixture_value(cf, step, timestamp):
+    """Value of the fixture archive of a step at a timestamp
+
+    :param str cf: Consolidation function
+    :param int step: Archive step
+    :param int timestamp: Row timestamp
+    :return: Row value, NaN if unknown or out of the archive
+    """
+    (rows, base, unknown) = {300: (12, 100, (5, 6)),
+                             1800: (10, 200, (7,))}[step]
+    k = (FIXTURE_END - timestamp) // step
+    if not 0 <= k < rows or k in unknown:
+        return NAN
+    return base - k + (0.5 if cf == 'MAX' else 0)
+
+
+# Munin creates its RRD files with a 5 minutes step and these archives
+STEP = 300
+RRAS = [(cf, steps, rows)
+        for (steps, rows) in ((1, 576), (6, 432), (24, 540), (288, 450))
+        for cf in ('AVERAGE', 'MIN', 'MAX')]
+
+# synthetic RRD: 12 days of updates, a 2 hours gap and an unaligned last
+# update
+LAST = 1400000000 - 1400000000 % STEP
+FIRST = LAST - 12 * 86400
+GAP = (LAST - 30 * 3600, LAST - 28 * 3600)
+LAST_UP = LAST + 137
+
+
+def create_rrd(path):
+    """Create a Munin like RRD file with a gap in its updates
+
+    :param str path: RRD file path
+    """
+    rrdtool.create(path, "--start", str(FIRST - STEP), "--step", str(STEP),
+                   "DS:42:GAUGE:600:U:U",
+                   *["RRA:{0}:0.5:{1}:{2}".format(cf, steps, rows)
+                     for (cf, steps, rows) in RRAS])
+    updates = []
+    for timestamp in range(FIRST, LAST + 1, STEP):
+        if GAP[0] <= timestamp < GAP[1]:
+            continue
+        updates.append("{0}:{1}".format(
+            timestamp, 50 + 40 * math.sin(timestamp / 3600.0)))
+        if len(updates) >= 512:
+            rrdtool.update(path, *updates)
+            updates = []
+    updates.append("{0}:42".format(LAST_UP))
+    rrdtool.update(path, *updates)
+
+
+class ParseTimeTest(unittest.TestCase):
+    """Time specifications parsing
+    """
+
+    def test_absolute(self):
+        self.assertEqual(rrd_reader.parse_time("1400000000", 42), 1400000000)
+        self.assertEqual(rrd_reader.parse_time(1400000000, 42), 1400000000)
+
+    def test_relative(self):
+        self.assertEqual(rrd_reader.parse_time("now", 1000), 1000)
+        self.assertEqual(rrd_reader.parse_time("now-1h", 10000), 6400)
+        self.assertEqual(rrd_reader.parse_time("now+2min", 1000), 1120)
+        self.assertEqual(rrd_reader.parse_time("now-1week", 604800), 0)
+
+    def test_calendar_units(self):
+        self.assertRaises(rrd_reader.UnsupportedRRD,
+                          rrd_reader.parse_time, "now-1month", 0)
+        self.assertEqual(
+            rrd_reader.parse_time("now-1y", 31536000, approximate=True), 0)
+
+    def test_unsupported(self):
+        for spec in ("yesterday", "now-1fortnight", "now-h", "-1h"):
+            self.assertRaises(rrd_reader.UnsupportedRRD,
+                              rrd_reader.parse_time, spec, 0)
+
+
+class SelectRRATest(unittest.TestCase):
+    """Archive selection
+    """
+
+    def setUp(self):
+        self.header = rrd_reader.RRDHeader(
+            ('42',), STEP, [(cf, rows, steps, 0)
+                            for (cf, steps, rows) in RRAS], 0, 0)
+
+    def select(self, cf, window, step=1):
+        """Select archive for a window ending on the last update
+
+        :return: Selected archive step and consolidation function
+        """
+        index = rrd_reader.select_rra(self.header, cf, LAST - window, LAST,
+                                      LAST, step)
+        (cf_name, _, pdp_cnt, _) = self.header.rras[index]
+        return cf_name, STEP * pdp_cnt
+
+    def test_covering_archive(self):
+        self.assertEqual(self.select('AVERAGE', 3600), ('AVERAGE', 300))
+        self.assertEqual(self.select('MAX', 3 * 86400), ('MAX', 1800))
+        self.assertEqual(self.select('MIN', 30 * 86400), ('MIN', 7200))
+
+    def test_requested_step(self):
+        self.assertEqual(self.select('AVERAGE', 3600, 7200),
+                         ('AVERAGE', 7200))
+        self.assertEqual(self.select('AVERAGE', 3600, 86400),
+                         ('AVERAGE', 86400))
+
+    def test_partial_archive(self):
+        # no archive covers 10 years, the one covering most of it wins
+        self.assertEqual(self.select('AVERAGE', 3650 * 86400),
+                         ('AVERAGE', 86400))
+
+    def test_unknown_cf(self):
+        self.assertRaises(rrd_reader.UnsupportedRRD,
+                          self.select, 'LAST', 3600)
+
+
+class UnsupportedFileTest(unittest.TestCase):
+    """Files the native reader must refuse
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="dispytch-tests-")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_not_rrd(self):
+        path = os.path.join(self.tmpdir, "garbage.rrd")
+        with open(path, 'wb') as rrd_file:
+            rrd_file.write("not a RRD file" * 100)
+        self.assertRaises(rrd_reader.UnsupportedRRD,
+                          rrd_reader.fetch, path, 'AVERAGE', 0, 1)
+
+    def test_truncated(self):
+        path = os.path.join(self.tmpdir, "truncated.rrd")
+        with open(path, 'wb') as rrd_file:
+            rrd_file.write("RRD\0")
+        self.assertRaises(rrd_reader.UnsupportedRRD,
+                          rrd_reader.fetch, path, 'AVERAGE', 0, 1)
+
+
+class FixtureTest(unittest.TestCase):
+    """Native reader on the committed RRD file
+    """
+
+    def check(self, cf, start, end, step, resolution=None):
+        """Fetch a window and check it against the fixture values
+
+        :param int step: Expected archive step
+        :return: Fetched values
+        """
+        (window, ds_names, values) = rrd_reader.fetch(
+            FIXTURE, cf, start, end, now=FIXTURE_LAST_UP,
+            resolution=resolution)
+        start = start - start % step
+        end = end + step - end % step
+        self.assertEqual(window, (start, end, step))
+        self.assertEqual(ds_names, ('42',))
+        expected = [fixture_value(cf, step, timestamp)
+                    for timestamp in range(start + step, end + 1, step)]
+        self.assertEqual(len(values), len(expected))
+        for idx, (value, wanted) in enumerate(zip(values, expected)):
+            if math.isnan(wanted):
+                self.assertTrue(math.isnan(value),
+                                "row {0}: {1} is not NaN".format(idx, value))
+            else:
+                self.assertEqual(value, wanted, "row {0}".format(idx))
+        return values
+
+    def test_archives(self):
+        self.assertEqual(rrd_reader.archives(FIXTURE),
+                         (FIXTURE_LAST_UP,
+                          [('AVERAGE', 300, 12), ('MAX', 300, 12),
+                           ('AVERAGE', 1800, 10), ('MAX', 1800, 10)]))
+
+    def test_fine_archive(self):
+        # rows wrap around the end of the archive
+        for cf in ('AVERAGE', 'MAX'):
+            values = self.check(cf, FIXTURE_END - 3600, FIXTURE_END, 300)
+            self.assertEqual(len(values), 13)
+
+    def test_unknown_values(self):
+        values = self.check('AVERAGE', FIXTURE_END - 3600, FIXTURE_END, 300)
+        self.assertEqual([idx for (idx, value) in enumerate(values)
+                          if math.isnan(value)], [5, 6, 12])
+
+    def test_unaligned_window(self):
+        self.check('AVERAGE', FIXTURE_END - 3600 + 17, FIXTURE_END - 123,
+                   300)
+        self.check('MAX', FIXTURE_END - 1799, FIXTURE_LAST_UP, 300)
+
+    def test_coarse_archive(self):
+        # the fine archive does not cover the window
+        self.check('AVERAGE', FIXTURE_END - 3601, FIXTURE_END, 1800)
+        self.check('MAX', FIXTURE_END - 18000, FIXTURE_END, 1800)
+
+    def test_resolution(self):
+        self.check('AVERAGE', FIXTURE_END - 3600, FIXTURE_END, 1800, 1800)
+        self.check('AVERAGE', FIXTURE_END - 3600, FIXTURE_END, 300, 300)
+
+    def test_outside_archives(self):
+        # before the archives, the one covering most of it is selected,
+        # after the last update the fine archive covers the window
+        for (start, end, step) in (
+                (FIXTURE_END - 40000, FIXTURE_END - 30000, 1800),
+                (FIXTURE_END + 3600, FIXTURE_END + 7200, 300)):
+            values = self.check('AVERAGE', start, end, step)
+            self.assertTrue(all(math.isnan(value) for value in values))
+
+    def test_relative_time(self):
+        fetched = rrd_reader.fetch(FIXTURE, 'AVERAGE', "now-1h", "now",
+                                   now=FIXTURE_LAST_UP)
+        self.assertEqual(fetched[0], (FIXTURE_END - 3600, FIXTURE_END + 300,
+                                      300))
+
+    def test_unknown_cf(self):
+        self.assertRaises(rrd_reader.UnsupportedRRD, rrd_reader.fetch,
+                          FIXTURE, 'MIN', FIXTURE_END - 3600, FIXTURE_END)
+
+    def test_empty_window(self):
+        self.assertRaises(rrd_reader.UnsupportedRRD, rrd_reader.fetch,
+                          FIXTURE, 'AVERAGE', FIXTURE_END, FIXTURE_END)
+
+    @unittest.skipIf(rrdtool is None, SKIP_REASON)
+    def test_rrdtool(self):
+        for (cf, start, end) in (('AVERAGE', FIXTURE_END - 3600, FIXTURE_END),
+                                 ('MAX', FIXTURE_END - 18000, FIXTURE_END),
+                                 ('AVERAGE', FIXTURE_END - 3500,
+                                  FIXTURE_LAST_UP)):
+            expected = rrdtool.fetch(FIXTURE, cf, "-s", str(start),
+                                     "-e", str(end))
+            (window, _, values) = rrd_reader.fetch(FIXTURE, cf, start, end)
+            self.assertEqual(tuple(expected[0]), window)
+            self.assertEqual(
+                [None if math.isnan(value) else value for value in values],
+                [row[0] for row in expected[2]])
+
+
+@unittest.skipIf(rrdtool is None, SKIP_REASON)
+class FetchTest(unittest.TestCase):
+    """Native reader compared with rrdtool fetch
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp(prefix="dispytch-tests-")
+        cls.path = os.path.join(cls.tmpdir, "node-cpu-user-d.rrd")
+        create_rrd(cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def compare(self, cf, start, end, resolution=None):
+        """Fetch a window with both readers and compare results
+
+        :return: Fetched range and values of the native reader
+        """
+        args = [self.path, cf, "-s", str(start), "-e", str(end)]
+        if resolution:
+            args.extend(["-r", str(resolution)])
+        expected = rrdtool.fetch(*args)
+        (window, ds_names, values) = rrd_reader.fetch(
+            self.path, cf, start, end, now=LAST_UP, resolution=resolution)
+
+        self.assertEqual(tuple(expected[0]), window)
+        self.assertEqual(tuple(expected[1]), ds_names)
+        self.assertEqual(len(expected[2]), len(values))
+        for idx, (row, value) in enumerate(zip(expected[2], values)):
+            if row[0] is None:
+                self.assertTrue(math.isnan(value),
+                                "row {0}: {1} is not NaN".format(idx, value))
+            else:
+                self.assertEqual(row[0], value, "row {0}".format(idx))
+        return window, values
+
+    def test_archive_selection(self):
+        steps = []
+        for window in (3600, 86400, 3 * 86400, 30 * 86400, 300 * 86400):
+            for cf in ('AVERAGE', 'MIN', 'MAX'):
+                steps.append(self.compare(cf, LAST - window, LAST)[0][2])
+        self.assertEqual(sorted(set(steps)), [300, 1800, 7200, 86400])
+
+    def test_resolution(self):
+        for resolution in (1800, 7200, 86400):
+            window, _ = self.compare('AVERAGE', LAST - 86400, LAST,
+                                     resolution)
+            self.assertEqual(window[2], resolution)
+
+    def test_unknown_values(self):
+        # values missing in the gap, before the first and after the last
+        # update are unknown
+        for (start, end) in ((GAP[0] - 3600, GAP[1] + 3600),
+                             (FIRST - 86400, FIRST + 86400),
+                             (LAST - 3600, LAST + 3600)):
+            for cf in ('AVERAGE', 'MAX'):
+                _, values = self.compare(cf, start, end)
+                self.assertTrue(any(math.isnan(value) for value in values))
+                self.assertFalse(all(math.isnan(value) for value in values))
+
+    def test_window_edges(self):
+        for (start, end) in ((LAST - 3600, LAST),
+                             (LAST - 3600 - 17, LAST - 123),
+                             (LAST - 3601, LAST_UP),
+                             (LAST - 3 * 86400 + 1, LAST - 86400 - 1),
+                             (LAST - 576 * STEP, LAST),
+                             (LAST - 576 * STEP - 1, LAST)):
+            self.compare('AVERAGE', start, end)
+
+    def test_outside_archives(self):
+        # windows entirely before the first row or after the last update
+        for (start, end) in ((LAST - 4000 * 86400, LAST - 3000 * 86400),
+                             (LAST + 86400, LAST + 2 * 86400)):
+            _, values = self.compare('AVERAGE', start, end)
+            self.assertTrue(all(math.isnan(value) for value in values))
+
+    def test_relative_time(self):
+        expected = rrd_reader.fetch(self.path, 'AVERAGE', LAST_UP - 86400,
+                                    LAST_UP, now=LAST_UP)
+        fetched = rrd_reader.fetch(self.path, 'AVERAGE', "now-1d", "now",
+                                   now=LAST_UP)
+        self.assertEqual(expected[0], fetched[0])
+        self.assertEqual(len(expected[2]), len(fetched[2]))
+
+    def test_archives(self):
+        last_up, layout = rrd_reader.archives(self.path)
+        self.assertEqual(last_up, LAST_UP)
+        self.assertEqual(layout, [(cf, STEP * steps, rows)
+                                  for (cf, steps, rows) in RRAS])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,359 @@
+#! /usr/bin/env python
+# coding: utf8
+
+#
+#    Modular REST API dispatcher in Python (dispytch)
+#
+#    Copyright (C) 2015 Denis Pompilio (jawa) <denis.pompilio@gmail.com>
+#    Copyright (C) 2015 Cyrielle Camanes (cycy) <cyrielle.camanes@gmail.com>
+#
+#    This file is part of dispytch
+#
+#    This program is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU General Public License
+#    as published by the Free Software Foundation; either version 2
+#    of the License, or (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+
+
+"""rrdcached client tests
+
+The client is exercised against a fake rrdcached serving a Unix socket,
+covering pipelined flushes, connection reuse and the error paths, and
+against a locally spawned rrdcached when its binary is available. Tests
+going through the munin module, which depends on rrdtool, are skipped
+when its python bindings are not installed.
+"""
+
+
+import os
+import math
+import time
+import shutil
+import socket
+import tempfile
+import unittest
+import threading
+import subprocess
+
+from helpers import load_munin_module
+
+rrdcached = load_munin_module('rrdcached')
+
+try:
+    import rrdtool
+    from munin import rrd_reader, rrd_utils
+except ImportError:
+    rrdtool = None
+
+SKIP_REASON = "rrdtool python bindings not installed"
+
+
+def find_binary(name):
+    """Find executable in PATH
+
+    :param str name: Executable name
+    :return: Executable path or None (:class:`str`)
+    """
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+class FakeRRDCached(threading.Thread):
+    """Fake rrdcached answering FLUSH commands on a Unix socket
+
+    Flushes of files in ``known`` succeed, others fail as for files unknown
+    to rrdcached. Commands received are recorded with their connection
+    index.
+    """
+
+    def __init__(self, path):
+        """Initialization method
+
+        :param str path: Unix socket path
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.known = set()
+        self.commands = []
+        self.connections = 0
+        # behaviours of the next responses
+        self.drop = False
+        self.garbage = False
+        self.silent = False
+        self.extra_lines = 0
+        self._running = True
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(5)
+        self._server.settimeout(0.1)
+
+    def stop(self):
+        """Stop serving and wait for the thread
+        """
+        self._running = False
+        self.join()
+        self._server.close()
+
+    def run(self):
+        while self._running:
+            try:
+                conn, _ = self._server.accept()
+            except socket.timeout:
+                continue
+            self.connections += 1
+            try:
+                self._handle(conn, self.connections)
+            finally:
+                conn.close()
+
+    def _handle(self, conn, index):
+        """Answer commands of a connection until it is closed
+
+        :param conn: Client connection (:class:`socket.socket`)
+        :param int index: Connection index
+        """
+        conn.settimeout(0.1)
+        reader = conn.makefile('rb')
+        while self._running:
+            try:
+                line = reader.readline()
+            except socket.timeout:
+                continue
+            if not line:
+                return
+            command = line.rstrip('\n')
+            self.commands.append((index, command))
+            if self.silent:
+                continue
+            if self.garbage:
+                conn.sendall("garbage\n")
+                continue
+
+            (name, _, path) = command.partition(' ')
+            if name != 'FLUSH':
+                conn.sendall("-1 Unknown command: {0}\n".format(name))
+            elif path in self.known:
+                conn.sendall("{0} Successfully flushed {1}.\n{2}".format(
+                    self.extra_lines, path,
+                    "detail\n" * self.extra_lines))
+            else:
+                conn.sendall("-1 No such file: {0}\n".format(path))
+
+            if self.drop:
+                self.drop = False
+                return
+
+
+class ParseAddressTest(unittest.TestCase):
+    """rrdcached addresses parsing
+    """
+
+    def test_unix(self):
+        self.assertEqual(rrdcached.parse_address("unix:/run/rrdcached.sock"),
+                         (socket.AF_UNIX, "/run/rrdcached.sock"))
+        self.assertEqual(rrdcached.parse_address("/run/rrdcached.sock"),
+                         (socket.AF_UNIX, "/run/rrdcached.sock"))
+
+    def test_inet(self):
+        self.assertEqual(rrdcached.parse_address("localhost"),
+                         (socket.AF_INET, ("localhost", 42217)))
+        self.assertEqual(rrdcached.parse_address("127.0.0.1:4242"),
+                         (socket.AF_INET, ("127.0.0.1", 4242)))
+
+    def test_inet6(self):
+        self.assertEqual(rrdcached.parse_address("[::1]:4242"),
+                         (socket.AF_INET6, ("::1", 4242)))
+        self.assertEqual(rrdcached.parse_address("[::1]"),
+                         (socket.AF_INET6, ("::1", 42217)))
+        self.assertEqual(rrdcached.parse_address("::1"),
+                         (socket.AF_INET6, ("::1", 42217)))
+
+
+class FakeDaemonCase(unittest.TestCase):
+    """Fake rrdcached serving a temporary Unix socket
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="dispytch-tests-")
+        self.address = "unix:" + os.path.join(self.tmpdir, "rrdcached.sock")
+        self.server = FakeRRDCached(os.path.join(self.tmpdir,
+                                                 "rrdcached.sock"))
+        self.server.known.update(["/data/a.rrd", "/data/b.rrd"])
+        self.server.start()
+        self.client = rrdcached.RRDCachedClient(self.address, timeout=1.0)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        shutil.rmtree(self.tmpdir)
+
+
+class FakeDaemonTest(FakeDaemonCase):
+    """Client against a fake rrdcached
+    """
+
+    def test_pipelined_flush(self):
+        paths = ["/data/a.rrd", "/data/b.rrd", "/data/unknown.rrd"]
+        self.client.flush(paths)
+        self.assertEqual(self.server.commands,
+                         [(1, "FLUSH {0}".format(path)) for path in paths])
+
+    def test_connection_reuse(self):
+        self.client.flush(["/data/a.rrd"])
+        self.client.flush(["/data/b.rrd"])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.server.commands,
+                         [(1, "FLUSH /data/a.rrd"), (1, "FLUSH /data/b.rrd")])
+
+    def test_no_paths(self):
+        self.client.flush([])
+        time.sleep(0.2)
+        self.assertEqual(self.server.connections, 0)
+
+    def test_multiline_response(self):
+        self.server.extra_lines = 2
+        self.client.flush(["/data/a.rrd", "/data/b.rrd"])
+        self.server.extra_lines = 0
+        # additional lines were consumed, responses stay in sync
+        self.client.flush(["/data/a.rrd"])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.commands), 3)
+
+    def test_reconnect(self):
+        self.server.drop = True
+        self.client.flush(["/data/a.rrd"])
+        self.client.flush(["/data/b.rrd"])
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(self.server.commands[-1], (2, "FLUSH /data/b.rrd"))
+
+    def test_malformed_response(self):
+        self.server.garbage = True
+        self.assertRaises(ValueError, self.client.flush, ["/data/a.rrd"])
+        self.server.garbage = False
+        # connection was closed, the next flush gets a new one
+        self.client.flush(["/data/a.rrd"])
+        self.assertEqual(self.server.connections, 2)
+
+    def test_timeout(self):
+        self.server.silent = True
+        self.client.timeout = 0.2
+        self.client.close()
+        self.assertRaises(socket.error, self.client.flush, ["/data/a.rrd"])
+
+    def test_unreachable(self):
+        client = rrdcached.RRDCachedClient(
+            "unix:" + os.path.join(self.tmpdir, "missing.sock"))
+        self.assertRaises(socket.error, client.flush, ["/data/a.rrd"])
+
+
+@unittest.skipIf(rrdtool is None, SKIP_REASON)
+class FlushRRDsTest(FakeDaemonCase):
+    """RRD utilities flushing through a fake rrdcached
+    """
+
+    def tearDown(self):
+        rrd_utils.configure()
+        FakeDaemonCase.tearDown(self)
+
+    def test_flush_rrds(self):
+        rrd_utils.configure(daemon=self.address)
+        client = rrd_utils.DAEMON
+        rrd_utils.flush_rrds(["/data/a.rrd"])
+        # client is kept while the address does not change
+        rrd_utils.configure(daemon=self.address)
+        self.assertIs(rrd_utils.DAEMON, client)
+        rrd_utils.flush_rrds(["/data/b.rrd"])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.server.commands), 2)
+
+    def test_flush_rrds_unreachable(self):
+        # stale data is preferred to failing the request
+        rrd_utils.configure(daemon="unix:" + os.path.join(self.tmpdir,
+                                                          "missing.sock"))
+        rrd_utils.flush_rrds(["/data/a.rrd"])
+
+
+@unittest.skipIf(rrdtool is None, SKIP_REASON)
+@unittest.skipIf(find_binary("rrdcached") is None,
+                 "rrdcached binary not found")
+class RRDCachedTest(unittest.TestCase):
+    """Fetches of RRD files updated through a local rrdcached
+    """
+
+    STEP = 300
+
+    def setUp(self):
+        self.tmpdir = os.path.realpath(
+            tempfile.mkdtemp(prefix="dispytch-tests-"))
+        sock = os.path.join(self.tmpdir, "rrdcached.sock")
+        self.address = "unix:" + sock
+        self.daemon = subprocess.Popen(
+            [find_binary("rrdcached"), "-g", "-l", self.address,
+             "-p", os.path.join(self.tmpdir, "rrdcached.pid"),
+             "-b", self.tmpdir, "-B", "-w", "3600", "-z", "0"],
+            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        deadline = time.time() + 5
+        while not os.path.exists(sock):
+            if time.time() > deadline or self.daemon.poll() is not None:
+                self.fail("rrdcached did not start")
+            time.sleep(0.05)
+
+        self.path = os.path.join(self.tmpdir, "node-load-load-g.rrd")
+        self.last = int(time.time()) // self.STEP * self.STEP - 3600
+        rrdtool.create(self.path, "--start", str(self.last - 86400),
+                       "--step", str(self.STEP), "DS:42:GAUGE:600:U:U",
+                       "RRA:AVERAGE:0.5:1:576")
+        rrdtool.update(self.path, "--daemon", self.address,
+                       *["{0}:{1}".format(timestamp, timestamp % 7)
+                         for timestamp in range(self.last - 3600,
+                                                self.last + 1, self.STEP)])
+
+    def tearDown(self):
+        rrd_utils.configure()
+        self.daemon.terminate()
+        self.daemon.wait()
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self):
+        """Fetch the updated window with the native reader
+
+        :return: Known values (:class:`list`)
+        """
+        (_, _, values) = rrd_reader.fetch(self.path, 'AVERAGE',
+                                          self.last - 3600, self.last)
+        return [value for value in values if not math.isnan(value)]
+
+    def test_flush_before_fetch(self):
+        # updates are kept in rrdcached cache until flushed
+        self.assertEqual(self.fetch(), [])
+        rrd_utils.configure(reader="native", daemon=self.address)
+        rrd_utils.flush_rrds([self.path])
+        self.assertEqual(self.fetch(),
+                         [float(timestamp % 7) for timestamp in
+                          range(self.last - 3300, self.last + 1, self.STEP)])
+
+    def test_unknown_file(self):
+        client = rrdcached.RRDCachedClient(self.address)
+        try:
+            client.flush([os.path.join(self.tmpdir, "missing.rrd"),
+                          self.path])
+            # an unknown file does not break the pipelined responses
+            client.flush([self.path])
+        finally:
+            client.close()
+        self.assertTrue(self.fetch())
+
+
+if __name__ == '__main__':
+    unittest.main()